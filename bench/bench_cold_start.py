@@ -0,0 +1,113 @@
+"""
+冷启动基准：插件重启后的导入耗时，以及重启后第一条命令的延迟（开启/关闭后台预热对比）。
+每次测量都在新的子进程里进行，保证模块、连接池、令牌和渲染缓存都是冷的。
+
+需要在 AstrBot 环境（可导入 astrbot.api）中运行：
+    python bench/bench_cold_start.py --runs 5
+    python bench/bench_cold_start.py --handshake 0.15 --idle 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = """
+import sys, time
+start = time.perf_counter()
+import main
+loaded = time.perf_counter() - start
+deferred = 'qrcode' not in sys.modules and 'PIL' not in sys.modules
+start = time.perf_counter()
+import qrcode
+print(loaded, time.perf_counter() - start, deferred)
+"""
+
+
+def run_child(args) -> str:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    return subprocess.run([sys.executable, *args], cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+
+
+def bench_import(runs: int) -> None:
+    rows = [run_child(["-c", IMPORT_PROBE]).split() for _ in range(runs)]
+    main_ms = statistics.median(float(r[0]) for r in rows) * 1000
+    qr_ms = statistics.median(float(r[1]) for r in rows) * 1000
+    print(f"import main：{main_ms:.1f} ms（中位数，{runs} 次）")
+    print(f"之后首次 import qrcode：{qr_ms:.1f} ms（延后到第一次渲染或后台预热）")
+    print(f"import main 时未加载 qrcode/PIL：{'是' if rows[0][2] == 'True' else '否'}")
+
+
+async def first_command(args) -> dict:
+    """子进程中运行：启动桩服务和插件，空闲 idle 秒后发起第一条 info 和 login"""
+    import main
+    from load_bench import BenchConfig, BenchEvent, drive, route_bilibili
+    from stub_servers import BiliStub, QinglongStub, ScanScript
+
+    bili = BiliStub(latency=args.bili_latency, connect_latency=args.handshake)
+    ql = QinglongStub(latency=args.ql_latency, connect_latency=args.handshake)
+    await bili.start()
+    await ql.start()
+    main.QrPollScheduler.IDLE_INTERVAL = 0.2
+    main.QrPollScheduler.SCANNED_INTERVAL = 0.2
+    config = BenchConfig(
+        ql_config={"ql_panel_url": ql.url, "ql_client_id": ql.client_id, "ql_client_secret": ql.client_secret},
+        slot_config={"max_account": 10, "logout_verify": True, "test": False, "qr_cooldown": 0},
+        advanced_config={"health_check": False, "cookie_refresh": False, "warm_up": args.child == "warm"},
+    )
+    start = time.perf_counter()
+    plugin = main.MyPlugin(None, config)
+    await route_bilibili(plugin, bili.url)
+    bili.render = lambda url: main._render_qr(url, plugin.bili.qr_compact).getvalue()
+    await plugin.initialize()
+    loaded = time.perf_counter() - start
+    try:
+        await asyncio.sleep(args.idle)
+        info = BenchEvent("user0", bili)
+        info_latency = await drive(plugin.info(info), info)
+        login = BenchEvent("user1", bili, ScanScript("10001", 0.1, 0.1))
+        await drive(plugin.login(login, 10001), login)
+        return {"load": loaded, "info": info_latency, "qr": login.first_image_at or 0.0}
+    finally:
+        await plugin.terminate()
+        await bili.stop()
+        await ql.stop()
+
+
+def bench_first_command(args) -> None:
+    print(f"重启后空闲 {args.idle}s 再发第一条命令，新连接握手 {args.handshake * 1000:.0f} ms：")
+    print(f"{'':<10} {'加载':>10} {'首次info':>10} {'首张二维码':>10}")
+    for mode, label in (("cold", "不预热"), ("warm", "后台预热")):
+        child = [__file__, "--child", mode, "--idle", str(args.idle), "--handshake", str(args.handshake),
+                 "--ql-latency", str(args.ql_latency), "--bili-latency", str(args.bili_latency)]
+        rows = [json.loads(run_child(child).strip().splitlines()[-1]) for _ in range(args.runs)]
+        med = {k: statistics.median(r[k] for r in rows) * 1000 for k in ("load", "info", "qr")}
+        print(f"{label:<10} {med['load']:>8.1f}ms {med['info']:>8.1f}ms {med['qr']:>8.1f}ms")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--runs", type=int, default=5, help="每项测量的子进程次数，取中位数")
+    p.add_argument("--idle", type=float, default=1.0, help="插件加载后多久收到第一条命令（秒）")
+    p.add_argument("--handshake", type=float, default=0.1, help="每条新连接的模拟 DNS + TLS 握手耗时（秒）")
+    p.add_argument("--ql-latency", type=float, default=0.005, help="面板每个请求的模拟延迟（秒）")
+    p.add_argument("--bili-latency", type=float, default=0.02, help="B站每个请求的模拟延迟（秒）")
+    p.add_argument("--child", choices=["cold", "warm"], help=argparse.SUPPRESS)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.child:
+        print(json.dumps(asyncio.run(first_command(args))))
+    else:
+        bench_import(args.runs)
+        print()
+        bench_first_command(args)
@@ -0,0 +1,38 @@
+"""
+二维码渲染微基准：对比旧版 PIL 渲染与紧凑 1 位 PNG 渲染的耗时和输出大小。
+
+需要在 AstrBot 环境（可导入 astrbot.api）中运行：
+    python bench/bench_qr_render.py [次数]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# 与 B 站 qrcode/generate 返回的 url 长度一致
+URL_TEMPLATE = "https://account.bilibili.com/h5/account-h5/auth/scan-web?navhide=1&callback=close&qrcode_key={:032x}&from="
+
+
+def bench(label: str, n: int, render) -> None:
+    sizes = []
+    start = time.perf_counter()
+    for i in range(n):
+        sizes.append(len(render(i).getvalue()))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / n * 1000:8.3f} ms/次   {sum(sizes) / len(sizes):8.0f} 字节")
+
+
+def main_bench(n: int) -> None:
+    print(f"渲染 {n} 次：")
+    bench("旧版 PIL（box_size=10）", n, lambda i: main._make_qr_bytes_sync(URL_TEMPLATE.format(i), compact=False))
+    main._qr_matrix.cache_clear()
+    bench("紧凑模式（冷缓存）", n, lambda i: main._make_qr_bytes_sync(URL_TEMPLATE.format(i + n)))
+    # 同一文本重复渲染（预生成池、重发二维码）时矩阵直接命中缓存
+    bench("紧凑模式（矩阵已缓存）", n, lambda i: main._make_qr_bytes_sync(URL_TEMPLATE.format(n)))
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,377 @@
+"""
+插件命令压测：启动本地青龙/B站桩服务，用 N 个并发模拟用户驱动 MyPlugin 的命令，
+输出每类命令的 p50/p99 延迟、每条命令的面板请求数、每个扫码会话的 B 站请求数和新建连接数。
+
+需要在 AstrBot 环境（可导入 astrbot.api）中运行：
+    python bench/load_bench.py --users 20
+    python bench/load_bench.py --users 50 --fast-poll --scan-after 1 --confirm-after 0.5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+from stub_servers import BiliStub, QinglongStub, ScanScript  # noqa: E402
+
+
+class BenchConfig:
+    """模拟 AstrBotConfig：插件按分组读取配置"""
+
+    def __init__(self, ql_config: Dict, slot_config: Dict, advanced_config: Optional[Dict] = None):
+        self.ql_config = ql_config
+        self.slot_config = slot_config
+        self.advanced_config = advanced_config or {}
+
+
+class BenchEvent:
+    """模拟 AstrMessageEvent：记录插件回复，收到二维码图片时按脚本"扫码\""""
+
+    def __init__(self, sender: str, bili: BiliStub, script: Optional[ScanScript] = None):
+        self.sender = sender
+        self.bili = bili
+        self.script = script
+        self.started = time.perf_counter()
+        self.first_image_at: Optional[float] = None
+        self.replies: List[str] = []
+
+    def get_sender_id(self) -> str:
+        return self.sender
+
+    def plain_result(self, text: str):
+        self.replies.append(text)
+        return text
+
+    def image_result(self, path: str):
+        if self.first_image_at is None:
+            self.first_image_at = time.perf_counter() - self.started
+        if self.script is not None:
+            with open(path, "rb") as f:
+                self.bili.scan_image(f.read(), self.script)
+        return path
+
+
+class StubRoute(httpx.AsyncBaseTransport):
+    """把发往 *.bilibili.com 的请求改发到本地 B 站桩服务，插件代码和 URL 常量保持原样"""
+
+    def __init__(self, base_url: str):
+        self.base = httpx.URL(base_url)
+        self.inner = httpx.AsyncHTTPTransport(limits=httpx.Limits(keepalive_expiry=30.0))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        if url.host.endswith("bilibili.com"):
+            url = url.copy_with(scheme=self.base.scheme, host=self.base.host, port=self.base.port)
+        routed = httpx.Request(request.method, url, headers=request.headers, stream=request.stream, extensions=request.extensions)
+        return await self.inner.handle_async_request(routed)
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+async def route_bilibili(plugin, base_url: str) -> None:
+    """换掉插件的 B 站客户端的传输层，沿用原客户端的超时、请求头和 Cookie 策略"""
+    old = plugin.bili.client
+    plugin.bili.client = httpx.AsyncClient(
+        transport=StubRoute(base_url), timeout=old.timeout, headers=old.headers, cookies=old.cookies.jar,
+    )
+    await old.aclose()
+
+
+class PanelGroup:
+    """把多个青龙桩服务当成一个来统计请求数、连接数和环境变量"""
+
+    def __init__(self, stubs: List[QinglongStub]):
+        self.stubs = stubs
+
+    @property
+    def envs(self) -> List[Dict]:
+        return [e for stub in self.stubs for e in stub.envs]
+
+    @property
+    def total_requests(self) -> int:
+        return sum(stub.total_requests for stub in self.stubs)
+
+    @property
+    def bytes_sent(self) -> int:
+        return sum(stub.bytes_sent for stub in self.stubs)
+
+    @property
+    def connections(self) -> int:
+        return sum(stub.connections for stub in self.stubs)
+
+    def reset_counters(self):
+        for stub in self.stubs:
+            stub.reset_counters()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+async def drive(gen, event: BenchEvent) -> float:
+    async for _ in gen:
+        pass
+    return time.perf_counter() - event.started
+
+
+def succeeded(event: BenchEvent) -> bool:
+    # ❌ 失败，⏳ 被限流/冷却拒绝
+    return bool(event.replies) and not event.replies[-1].startswith(("❌", "⏳"))
+
+
+async def run_phase(name: str, plugin, ql: PanelGroup, bili: BiliStub, make_calls) -> None:
+    ql.reset_counters()
+    bili.reset_counters()
+    events, coros = make_calls()
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*coros)
+    wall = time.perf_counter() - start
+
+    n = len(latencies)
+    ok = sum(1 for e in events if succeeded(e))
+    sessions = bili.requests["GET /x/passport-login/web/qrcode/generate"]
+    ttq = [e.first_image_at for e in events if e.first_image_at is not None]
+    line = (
+        f"{name:<12} n={n:<4} 成功={ok:<4} 总耗时={wall:7.2f}s  "
+        f"p50={percentile(latencies, 50) * 1000:8.1f}ms  p99={percentile(latencies, 99) * 1000:8.1f}ms  "
+        f"面板请求/命令={ql.total_requests / n:5.2f}  面板字节/命令={ql.bytes_sent / n:8.0f}  面板新连接={ql.connections}"
+    )
+    if sessions:
+        line += (
+            f"  B站请求/会话={bili.total_requests / sessions:5.2f}"
+            f"  出图p50={percentile(ttq, 50) * 1000:7.1f}ms"
+        )
+    print(line)
+    if ok < n:
+        failed = [e.replies[-1] if e.replies else "（无回复）" for e in events if not succeeded(e)]
+        print(f"{'':<12} 失败示例：{failed[:3]}")
+
+
+async def refresh_phase(plugin, ql: PanelGroup, bili: BiliStub, stale: List[str]) -> None:
+    """让一部分账号进入"需要刷新"状态，跑一轮自动刷新，确认面板里的 Cookie 被换成新的且旧 Cookie 已失效"""
+    if not main.refresh_supported():
+        print(f"{'refresh':<12} 未安装 cryptography，跳过")
+        return
+    for uid in stale:
+        bili.mark_stale(uid)
+    refresher = plugin.cookie_refresher
+    refresher.check_age, refresher.spacing = 0, 0
+    before = {main.env_uid(e): e["value"] for e in ql.envs if e["name"].startswith(main.CHECK_PREFIX)}
+    ql.reset_counters()
+    bili.reset_counters()
+    start = time.perf_counter()
+    done = await refresher.refresh_due()
+    wall = time.perf_counter() - start
+    after = {main.env_uid(e): e["value"] for e in ql.envs if e["name"].startswith(main.CHECK_PREFIX)}
+    stale = [uid for uid in stale if uid in before and uid in after]
+    changed = sum(1 for uid in stale if after[uid] != before[uid])
+    alive = [await plugin.bili.check_login_state(after[uid]) for uid in stale]
+    old_alive = [await plugin.bili.check_login_state(before[uid]) for uid in stale if after[uid] != before[uid]]
+    print(
+        f"{'refresh':<12} 刷新={done}/{len(stale)}  面板Cookie已更新={changed}  新Cookie有效={sum(map(bool, alive))}  "
+        f"旧Cookie仍有效={sum(map(bool, old_alive))}  总耗时={wall:7.2f}s  面板请求={ql.total_requests}  B站请求={bili.total_requests}"
+    )
+
+
+async def panel_outage_phase(plugin, stubs: List[QinglongStub], bili: BiliStub, uids: List[str]) -> None:
+    """停掉最后一个面板，确认其它面板的账号仍可登录、info 仍能展示，不可用面板只影响自己"""
+    down = stubs[-1]
+    await down.stop()
+    down_url = down.url
+    for panel in plugin.ql.panels:
+        panel.invalidate_envs()
+    events = [BenchEvent(f"outage{i}", bili) for i in range(3)]
+    start = time.perf_counter()
+    await asyncio.gather(*[drive(plugin.info(e), e) for e in events])
+    wall = time.perf_counter() - start
+    text = events[0].replies[-1]
+    print(f"{'outage':<12} 停掉 {down_url} 后 info 耗时={wall * 1000:7.1f}ms  展示不可用面板={'暂时无法连接' in text}")
+    # 熔断后再查询，宕机面板的请求直接被拒绝
+    for panel in plugin.ql.panels:
+        panel.invalidate_envs()
+    event = BenchEvent("outage", bili)
+    start = time.perf_counter()
+    await drive(plugin.info(event), event)
+    breaker = main.BREAKERS.get(down_url.split("://", 1)[1])
+    print(f"{'':<12} 再次 info 耗时={(time.perf_counter() - start) * 1000:7.1f}ms  熔断器状态={breaker.state}")
+    event = BenchEvent("outage-login", bili, ScanScript(uids[0], 0.2, 0.1))
+    await drive(plugin.login(event, int(uids[0])), event)
+    live = sum(1 for s in stubs[:-1] for e in s.envs if e["name"].startswith(main.CHECK_PREFIX))
+    print(f"{'':<12} 面板故障期间登录：{event.replies[-1].splitlines()[0]}（可用面板账号数={live}）")
+
+
+async def status_phase(plugin, stubs: List[QinglongStub], uids: List[str], rounds: int = 3) -> None:
+    """每个面板跑完一次每日任务后，所有用户反复查询 status，确认日志只按运行次数读取"""
+    for stub in stubs:
+        for cron in stub.crons:
+            stub._run_cron(cron)
+    await asyncio.sleep(max(stub.run_duration for stub in stubs) + 0.1)
+    for stub in stubs:
+        stub.reset_counters()
+        stub.log_fetches = 0
+    start = time.perf_counter()
+    found = 0
+    for _ in range(rounds):
+        events = [BenchEvent(f"user{i}", None) for i in range(len(uids))]
+        await asyncio.gather(*[drive(plugin.status(e, int(uid)), e) for e, uid in zip(events, uids)])
+        found += sum(1 for e in events if e.replies and "经验" in e.replies[-1])
+    wall = time.perf_counter() - start
+    n = rounds * len(uids)
+    print(
+        f"{'status':<12} n={n:<4} 找到账号日志={found:<4} 总耗时={wall:7.2f}s  "
+        f"面板请求={sum(s.total_requests for s in stubs)}  日志读取={sum(s.log_fetches for s in stubs)}（{len(stubs)} 个面板各运行 1 次）"
+    )
+
+
+async def health_phase(plugin, ql: PanelGroup, bili: BiliStub, expired: List[str]) -> None:
+    """让一部分账号的 Cookie 在 B 站侧失效，跑一轮健康检测，再确认 info 能展示失效账号"""
+    for uid in expired:
+        bili.expire(uid)
+    checker = plugin.health_checker
+    checker.max_age, checker.jitter = 0, 0
+    ql.reset_counters()
+    bili.reset_counters()
+    start = time.perf_counter()
+    checked = await checker.check_due()
+    wall = time.perf_counter() - start
+    dead = sum(1 for st in plugin.registry.all().values() if st.get("alive") is False)
+    print(
+        f"{'health':<12} 检测={checked:<4} 失效={dead}/{len(expired)}  总耗时={wall:7.2f}s  "
+        f"面板请求={ql.total_requests}  B站请求={bili.total_requests}  并发上限={checker.concurrency}"
+    )
+    event = BenchEvent("admin", bili)
+    await drive(plugin.info(event), event)
+    print(f"{'':<12} info 展示失效账号：{event.replies[-1].count('UID ')}")
+
+
+async def bench(args) -> None:
+    bili = BiliStub(latency=args.bili_latency, risk_rps=args.bili_risk_rps)
+    stubs = [QinglongStub(latency=args.ql_latency, paginate=args.ql_paginate) for _ in range(max(1, args.panels))]
+    ql = PanelGroup(stubs)
+    await bili.start()
+    for stub in stubs:
+        await stub.start()
+        for name, desc in main.parse_ql_env_mapping(
+            "最少保留的硬币数量;Ray_DailyTaskConfig__NumberOfProtectedCoins\n点赞视频;DailyTaskConfig__SelectLike"
+        ).items():
+            stub.add_env(name, "10", desc)
+        for i in range(args.noise_envs):
+            stub.add_env(f"UNRELATED_ENV_{i}", "x" * 64)
+
+    if args.fast_poll:
+        main.QrPollScheduler.IDLE_INTERVAL = 0.5
+        main.QrPollScheduler.SCANNED_INTERVAL = 0.2
+
+    config = BenchConfig(
+        ql_config={
+            "ql_panel_url": stubs[0].url,
+            "ql_client_id": stubs[0].client_id,
+            "ql_client_secret": stubs[0].client_secret,
+            "ql_panels": "\n".join(f"{s.url};{s.client_id};{s.client_secret}" for s in stubs[1:]),
+        },
+        slot_config={
+            # 多面板时每个面板的上限按平均分配计算，刚好装下所有用户
+            "max_account": -(-args.users // len(stubs)) if len(stubs) > 1 else args.users * 2,
+            "logout_verify": True,
+            "test": False,
+            "max_qr_sessions": args.max_qr_sessions or args.users,
+            "qr_cooldown": 0,
+            "qr_pool_size": args.qr_pool,
+        },
+        # 健康检测和自动刷新由压测脚本手动触发，不启动后台轮询
+        advanced_config={
+            "health_check": False, "cookie_refresh": False, "bili_max_rps": args.bili_max_rps,
+            "task_trigger_delay": args.task_trigger_delay,
+        },
+    )
+    plugin = main.MyPlugin(None, config)
+    await route_bilibili(plugin, bili.url)
+    plugin.bili.poller.max_rps = args.poll_rps
+    bili.render = lambda url: main._render_qr(url, plugin.bili.qr_compact).getvalue()
+    await plugin.initialize()
+
+    uids = [str(10000 + i) for i in range(args.users)]
+
+    def menu(cmd):
+        def make():
+            events = [BenchEvent(f"user{i}", bili) for i in range(args.users)]
+            return events, [drive(getattr(plugin, cmd)(e), e) for e in events]
+        return make
+
+    def qr_flow(cmd):
+        def make():
+            events = [
+                BenchEvent(f"user{i}", bili, ScanScript(uid, args.scan_after, args.confirm_after))
+                for i, uid in enumerate(uids)
+            ]
+            return events, [drive(getattr(plugin, cmd)(e, int(uid)), e) for e, uid in zip(events, uids)]
+        return make
+
+    def force_logout():
+        events = [BenchEvent("admin", bili) for _ in uids]
+        return events, [drive(plugin.forcelogout(e, int(uid)), e) for e, uid in zip(events, uids)]
+
+    print(f"并发用户数：{args.users}，面板数：{len(stubs)}，面板无关变量：{args.noise_envs}")
+    try:
+        await run_phase("info", plugin, ql, bili, menu("info"))
+        await run_phase("help", plugin, ql, bili, menu("help"))
+        await run_phase("login", plugin, ql, bili, qr_flow("login"))
+        await run_phase("logout", plugin, ql, bili, qr_flow("logout"))
+        await run_phase("login", plugin, ql, bili, qr_flow("login"))
+        await status_phase(plugin, stubs, uids)
+        await refresh_phase(plugin, ql, bili, uids[1::2])
+        await health_phase(plugin, ql, bili, uids[::2])
+        await run_phase("forcelogout", plugin, ql, bili, force_logout)
+        remaining = [e["name"] for e in ql.envs if e["name"].startswith(main.CHECK_PREFIX)]
+        print(f"结束时剩余 Cookie 变量：{len(remaining)}")
+        if args.task_trigger_delay:
+            print(f"登录后触发的 BiliTool 任务运行次数：{sum(s.cron_runs for s in stubs)}（登录 {2 * len(uids)} 次）")
+        if len(stubs) > 1:
+            await panel_outage_phase(plugin, stubs, bili, uids)
+        if bili.risk_rps is not None:
+            print(f"B站桩返回风控次数：{bili.risk_hits}")
+        if args.stats:
+            print()
+            print(plugin._render_stats())
+    finally:
+        await plugin.terminate()
+        await bili.stop()
+        for stub in stubs:
+            await stub.stop()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=20, help="并发模拟用户数")
+    p.add_argument("--scan-after", type=float, default=2.0, help="用户看到二维码后多少秒扫码")
+    p.add_argument("--confirm-after", type=float, default=1.0, help="扫码后多少秒在手机上确认")
+    p.add_argument("--max-qr-sessions", type=int, default=0, help="同时扫码会话上限，0 表示等于用户数")
+    p.add_argument("--qr-pool", type=int, default=1, help="预生成二维码数量，0 关闭")
+    p.add_argument("--poll-rps", type=float, default=4.0, help="全局二维码轮询速率上限")
+    p.add_argument("--fast-poll", action="store_true", help="缩短轮询间隔，加快压测")
+    p.add_argument("--noise-envs", type=int, default=50, help="面板上与插件无关的环境变量数量")
+    p.add_argument("--ql-latency", type=float, default=0.005, help="面板每个请求的模拟延迟（秒）")
+    p.add_argument("--ql-paginate", action="store_true", help="模拟支持环境变量分页的面板")
+    p.add_argument("--panels", type=int, default=1, help="青龙面板数量，大于 1 时测试多面板分片")
+    p.add_argument("--stats", action="store_true", help="结束时打印插件自身的 stats 统计")
+    p.add_argument("--bili-max-rps", type=float, default=5.0, help="插件对每个B站主机的请求速率上限")
+    p.add_argument("--bili-risk-rps", type=float, default=None, help="桩服务每秒请求数超过该值时返回风控 -412，不填不模拟")
+    p.add_argument("--task-trigger-delay", type=float, default=0.5, help="登录后触发 BiliTool 任务的防抖时间（秒），0 不触发")
+    p.add_argument("--bili-latency", type=float, default=0.02, help="B站每个请求的模拟延迟（秒）")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(bench(parse_args()))
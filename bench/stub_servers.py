@@ -0,0 +1,449 @@
+"""
+本地桩服务：模拟插件用到的青龙面板和 B 站接口，供压测脚本使用，不依赖任何第三方库。
+
+- QinglongStub：/open/auth/token、/open/envs（GET/POST/PUT/DELETE）
+- BiliStub：qrcode/generate、qrcode/poll（可编排扫码时间线）、首页 Set-Cookie、
+  nav 登录状态（可让指定账号的 SESSDATA 失效）、Cookie 刷新
+  （cookie/info → correspond → cookie/refresh → confirm/refresh）
+
+两个服务都会统计新建连接数和每个接口的请求数，用来量化插件的往返次数。
+"""
+import asyncio
+import hashlib
+import json
+import secrets
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+Response = Tuple[int, List[Tuple[str, str]], bytes]
+
+
+def json_response(data, status: int = 200, headers: Optional[List[Tuple[str, str]]] = None) -> Response:
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    return status, [("Content-Type", "application/json; charset=utf-8")] + (headers or []), body
+
+
+class StubHTTPServer:
+    """极简 HTTP/1.1 服务，支持 keep-alive，子类实现 handle()"""
+
+    REASONS = {200: "OK", 401: "Unauthorized", 404: "Not Found", 412: "Precondition Failed", 500: "Internal Server Error"}
+
+    def __init__(self, latency: float = 0.0, connect_latency: float = 0.0):
+        # 每个请求附加的模拟网络延迟（秒）
+        self.latency = latency
+        # 每条新连接的第一个请求额外附加的延迟，模拟 DNS 解析 + TLS 握手（秒）
+        self.connect_latency = connect_latency
+        self.connections = 0
+        self.requests: Counter = Counter()
+        # 响应体的总字节数
+        self.bytes_sent = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers: set = set()
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._serve, host, port)
+        sock = self._server.sockets[0].getsockname()
+        self.url = f"http://{sock[0]}:{sock[1]}"
+        return self.url
+
+    async def stop(self):
+        """停止监听并断开所有 keep-alive 连接，可用来模拟服务宕机"""
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+    def reset_counters(self):
+        self.connections = 0
+        self.bytes_sent = 0
+        self.requests.clear()
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._writers.add(writer)
+        handshake = self.connect_latency
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers: Dict[str, str] = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = h.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = b""
+                if int(headers.get("content-length", 0)):
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                parts = urlsplit(target)
+                query = {k: v[-1] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+                self.requests[f"{method} {parts.path}"] += 1
+                if self.latency or handshake:
+                    await asyncio.sleep(self.latency + handshake)
+                    handshake = 0.0
+                try:
+                    status, resp_headers, resp_body = await self.handle(method, parts.path, query, headers, body)
+                except Exception as e:  # 桩服务自身出错时返回 500，方便定位
+                    status, resp_headers, resp_body = json_response({"code": 500, "message": str(e)}, 500)
+
+                if method == "HEAD":
+                    # HEAD 只回头部，Content-Length 仍是完整响应的长度
+                    head_only, resp_body = resp_body, b""
+                else:
+                    head_only = resp_body
+                head = [f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}", f"Content-Length: {len(head_only)}"]
+                head += [f"{k}: {v}" for k, v in resp_headers]
+                self.bytes_sent += len(resp_body)
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + resp_body)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def handle(self, method: str, path: str, query: Dict[str, str], headers: Dict[str, str], body: bytes) -> Response:
+        raise NotImplementedError
+
+
+# =========================
+# 青龙面板
+# =========================
+class QinglongStub(StubHTTPServer):
+    def __init__(self, client_id: str = "stub-id", client_secret: str = "stub-secret", token_ttl: float = 30 * 86400,
+                 paginate: bool = False, run_duration: float = 1.0, **kwargs):
+        """run_duration：BiliTool 定时任务被触发后保持"运行中"的秒数"""
+        super().__init__(**kwargs)
+        # 模拟支持分页的新版面板：带 page/size 查询时返回 {"data": [...], "total": n}
+        self.paginate = paginate
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_ttl = token_ttl
+        self.tokens: Dict[str, float] = {}
+        self.envs: List[Dict] = []
+        self._next_id = 1
+        # 定时任务，status 与青龙一致：0 运行中，1 空闲
+        self.run_duration = run_duration
+        self.crons: List[Dict] = [{
+            "id": 1, "name": "bili每日任务", "command": "task raywangqvq_bilibilitoolpro/bili_task_daily.sh",
+            "status": 1, "isDisabled": 0, "last_execution_time": None, "log_path": None,
+        }]
+        self.cron_runs = 0
+        # 每次运行按当时的 Cookie 变量生成日志，运行中只返回前一半
+        self.cron_log = ""
+        self.log_fetches = 0
+
+    def add_env(self, name: str, value: str, remarks: str = "") -> Dict:
+        env = {"id": self._next_id, "name": name, "value": value, "remarks": remarks, "status": 0}
+        self._next_id += 1
+        self.envs.append(env)
+        return env
+
+    def expire_tokens(self):
+        """让已发放的令牌全部失效，用于测试 401 重新认证"""
+        self.tokens.clear()
+
+    def _authorized(self, headers: Dict[str, str]) -> bool:
+        token = headers.get("authorization", "").replace("Bearer ", "", 1)
+        return self.tokens.get(token, 0) > time.time()
+
+    async def handle(self, method, path, query, headers, body):
+        if path == "/open/auth/token":
+            if query.get("client_id") != self.client_id or query.get("client_secret") != self.client_secret:
+                return json_response({"code": 400, "message": "client_id 或 client_secret 错误"})
+            token = secrets.token_hex(16)
+            expiration = time.time() + self.token_ttl
+            self.tokens[token] = expiration
+            return json_response({"code": 200, "data": {"token": token, "token_type": "Bearer", "expiration": int(expiration)}})
+
+        if not self._authorized(headers):
+            return json_response({"code": 401, "message": "UnauthorizedError"}, 401)
+
+        if path == "/open/envs":
+            return self._envs(method, query, json.loads(body) if body else None)
+        if path == "/open/crons" and method == "GET":
+            sv = query.get("searchValue", "")
+            items = [c for c in self.crons if sv in c["name"] or sv in c["command"]]
+            data = {"data": items, "total": len(items)} if self.paginate else items
+            return json_response({"code": 200, "data": data})
+        if path.startswith("/open/crons/") and path.endswith("/log") and method == "GET":
+            self.log_fetches += 1
+            running = self.crons[0]["status"] == 0
+            return json_response({"code": 200, "data": self.cron_log[:len(self.cron_log) // 2] if running else self.cron_log})
+        if path == "/open/crons/run" and method == "PUT":
+            for cron in self.crons:
+                if cron["id"] in (json.loads(body) or []):
+                    self._run_cron(cron)
+            return json_response({"code": 200})
+        return json_response({"code": 404, "message": "not found"}, 404)
+
+    def _run_cron(self, cron: Dict):
+        cron["status"] = 0
+        cron["last_execution_time"] = int(time.time())
+        cron["log_path"] = f"bili_task_daily/{self.cron_runs}.log"
+        self.cron_runs += 1
+        self.cron_log = self._task_log()
+        asyncio.get_running_loop().call_later(self.run_duration, cron.update, {"status": 1})
+
+    def _task_log(self) -> str:
+        """按 BiliTool 的格式为每个账号生成一段日志：分隔行、UID、经验和硬币"""
+        cookies = sorted(
+            (e for e in self.envs if e["name"].startswith("Ray_BiliBiliCookies__")),
+            key=lambda e: int(e["name"].rsplit("__", 1)[1]) if e["name"].rsplit("__", 1)[1].isdigit() else 1 << 30,
+        )
+        lines = ["开始运行 BiliBiliToolPro 每日任务"]
+        for i, env in enumerate(cookies, 1):
+            uid = parse_qs(env["value"].replace("; ", "&")).get("DedeUserID", ["?"])[0]
+            lines += [
+                f"========== 账号 {i} ==========",
+                f"[08:00:0{i % 10} INF] 登录成功，UID: {uid}",
+                f"[08:00:0{i % 10} INF] 【当前经验】{1000 + i}",
+                "[08:00:0{0} INF] 投币成功，经验+10，【硬币余额】{0}".format(i % 10),
+                "[08:00:0{0} INF] 观看视频成功，经验+5".format(i % 10),
+            ]
+        return "\n".join(lines) + "\n"
+
+    def _envs(self, method, query, payload):
+        if method == "GET":
+            sv = query.get("searchValue", "")
+            items = [e for e in self.envs if not sv or sv in e["name"] or sv in e["value"] or sv in e["remarks"]]
+            if self.paginate and "page" in query:
+                page, size = int(query["page"]), int(query.get("size", 20))
+                return json_response({"code": 200, "data": {"data": items[(page - 1) * size:page * size], "total": len(items)}})
+            return json_response({"code": 200, "data": items})
+        if method == "POST":
+            created = [self.add_env(e["name"], e["value"], e.get("remarks", "")) for e in payload]
+            return json_response({"code": 200, "data": created})
+        if method == "PUT":
+            for env in self.envs:
+                if env["id"] == payload["id"]:
+                    env.update({k: payload[k] for k in ("name", "value", "remarks") if k in payload})
+                    return json_response({"code": 200, "data": env})
+            return json_response({"code": 400, "message": "env not found"})
+        if method == "DELETE":
+            ids = set(payload or [])
+            self.envs = [e for e in self.envs if e["id"] not in ids]
+            return json_response({"code": 200})
+        return json_response({"code": 405, "message": "method not allowed"}, 404)
+
+
+# =========================
+# B 站
+# =========================
+class ScanScript:
+    """
+    一次扫码会话的时间线（相对用户"看到二维码"的时刻）：
+    scan_after 秒后扫码（86101 → 86090），再过 confirm_after 秒确认登录（→ 0）。
+    scan_after 为 None 表示用户一直不扫，直到二维码过期（86038）。
+    """
+
+    def __init__(self, uid: str, scan_after: Optional[float] = 2.0, confirm_after: float = 1.0):
+        self.uid = str(uid)
+        self.scan_after = scan_after
+        self.confirm_after = confirm_after
+
+
+class BiliStub(StubHTTPServer):
+    # 与 B 站一致：二维码 180 秒后过期
+    QR_EXPIRE = 180.0
+
+    def __init__(self, render: Optional[Callable[[str], bytes]] = None, sessdata_ttl: float = 15552000,
+                 refresh_window: float = 7 * 86400, risk_rps: Optional[float] = None, **kwargs):
+        """
+        render：把二维码 url 渲染成图片字节的函数（传入插件的渲染函数），
+        用于从用户收到的图片反查 qrcode_key，模拟"扫描这张图"。
+        sessdata_ttl：登录后 SESSDATA 的有效期（秒），调小可模拟 Cookie 自然过期。
+        refresh_window：SESSDATA 剩余有效期小于该值时，cookie/info 提示需要刷新。
+        risk_rps：最近 1 秒内的请求数超过该值时返回风控（code -412），None 表示不模拟风控。
+        """
+        super().__init__(**kwargs)
+        self.render = render
+        self.sessdata_ttl = sessdata_ttl
+        self.refresh_window = refresh_window
+        self.risk_rps = risk_rps
+        self.risk_hits = 0
+        self._recent: deque = deque()
+        self.sessions: Dict[str, Dict] = {}
+        self._by_image: Dict[str, str] = {}
+        # SESSDATA → 登录记录 {uid, expire_at, bili_jct, refresh_token, refresh_csrf, stale}
+        self.logins: Dict[str, Dict] = {}
+
+    def expire(self, uid) -> int:
+        """让某个账号已发放的 SESSDATA 全部失效（模拟过期或在别处退出），返回失效数量"""
+        victims = [rec for rec in self.logins.values() if rec["uid"] == str(uid)]
+        for rec in victims:
+            rec["expire_at"] = 0.0
+        return len(victims)
+
+    def mark_stale(self, uid) -> int:
+        """让某个账号的有效 SESSDATA 进入"需要刷新"状态，返回数量"""
+        victims = [rec for rec in self.logins.values() if rec["uid"] == str(uid) and rec["expire_at"] > time.time()]
+        for rec in victims:
+            rec["stale"] = True
+        return len(victims)
+
+    def issue_login(self, uid) -> Tuple[str, Dict]:
+        """直接签发一组有效的登录态，返回 (SESSDATA, 登录记录)，便于预置面板中的账号"""
+        sessdata = secrets.token_hex(16)
+        rec = {
+            "uid": str(uid),
+            "expire_at": time.time() + self.sessdata_ttl,
+            "bili_jct": secrets.token_hex(16),
+            "refresh_token": secrets.token_hex(16),
+            "refresh_csrf": "",
+            "stale": False,
+        }
+        self.logins[sessdata] = rec
+        return sessdata, rec
+
+    def _login_of(self, headers: Dict[str, str]) -> Optional[Dict]:
+        cookie = dict(p.strip().split("=", 1) for p in headers.get("cookie", "").split(";") if "=" in p)
+        rec = self.logins.get(cookie.get("SESSDATA", ""))
+        if rec is None or rec["expire_at"] <= time.time():
+            return None
+        return rec
+
+    def _login_cookies(self, sessdata: str, rec: Dict) -> List[Tuple[str, str]]:
+        return [
+            ("Set-Cookie", f"DedeUserID={rec['uid']}; Path=/"),
+            ("Set-Cookie", f"DedeUserID__ckMd5={secrets.token_hex(8)}; Path=/"),
+            ("Set-Cookie", f"SESSDATA={sessdata}; Path=/; HttpOnly"),
+            ("Set-Cookie", f"bili_jct={rec['bili_jct']}; Path=/"),
+            ("Set-Cookie", f"sid={secrets.token_hex(4)}; Path=/"),
+        ]
+
+    def scan_image(self, image: bytes, script: ScanScript) -> bool:
+        """模拟用户扫描收到的二维码图片，返回是否识别出对应的会话"""
+        key = self._by_image.get(hashlib.sha256(image).hexdigest())
+        if key is None:
+            return False
+        self.sessions[key]["script"] = script
+        self.sessions[key]["shown_at"] = time.monotonic()
+        return True
+
+    def _status(self, sess: Dict) -> int:
+        now = time.monotonic()
+        if now - sess["created"] > self.QR_EXPIRE:
+            return 86038
+        script: Optional[ScanScript] = sess.get("script")
+        if script is None or script.scan_after is None:
+            return 86101
+        elapsed = now - sess["shown_at"]
+        if elapsed < script.scan_after:
+            return 86101
+        if elapsed < script.scan_after + script.confirm_after:
+            return 86090
+        return 0
+
+    def _risk_controlled(self) -> bool:
+        if self.risk_rps is None:
+            return False
+        now = time.monotonic()
+        self._recent.append(now)
+        while self._recent and now - self._recent[0] > 1.0:
+            self._recent.popleft()
+        if len(self._recent) > self.risk_rps:
+            self.risk_hits += 1
+            return True
+        return False
+
+    async def handle(self, method, path, query, headers, body):
+        if self._risk_controlled():
+            return json_response({"code": -412, "message": "请求被拦截", "data": None})
+
+        if path == "/x/passport-login/web/qrcode/generate":
+            key = secrets.token_hex(16)
+            url = f"https://account.bilibili.com/h5/account-h5/auth/scan-web?navhide=1&callback=close&qrcode_key={key}&from="
+            self.sessions[key] = {"created": time.monotonic(), "url": url}
+            if self.render:
+                self._by_image[hashlib.sha256(self.render(url)).hexdigest()] = key
+            return json_response({"code": 0, "message": "0", "data": {"url": url, "qrcode_key": key}})
+
+        if path == "/x/passport-login/web/qrcode/poll":
+            sess = self.sessions.get(query.get("qrcode_key", ""))
+            if sess is None:
+                return json_response({"code": 0, "data": {"code": 86038, "message": "二维码已失效"}})
+            code = self._status(sess)
+            cookies, refresh_token = [], ""
+            if code == 0:
+                sessdata, rec = self.issue_login(sess["script"].uid)
+                cookies, refresh_token = self._login_cookies(sessdata, rec), rec["refresh_token"]
+            data = {"code": code, "message": "", "url": "", "refresh_token": refresh_token, "timestamp": int(time.time() * 1000)}
+            return json_response({"code": 0, "message": "0", "data": data}, headers=cookies)
+
+        if path == "/x/web-interface/nav":
+            rec = self._login_of(headers)
+            if rec is None:
+                return json_response({"code": -101, "message": "账号未登录", "data": {"isLogin": False}})
+            return json_response({"code": 0, "message": "0", "data": {"isLogin": True, "mid": int(rec["uid"])}})
+
+        if path.startswith("/x/passport-login/web/") or path.startswith("/correspond/1/"):
+            return self._refresh(method, path, query, headers, body)
+
+        if path == "/":
+            return 200, [
+                ("Content-Type", "text/html; charset=utf-8"),
+                ("Set-Cookie", f"buvid3={secrets.token_hex(16)}infoc; Path=/"),
+                ("Set-Cookie", f"b_nut={int(time.time())}; Path=/"),
+            ], b"<html></html>"
+
+        return json_response({"code": -404, "message": "啥都木有"}, 404)
+
+    def _refresh(self, method, path, query, headers, body) -> Response:
+        """Cookie 刷新流程。correspondPath 无法在桩里解密，只校验它是十六进制串"""
+        rec = self._login_of(headers)
+        form = {k: unquote(v[-1]) for k, v in parse_qs(body.decode("utf-8")).items()} if body else {}
+        if rec is None:
+            return json_response({"code": -101, "message": "账号未登录"})
+
+        if path == "/x/passport-login/web/cookie/info":
+            need = rec["stale"] or rec["expire_at"] - time.time() < self.refresh_window
+            return json_response({"code": 0, "message": "0", "data": {"refresh": need, "timestamp": int(time.time() * 1000)}})
+
+        if path.startswith("/correspond/1/"):
+            try:
+                bytes.fromhex(path.rsplit("/", 1)[-1])
+            except ValueError:
+                return 404, [("Content-Type", "text/html")], b"<html>404</html>"
+            rec["refresh_csrf"] = secrets.token_hex(16)
+            html = f'<html><body><div id="1-name">{rec["refresh_csrf"]}</div></body></html>'
+            return 200, [("Content-Type", "text/html; charset=utf-8")], html.encode("utf-8")
+
+        if path == "/x/passport-login/web/cookie/refresh" and method == "POST":
+            if form.get("csrf") != rec["bili_jct"]:
+                return json_response({"code": -111, "message": "csrf 校验失败"})
+            if not rec["refresh_csrf"] or form.get("refresh_csrf") != rec["refresh_csrf"]:
+                return json_response({"code": 86095, "message": "refresh_csrf 错误或 refresh_token 与 cookie 不匹配"})
+            if form.get("refresh_token") != rec["refresh_token"]:
+                return json_response({"code": 86095, "message": "refresh_csrf 错误或 refresh_token 与 cookie 不匹配"})
+            # 旧 refresh_token 立即作废，旧 SESSDATA 保留到 confirm/refresh
+            rec["consumed_token"], rec["refresh_token"], rec["refresh_csrf"] = rec["refresh_token"], "", ""
+            sessdata, new_rec = self.issue_login(rec["uid"])
+            data = {"status": 0, "message": "", "refresh_token": new_rec["refresh_token"]}
+            return json_response({"code": 0, "message": "0", "data": data}, headers=self._login_cookies(sessdata, new_rec))
+
+        if path == "/x/passport-login/web/confirm/refresh" and method == "POST":
+            if form.get("csrf") != rec["bili_jct"]:
+                return json_response({"code": -111, "message": "csrf 校验失败"})
+            old = [r for r in self.logins.values() if r.get("consumed_token") and r.get("consumed_token") == form.get("refresh_token")]
+            if not old:
+                return json_response({"code": -400, "message": "请求错误"})
+            for r in old:
+                r["expire_at"] = 0.0
+            return json_response({"code": 0, "message": "0", "ttl": 1})
+
+        return json_response({"code": -404, "message": "啥都木有"}, 404)
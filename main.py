@@ -1,12 +1,34 @@
 import asyncio
 import json
+import struct
+import zlib
+import functools
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 from io import BytesIO
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Dict, List, Tuple, Optional
+from urllib.parse import urlsplit
 
 import os
+import re
+import ssl
+import time
+import random
+import hashlib
+import sqlite3
+import secrets
+import socket
 import tempfile
+import importlib.util
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 import httpx
-import qrcode
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，跳过本机文件锁
+    fcntl = None
 
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
 from astrbot.api.star import Context, Star, register
@@ -17,7 +39,188 @@ from astrbot.api import AstrBotConfig
 QRCODE_GENERATE_URL = "https://passport.bilibili.com/x/passport-login/web/qrcode/generate"
 QRCODE_CHECK_URL = "https://passport.bilibili.com/x/passport-login/web/qrcode/poll"
 HOME_PAGE_URL = "https://www.bilibili.com/"
+NAV_URL = "https://api.bilibili.com/x/web-interface/nav"
+COOKIE_INFO_URL = "https://passport.bilibili.com/x/passport-login/web/cookie/info"
+CORRESPOND_URL = "https://www.bilibili.com/correspond/1/{}"
+COOKIE_REFRESH_URL = "https://passport.bilibili.com/x/passport-login/web/cookie/refresh"
+CONFIRM_REFRESH_URL = "https://passport.bilibili.com/x/passport-login/web/confirm/refresh"
+# 生成 correspondPath 用的 B站公钥（RSA-OAEP / SHA-256）
+BILI_REFRESH_PUBKEY = """-----BEGIN PUBLIC KEY-----
+MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDLgd2OAkcGVtoE3ThUREbio0Eg
+Uc/prcajMKXvkCKFCWhJYJcLkcM2DKKcSeFpD/j6Boy538YXnR6VhcuUJOhH2x71
+nzPjfdTcqMz7djHum0qSZA0AyCBDABUqCrfNgCiJ00Ra7GmRj+YCK1NJEuewlb40
+JNrRuoEUXpabUzGB8QIDAQAB
+-----END PUBLIC KEY-----"""
 CHECK_PREFIX = "Ray_BiliBiliCookies__"
+PLUGIN_NAME = "astrbot_plugin_ql_bilibili_account_manager"
+
+def plugin_data_dir() -> str:
+    """插件数据目录，优先使用 AstrBot 提供的目录，旧版本回退到 data/plugin_data/<插件名>"""
+    try:
+        from astrbot.api.star import StarTools
+        path = str(StarTools.get_data_dir(PLUGIN_NAME))
+    except Exception:
+        path = os.path.join("data", "plugin_data", PLUGIN_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# =========================
+# 运行指标：请求/命令计数、延迟、错误率
+# =========================
+# 当前正在执行的命令的统计对象，HTTP 请求据此归属到命令
+_command_stats: contextvars.ContextVar = contextvars.ContextVar("bilitool_command_stats", default=None)
+
+
+class PluginMetrics:
+    """
+    进程内指标收集。计数和直方图用于 Prometheus 导出，
+    每个键另外保留最近的样本用于 stats 命令里的 p50/p99。
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    SAMPLES = 512
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Dict] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1.0):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: Tuple, seconds: float):
+        key = (name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0, "samples": deque(maxlen=self.SAMPLES)}
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                h["buckets"][i] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+        h["samples"].append(seconds)
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self.gauges[name] = fn
+
+    def record_http(self, target: str, method: str, endpoint: str, status: Optional[int], seconds: float):
+        """记录一次对外 HTTP 请求，status 为 None 表示请求异常（未收到响应）"""
+        labels = (("target", target), ("method", method), ("endpoint", endpoint))
+        self.inc("bilitool_http_requests_total", labels)
+        if status is None or status >= 400:
+            self.inc("bilitool_http_errors_total", labels)
+        self.observe("bilitool_http_request_seconds", labels, seconds)
+        stats = _command_stats.get()
+        if stats is not None:
+            stats[target] = stats.get(target, 0) + 1
+
+    @contextmanager
+    def track_command(self, name: str):
+        """
+        包住命令处理流程：记录次数、异常、耗时，以及期间发出的 HTTP 请求数。
+        只负责计数，请求归属由调用方在命令代码实际运行时用 command_scope 设置
+        """
+        stats: Dict[str, int] = {}
+        start = time.perf_counter()
+        labels = (("command", name),)
+        try:
+            yield stats
+        except Exception:
+            self.inc("bilitool_command_errors_total", labels)
+            raise
+        finally:
+            self.inc("bilitool_commands_total", labels)
+            self.observe("bilitool_command_seconds", labels, time.perf_counter() - start)
+            for target, n in stats.items():
+                self.inc("bilitool_command_http_requests_total", labels + (("target", target),), n)
+
+    @staticmethod
+    @contextmanager
+    def command_scope(stats: Optional[Dict[str, int]]):
+        """在这段代码内发出的 HTTP 请求归属 stats；必须在同一上下文里进入和退出（中间不能 yield）"""
+        token = _command_stats.set(stats)
+        try:
+            yield
+        finally:
+            _command_stats.reset(token)
+
+    @staticmethod
+    def current_command() -> Optional[Dict[str, int]]:
+        return _command_stats.get()
+
+    @staticmethod
+    def attach_command(stats: Optional[Dict[str, int]]):
+        """后台任务开始时调用：长期运行的任务不归属任何命令，为某个会话服务的任务归属该会话的命令"""
+        _command_stats.set(stats)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        seen = set()
+
+        def fmt(labels: Tuple) -> str:
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels) + "}"
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            for bound, n in zip(self.BUCKETS, h["buckets"]):
+                lines.append(f"{name}_bucket{fmt(labels + (('le', f'{bound:g}'),))} {n}")
+            lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {h['count']}")
+            lines.append(f"{name}_sum{fmt(labels)} {h['sum']:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {h['count']}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def percentile(self, name: str, labels: Tuple, pct: float) -> float:
+        h = self.histograms.get((name, labels))
+        if not h or not h["samples"]:
+            return 0.0
+        ordered = sorted(h["samples"])
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+METRICS = PluginMetrics()
+
+
+def tracked_command(name: str):
+    """
+    命令处理函数（异步生成器）的装饰器，把整个处理过程计入 METRICS。
+    异步生成器运行在调用方（AstrBot 流水线）的上下文里，命令归属只在每一步 __anext__ 期间设置，
+    yield 出去之后流水线发出的请求不会被算到命令头上
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            with METRICS.track_command(name) as stats:
+                try:
+                    while True:
+                        with METRICS.command_scope(stats):
+                            try:
+                                result = await gen.__anext__()
+                            except StopAsyncIteration:
+                                break
+                        yield result
+                finally:
+                    with METRICS.command_scope(stats):
+                        await gen.aclose()
+        return wrapper
+    return decorator
 
 # =========================
 # 辅助函数：ql_env_mapping 解析
@@ -49,10 +252,86 @@ def parse_ql_env_mapping(raw_text: str, strict: bool = True) -> Dict[str, str]:
         raise ValueError("ql_env_mapping 格式错误，非法行：" + "; ".join(msgs))
     return mapping
 
+def parse_ql_panels(raw_text: str) -> List[Tuple[str, str, str]]:
+    """
+    解析 ql_panels 文本（每行：面板地址;Client ID;Client Secret）
+    返回 [(地址, Client ID, Client Secret)]，非法行记录错误后跳过，不影响其它面板
+    """
+    panels = []
+    for idx, line in enumerate(raw_text.splitlines(), start=1):
+        s = line.strip()
+        if not s:
+            continue
+        parts = [p.strip() for p in s.split(";")]
+        if len(parts) != 3 or not all(parts):
+            logger.error(f"ql_panels 格式错误，已跳过第 {idx} 行：{line!r}")
+            continue
+        panels.append((parts[0].rstrip("/"), parts[1], parts[2]))
+    return panels
+
 # =========================
 # 二维码生成（同步操作放入线程）
 # =========================
-def _make_qr_bytes_sync(qr_text: str) -> BytesIO:
+# 紧凑模式：每个模块的像素数和静区宽度（模块数），手机扫屏幕足够清晰
+QR_COMPACT_SCALE = 6
+QR_COMPACT_BORDER = 2
+
+@lru_cache(maxsize=64)
+def _qr_matrix(qr_text: str) -> Tuple[Tuple[bool, ...], ...]:
+    """
+    编码二维码矩阵（含静区），同一文本重复渲染时直接复用。
+    屏幕扫码不存在污损，使用 L 级纠错以得到更低的版本号、更少的模块。
+    掩码交给 qrcode 按惩罚分选择：固定掩码在个别内容下会出现大片同色区域或类定位图案，
+    部分扫码器识别不了；试算掩码的开销由 lru_cache 和二维码池摊薄。
+    """
+    # 渲染依赖在第一次生成二维码时才导入（或由 initialize 预热），不拖慢插件加载
+    import qrcode
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=QR_COMPACT_BORDER,
+    )
+    qr.add_data(qr_text)
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+def _encode_qr_png(matrix: Tuple[Tuple[bool, ...], ...], scale: int) -> bytes:
+    """把二维码矩阵直接编码为 1 位灰度 PNG，不经过 PIL"""
+    size = len(matrix) * scale
+    row_bytes = (size + 7) // 8
+    raw = bytearray()
+    for row in matrix:
+        # 1 位灰度：0 为黑（深色模块），1 为白
+        bits = 0
+        for dark in row:
+            px = 0 if dark else (1 << scale) - 1
+            bits = (bits << scale) | px
+        bits <<= row_bytes * 8 - size
+        # 每条扫描线以滤波类型 0 开头，同一模块行重复 scale 次
+        line = b"\x00" + bits.to_bytes(row_bytes, "big")
+        raw += line * scale
+    ihdr = struct.pack(">IIBBBBB", size, size, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", ihdr)
+        + _png_chunk(b"IDAT", zlib.compress(bytes(raw), 9))
+        + _png_chunk(b"IEND", b"")
+    )
+
+def _make_qr_bytes_sync(qr_text: str, compact: bool = True) -> BytesIO:
+    start = time.perf_counter()
+    try:
+        return _render_qr(qr_text, compact)
+    finally:
+        METRICS.observe("bilitool_qr_render_seconds", (("mode", "compact" if compact else "pil"),), time.perf_counter() - start)
+
+def _render_qr(qr_text: str, compact: bool) -> BytesIO:
+    if compact:
+        return BytesIO(_encode_qr_png(_qr_matrix(qr_text), QR_COMPACT_SCALE))
+    # 旧版渲染：经 PIL 输出大尺寸图片，保留用于兼容个别识别不了小图的客户端
+    import qrcode
     qr = qrcode.QRCode(version=1, box_size=10, border=1)
     qr.add_data(qr_text)
     qr.make(fit=True)
@@ -62,12 +341,12 @@ def _make_qr_bytes_sync(qr_text: str) -> BytesIO:
     bio.seek(0)
     return bio
 
-async def generate_qr_bytes(qr_text: str) -> BytesIO:
+async def generate_qr_bytes(qr_text: str, compact: bool = True) -> BytesIO:
     """
     在线程池中执行同步二维码生成，返回 BytesIO（已 seek(0)）。
     使用 asyncio.to_thread 避免阻塞事件循环，且不产生嵌套事件循环问题。
     """
-    return await asyncio.to_thread(_make_qr_bytes_sync, qr_text)
+    return await asyncio.to_thread(_make_qr_bytes_sync, qr_text, compact)
 
 # =========================
 # Cookie 工具
@@ -80,11 +359,33 @@ def parse_cookie_string(cookie_str: str) -> Dict[str, str]:
             d[key.strip()] = value.strip()
     return d
 
+def env_name(env: Dict) -> str:
+    """取环境变量名，兼容个别面板返回 bytes 的情况"""
+    name = env.get("name", "")
+    if isinstance(name, bytes):
+        try:
+            name = name.decode("utf-8", errors="ignore")
+        except Exception:
+            name = str(name)
+    return name
+
+def env_slot(env: Dict) -> int:
+    """取 Ray_BiliBiliCookies__N 的序号 N，无法解析时排到最后"""
+    try:
+        return int(env_name(env).split("__")[-1])
+    except Exception:
+        return 99999
+
+def env_uid(env: Dict) -> str:
+    """从备注 bili-<uid> 取 UID，不是本插件写入的变量返回空串"""
+    remarks = str(env.get("remarks") or "")
+    return remarks[5:] if remarks.startswith("bili-") else ""
+
 def merge_cookies_from_response(resp_cookies) -> Dict[str, str]:
     res = {}
     try:
-        # httpx cookies: resp.cookies is Cookies, can iterate
-        for c in resp_cookies:
+        # httpx.Cookies 直接迭代只会得到名字，需要遍历底层 jar 才能拿到 Cookie 对象
+        for c in getattr(resp_cookies, "jar", resp_cookies):
             # c might be cookie tuple or httpx._models.Cookie
             try:
                 name = getattr(c, "name", None)
@@ -104,13 +405,341 @@ def merge_cookies_from_response(resp_cookies) -> Dict[str, str]:
             pass # 你有办法吗
     return res
 
+# =========================
+# 账号导出文件：{"v":1,"exported_at":秒,"accounts":[{"uid","cookie","refresh_token"}]}
+# =========================
+ACCOUNT_EXPORT_VERSION = 1
+
+
+def dump_account_export(accounts: List[Dict]) -> str:
+    """序列化导出文件，紧凑格式，每个账号一行"""
+    head = json.dumps({"v": ACCOUNT_EXPORT_VERSION, "exported_at": int(time.time())}, separators=(",", ":"))[:-1]
+    body = ",\n".join(json.dumps(a, ensure_ascii=False, separators=(",", ":")) for a in accounts)
+    return f'{head},"accounts":[\n{body}\n]}}\n'
+
+
+def load_account_export(text: str) -> List[Dict]:
+    """
+    解析导出文件，返回 [{"uid","cookie","refresh_token"}]，同一 UID 以最后一条为准。
+    文件格式不对时抛出 ValueError。
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"不是有效的JSON：{e}")
+    if not isinstance(data, dict) or data.get("v") != ACCOUNT_EXPORT_VERSION or not isinstance(data.get("accounts"), list):
+        raise ValueError("不是本插件导出的账号文件")
+    accounts: Dict[str, Dict] = {}
+    for idx, item in enumerate(data["accounts"], start=1):
+        if not isinstance(item, dict) or not str(item.get("uid", "")).isdigit() or not item.get("cookie"):
+            raise ValueError(f"第 {idx} 个账号缺少 uid 或 cookie")
+        uid = str(item["uid"])
+        accounts[uid] = {"uid": uid, "cookie": str(item["cookie"]), "refresh_token": str(item.get("refresh_token") or "")}
+    return list(accounts.values())
+
+# =========================
+# Cookie 刷新：correspondPath 加密（可选依赖 cryptography）
+# =========================
+def refresh_supported() -> bool:
+    return importlib.util.find_spec("cryptography") is not None
+
+
+@lru_cache(maxsize=1)
+def _refresh_public_key():
+    from cryptography.hazmat.primitives import serialization
+    return serialization.load_pem_public_key(BILI_REFRESH_PUBKEY.encode())
+
+
+def correspond_path(timestamp: int) -> str:
+    """用 B站公钥加密 refresh_{毫秒时间戳}，得到 correspond 页面路径"""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    encrypted = _refresh_public_key().encrypt(
+        f"refresh_{timestamp}".encode(),
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
+    )
+    return encrypted.hex()
+
+
+REFRESH_CSRF_RE = re.compile(r'<div id="1-name">([^<]+)</div>')
+
+# =========================
+# 重试与熔断：BiliClient 和 QinglongClient 共用
+# =========================
+@lru_cache(maxsize=1)
+def shared_ssl_context() -> ssl.SSLContext:
+    """
+    所有 HTTP/1.1 客户端共用一个 SSL 上下文：每新建一个都要重新加载 CA 证书，
+    多面板时插件加载会因此多花几十毫秒。HTTP/2 客户端要协商 ALPN，不共用。
+    """
+    return httpx.create_ssl_context()
+
+
+class CircuitOpenError(httpx.ConnectError):
+    """目标主机处于熔断状态，请求没有发出。继承 ConnectError，沿用"无法连接"的处理"""
+
+
+class CircuitBreaker:
+    """
+    单个主机的熔断器：
+    - closed：正常放行，连续失败 failure_threshold 次后转为 open
+    - open：reset_timeout 秒内直接拒绝，不再等待超时
+    - half_open：到时间后只放行一个探测请求，成功则恢复，失败则重新计时
+    """
+
+    def __init__(self, host: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+        # 半开时同一时间只有一个探测请求；探测被取消没有结果时，超时后允许再探测
+        if now - self._probe_at < self.reset_timeout:
+            return False
+        self._probe_at = now
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probe_at = 0.0
+
+    def record_skipped(self):
+        """请求没有到达主机（本地连接池排队超时），不算成败；半开时让出探测名额"""
+        if self.state == "half_open":
+            self._probe_at = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"{self.host} 连续 {self.failures} 次请求失败，熔断 {self.reset_timeout:g} 秒")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_at = 0.0
+
+
+class BreakerRegistry:
+    """按主机名共享熔断器，同一主机的所有客户端看到同一个状态"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, host: str) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers[host] = CircuitBreaker(host)
+        return breaker
+
+    def items(self) -> List[Tuple[str, CircuitBreaker]]:
+        return sorted(self._breakers.items())
+
+    @property
+    def open_count(self) -> int:
+        return sum(1 for b in self._breakers.values() if b.state != "closed")
+
+
+BREAKERS = BreakerRegistry()
+
+# 服务端临时故障，幂等请求可以重试
+RETRYABLE_STATUS = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 2.0) -> float:
+    """指数退避加随机抖动，避免大量请求在同一时刻重试"""
+    return min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+
+async def resilient_request(client: httpx.AsyncClient, method: str, url: str, host: str, retries: int = 1, **kwargs) -> httpx.Response:
+    """
+    经过熔断器并按错误类型重试地发送请求：
+    - 连接阶段的错误（请求还没发出）任何方法都重试
+    - 读写超时、对端断开连接和 502/503/504 只对幂等方法重试：此时请求可能已被处理，
+      POST 不重试，避免重复创建变量/重复消耗 refresh_token
+    - 每次尝试的成败都计入该主机的熔断器，熔断中直接抛出 CircuitOpenError；
+      本地连接池排队超时（PoolTimeout）与对端无关，不计入熔断器
+    """
+    breaker = BREAKERS.get(host)
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    for attempt in range(retries + 1):
+        if not breaker.allow():
+            METRICS.inc("bilitool_circuit_rejected_total", (("host", host),))
+            raise CircuitOpenError(f"{host} 暂时不可用，请稍后再试")
+        try:
+            resp = await client.request(method, url, **kwargs)
+        except httpx.PoolTimeout as e:
+            # 本进程的连接池占满，请求没有发出，主机本身未必有问题
+            error, retryable = e, True
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            error, retryable = e, True
+        except (httpx.TimeoutException, httpx.RemoteProtocolError) as e:
+            # 对端可能已读取并处理了请求后才断开，只有幂等方法可以放心重发
+            error, retryable = e, idempotent
+        else:
+            if resp.status_code not in RETRYABLE_STATUS:
+                breaker.record_success()
+                return resp
+            breaker.record_failure()
+            # 刚被熔断时不再重试，直接把结果交给调用方
+            if not idempotent or attempt >= retries or breaker.state == "open":
+                return resp
+            error, retryable = None, True
+
+        if error is not None:
+            if isinstance(error, httpx.PoolTimeout):
+                breaker.record_skipped()
+            else:
+                breaker.record_failure()
+            if not retryable or attempt >= retries or breaker.state == "open":
+                raise error
+        METRICS.inc("bilitool_http_retries_total", (("host", host),))
+        logger.debug(f"{method} {host} 第 {attempt + 1} 次请求失败，稍后重试：{error or resp.status_code}")
+        await asyncio.sleep(backoff_delay(attempt))
+    raise RuntimeError("unreachable")
+
+# =========================
+# B站自适应限速：遇到风控自动降速
+# =========================
+RISK_CONTROL_CODES = {-412}
+
+
+class AdaptiveRateLimiter:
+    """
+    单个 B站主机的令牌桶限速：
+    - 平时按 max_rps 放行，允许 max_rps 个突发
+    - 收到风控（HTTP 412 / code -412）时速率减半，并在 hold 秒内暂停发起新的扫码会话，
+      连续触发时暂停时间翻倍（最长 max_hold）
+    - 暂停结束后在 recovery 秒内线性恢复到 max_rps
+    """
+    MIN_RPS = 0.2
+    # 同一波并发请求会几乎同时收到风控，这段时间内只算一次
+    STRIKE_DEDUP = 2.0
+
+    def __init__(self, host: str, max_rps: float = 5.0, hold: float = 60.0, max_hold: float = 600.0, recovery: float = 300.0):
+        self.host = host
+        self.max_rps = max(self.MIN_RPS, max_rps)
+        self.rate = self.max_rps
+        self.burst = max(1.0, self.max_rps)
+        self.tokens = self.burst
+        self.hold = hold
+        self.max_hold = max_hold
+        self.recovery = recovery
+        self.hold_until = 0.0
+        self.strikes = 0
+        self.last_strike = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if self.rate < self.max_rps and now >= self.hold_until:
+            # 只有暂停结束之后的时间算恢复期，暂停期间没有请求时不能一次补回
+            recovering = now - max(self._updated, self.hold_until)
+            self.rate = min(self.max_rps, self.rate + self.max_rps * recovering / self.recovery)
+        self._updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        # 很久没有再触发风控，连续次数清零
+        if self.strikes and now - self.last_strike > self.max_hold + self.recovery:
+            self.strikes = 0
+
+    async def acquire(self):
+        """取一个令牌，不够时排队等待（先到先得）"""
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self):
+        now = time.monotonic()
+        if now - self.last_strike < self.STRIKE_DEDUP:
+            return
+        self._refill(now)
+        self.strikes += 1
+        self.last_strike = now
+        self.rate = max(self.MIN_RPS, self.rate / 2)
+        self.tokens = 0.0
+        hold = min(self.max_hold, self.hold * 2 ** (self.strikes - 1))
+        self.hold_until = max(self.hold_until, now + hold)
+        METRICS.inc("bilitool_bili_risk_control_total", (("host", self.host),))
+        logger.warning(f"B站 {self.host} 触发风控，速率降至 {self.rate:.2f} 次/秒，{hold:g} 秒内暂停新的扫码会话")
+
+    @property
+    def hold_left(self) -> float:
+        return max(0.0, self.hold_until - time.monotonic())
+
+    @property
+    def current_rate(self) -> float:
+        self._refill(time.monotonic())
+        return self.rate
+
+
+def is_risk_control(resp: httpx.Response) -> bool:
+    if resp.status_code == 412:
+        return True
+    if not resp.headers.get("content-type", "").startswith("application/json"):
+        return False
+    try:
+        data = resp.json()
+    except Exception:
+        return False
+    return isinstance(data, dict) and data.get("code") in RISK_CONTROL_CODES
+
 # =========================
 # BiliClient: 与 B站交互（异步 httpx）
 # =========================
-class BiliClient:
+class BiliSession:
+    """
+    一次扫码流程独占的 Cookie 容器。
+    连接池由 BiliClient 共享，Cookie 只存在这里，流程结束后随会话一起释放，
+    并发登录不会串号，也不会在共享客户端里越积越多。
+    """
+    __slots__ = ("cookies", "refresh_token")
+
     def __init__(self):
+        self.cookies: Dict[str, str] = {}
+        # 登录成功时下发的 refresh_token，用于之后刷新 Cookie
+        self.refresh_token: str = ""
+
+    def absorb(self, resp: httpx.Response):
+        self.cookies.update(merge_cookies_from_response(resp.cookies))
+
+
+def cookie_header(cookies: Dict) -> Dict[str, str]:
+    """把 cookie 字典转成请求头，避免使用 httpx 已弃用的单次请求 cookies 参数"""
+    if not cookies:
+        return {}
+    return {"Cookie": "; ".join(f"{k}={v}" for k, v in cookies.items())}
+
+
+class BiliClient:
+    def __init__(self, qr_compact: bool = True, max_rps: float = 5.0, qr_pool_size: int = 0):
+        self.qr_compact = qr_compact
+        self.max_rps = max_rps
+        # 主机名 → 限速器，按原始 *.bilibili.com 主机区分
+        self.limiters: Dict[str, AdaptiveRateLimiter] = {}
         self.client = httpx.AsyncClient(
-            timeout=15.0,
+            # 连接超时单独设短，主机宕机时尽快失败并触发熔断
+            timeout=httpx.Timeout(15.0, connect=3.0),
+            verify=shared_ssl_context(),
+            # 预热建立的连接要能留到第一次扫码，空闲连接多保留一会
+            limits=httpx.Limits(keepalive_expiry=30.0),
+            # 共享客户端拒收一切 Cookie，所有 Cookie 都由各自的 BiliSession 保存
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
             headers={
                 "User-Agent": (
                     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -122,11 +751,61 @@ class BiliClient:
                 "Accept": "application/json, text/plain, */*",
             }
         )
+        self.poller = QrPollScheduler(self)
+        self.qr_pool = QrKeyPool(self, qr_pool_size)
+
+    # 每个请求失败后最多重试的次数
+    RETRIES = 1
+
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """B站请求的统一出口：按主机限速、熔断、重试临时错误，并记录耗时和结果"""
+        endpoint = url.split("bilibili.com", 1)[-1] or "/"
+        if endpoint.startswith("/correspond/"):
+            # correspondPath 每次都不同，统计时合并为一个接口
+            endpoint = "/correspond/1/*"
+        host = urlsplit(url).netloc
+        limiter = self._limiter(host)
+        await limiter.acquire()
+        start = time.perf_counter()
+        status = None
+        try:
+            resp = await resilient_request(self.client, method, url, host, retries=self.RETRIES, **kwargs)
+            status = resp.status_code
+            if is_risk_control(resp):
+                limiter.penalize()
+            return resp
+        finally:
+            METRICS.record_http("bilibili", method, endpoint, status, time.perf_counter() - start)
 
+    def _limiter(self, host: str) -> AdaptiveRateLimiter:
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = self.limiters[host] = AdaptiveRateLimiter(host, self.max_rps)
+        return limiter
+
+    def hold_left(self) -> float:
+        """因风控暂停新扫码会话的剩余秒数，0 表示可以发起"""
+        return max((l.hold_left for l in self.limiters.values()), default=0.0)
+
+    async def _get(self, url: str, **kwargs) -> httpx.Response:
+        return await self._send("GET", url, **kwargs)
+
+    async def _post(self, url: str, **kwargs) -> httpx.Response:
+        return await self._send("POST", url, **kwargs)
+
+    async def warm_up(self):
+        """提前完成扫码接口所在主机的 DNS 解析和 TLS 握手，连接留在连接池里给第一次扫码使用"""
+        try:
+            await self._send("HEAD", f"https://{urlsplit(QRCODE_GENERATE_URL).netloc}/")
+        except Exception as e:
+            logger.debug(f"预连接B站失败：{e}")
 
     async def generate_qrcode(self) -> Tuple[Optional[str], Optional[BytesIO]]:
+        if self.hold_left() > 0:
+            logger.warning("B站风控冷却中，暂不生成二维码")
+            return None, None
         try:
-            resp = await self.client.get(QRCODE_GENERATE_URL)
+            resp = await self._get(QRCODE_GENERATE_URL)
             resp.raise_for_status()
             data = resp.json()
             if data.get("code") != 0:
@@ -135,317 +814,2401 @@ class BiliClient:
             qrcode_url = data["data"]["url"]
             oauth_key = data["data"]["qrcode_key"]
             # 生成二维码 BytesIO（内存）
-            img_bytes = await generate_qr_bytes(qrcode_url)
+            img_bytes = await generate_qr_bytes(qrcode_url, compact=self.qr_compact)
             return oauth_key, img_bytes
         except Exception as e:
-            logger.error(f"generate_qrcode 异常：{e}", exc_info=True)
-            return None, None
+            logger.error(f"generate_qrcode 异常：{e}", exc_info=True)
+            return None, None
+
+    async def check_qrcode_status(self, oauth_key: str, timeout_seconds: int = 120, session: Optional[BiliSession] = None) -> Optional[Dict]:
+        """
+        等待二维码登录结果，轮询由 QrPollScheduler 统一调度。
+        成功时返回合并后的 cookie 字典（包含补全后的 cookie），refresh_token 留在 session 中。
+        """
+        return await self.poller.wait(oauth_key, timeout_seconds, session or BiliSession())
+
+    async def poll_qrcode_once(self, oauth_key: str, session: Optional[BiliSession] = None) -> Tuple[Optional[int], Optional[Dict]]:
+        """
+        查询一次二维码状态，返回 (状态码, cookies)。
+        状态码：0 登录成功（此时 cookies 为补全后的字典）；86038 已过期；
+        86101 等待扫码；86090 已扫描等待确认；None 为接口返回非预期数据。
+        登录过程中收到的 Cookie 只写入 session。
+        """
+        session = session or BiliSession()
+        resp = await self._get(
+            QRCODE_CHECK_URL, params={"qrcode_key": oauth_key}, headers=cookie_header(session.cookies)
+        )
+        resp.raise_for_status()
+        session.absorb(resp)
+        data = resp.json()
+        inner = data.get("data") or {}
+        status_code = inner.get("code") if isinstance(inner, dict) else None
+        # B 站返回结构复杂：top-level code 非 0 时通常是接口错误或提示，只认过期
+        if data.get("code") != 0:
+            if status_code == 86038:
+                return 86038, None
+            logger.debug(f"二维码检查返回非预期数据：{data}")
+            return None, None
+        if status_code != 0:
+            return status_code, None
+
+        # 登录成功：本会话收到的 Cookie 即为该账号的登录态，再请求首页补全
+        session.refresh_token = str(inner.get("refresh_token") or "")
+        cookies = await self.complement_cookies(dict(session.cookies))
+        logger.info("B站二维码登录成功，已提取并补全 Cookies")
+        return 0, cookies
+
+    async def complement_cookies(self, cookies: Dict) -> Dict:
+        """
+        访问 B 站首页以补全服务器在 Set-Cookie 中设置的 cookie。
+        返回合并后的 cookie dict。
+        """
+        try:
+            resp = await self._get(HOME_PAGE_URL, headers=cookie_header(cookies))
+            resp.raise_for_status()
+            new_cookies = merge_cookies_from_response(resp.cookies)
+            cookies.update(new_cookies)
+            logger.debug(f"补全Cookie成功，新增字段：{','.join(new_cookies.keys())}")
+            return cookies
+        except Exception as e:
+            logger.error(f"complement_cookies 异常：{e}", exc_info=True)
+            return cookies
+
+    async def check_login_state(self, cookie_str: str) -> Optional[bool]:
+        """
+        用 nav 接口在线检测 Cookie 是否仍处于登录状态。
+        返回 True 有效、False 已失效（-101 未登录），None 表示无法判断（网络错误等）。
+        """
+        try:
+            resp = await self._get(NAV_URL, headers={"Cookie": cookie_str})
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("code") == 0:
+                return bool((data.get("data") or {}).get("isLogin"))
+            if data.get("code") == -101:
+                return False
+            logger.warning(f"检测登录状态返回非预期数据：{data.get('code')} {data.get('message')}")
+            return None
+        except Exception as e:
+            logger.warning(f"检测登录状态异常：{e}")
+            return None
+
+    async def cookie_refresh_info(self, cookies: Dict) -> Tuple[Optional[bool], int]:
+        """
+        查询 Cookie 是否需要刷新，返回 (是否需要刷新, 毫秒时间戳)。
+        None 表示无法判断（未登录或请求失败）。
+        """
+        try:
+            resp = await self._get(
+                COOKIE_INFO_URL, params={"csrf": cookies.get("bili_jct", "")}, headers=cookie_header(cookies)
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("code") != 0:
+                logger.warning(f"查询Cookie刷新状态失败：{data.get('code')} {data.get('message')}")
+                return None, 0
+            inner = data.get("data") or {}
+            return bool(inner.get("refresh")), int(inner.get("timestamp") or time.time() * 1000)
+        except Exception as e:
+            logger.warning(f"查询Cookie刷新状态异常：{e}")
+            return None, 0
+
+    async def refresh_cookies(self, cookies: Dict, refresh_token: str, timestamp: int) -> Tuple[Optional[Dict], str]:
+        """
+        刷新 Cookie，返回 (新 cookies, 新 refresh_token)，失败时返回 (None, "")。
+        刷新后旧 Cookie 仍然有效，直到调用 confirm_refresh。
+        """
+        try:
+            resp = await self._get(CORRESPOND_URL.format(correspond_path(timestamp)), headers=cookie_header(cookies))
+            resp.raise_for_status()
+            match = REFRESH_CSRF_RE.search(resp.text)
+            if not match:
+                logger.warning("获取refresh_csrf失败：页面中没有找到对应字段")
+                return None, ""
+
+            resp = await self._post(
+                COOKIE_REFRESH_URL,
+                data={
+                    "csrf": cookies.get("bili_jct", ""),
+                    "refresh_csrf": match.group(1),
+                    "source": "main_web",
+                    "refresh_token": refresh_token,
+                },
+                headers=cookie_header(cookies),
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("code") != 0:
+                logger.warning(f"刷新Cookie失败：{data.get('code')} {data.get('message')}")
+                return None, ""
+            new_cookies = dict(cookies)
+            new_cookies.update(merge_cookies_from_response(resp.cookies))
+            return new_cookies, str((data.get("data") or {}).get("refresh_token") or "")
+        except Exception as e:
+            logger.warning(f"刷新Cookie异常：{e}")
+            return None, ""
+
+    async def confirm_refresh(self, new_cookies: Dict, old_refresh_token: str) -> bool:
+        """确认刷新，让旧 Cookie 失效"""
+        try:
+            resp = await self._post(
+                CONFIRM_REFRESH_URL,
+                data={"csrf": new_cookies.get("bili_jct", ""), "refresh_token": old_refresh_token},
+                headers=cookie_header(new_cookies),
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("code") != 0:
+                logger.warning(f"确认刷新Cookie失败：{data.get('code')} {data.get('message')}")
+                return False
+            return True
+        except Exception as e:
+            logger.warning(f"确认刷新Cookie异常：{e}")
+            return False
+
+    async def validate_cookie(self, cookies: Dict) -> Tuple[bool, str]:
+        """
+        验证 Cookie 有效性，保持与原函数签名一致。
+        """
+        required_fields = ["DedeUserID", "SESSDATA", "bili_jct"]
+        missing = [f for f in required_fields if f not in cookies]
+        if missing:
+            return False, f"缺少必要Cookie字段：{', '.join(missing)}"
+        if not str(cookies["DedeUserID"]).isdigit():
+            return False, "DedeUserID格式无效（非数字）"
+        if len(cookies["SESSDATA"]) < 20:
+            return False, "SESSDATA格式无效（长度不足20）"
+        if len(cookies["bili_jct"]) != 32:
+            return False, "bili_jct格式无效（长度不为32）"
+        return True, "Cookie验证通过"
+
+    async def close(self):
+        await self.qr_pool.close()
+        await self.poller.close()
+        await self.client.aclose()
+
+# =========================
+# QrPollScheduler: 统一调度所有待扫码会话的轮询
+# =========================
+class QrPollScheduler:
+    """
+    一个后台任务负责轮询所有待扫码的 qrcode_key，代替每个会话各自 while 循环。
+    - 等待扫码（86101）时慢速轮询，已扫描待确认（86090）时快速轮询
+    - 全局限制每秒轮询请求数，并发会话再多，B站收到的请求量也有上限
+    - 会话到达终态（成功/过期/超时）时完成对应的 future
+    """
+    # 等待扫码时的轮询间隔（秒）
+    IDLE_INTERVAL = 3.0
+    # 已扫码等待确认时的轮询间隔（秒），确认后尽快拿到结果
+    SCANNED_INTERVAL = 1.0
+    # 连续多少次请求异常后放弃该会话
+    MAX_ERRORS = 3
+
+    def __init__(self, bili: "BiliClient", max_rps: float = 4.0):
+        self.bili = bili
+        self.max_rps = max_rps
+        self._sessions: Dict[str, Dict] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # 持有在途轮询任务的引用，避免被垃圾回收
+        self._inflight: set = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._sessions)
+
+    async def wait(self, oauth_key: str, timeout_seconds: float, session: Optional["BiliSession"] = None) -> Optional[Dict]:
+        now = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._sessions[oauth_key] = {
+            "future": fut,
+            "session": session or BiliSession(),
+            # 轮询请求归属到发起该会话的命令
+            "command": METRICS.current_command(),
+            "deadline": now + timeout_seconds,
+            # 刚发出的二维码不可能已被扫描，首轮轮询延后一个慢速间隔
+            "next_poll": now + self.IDLE_INTERVAL,
+            "errors": 0,
+        }
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        try:
+            return await fut
+        finally:
+            # 调用方被取消时同样移除会话，不再继续轮询
+            self._sessions.pop(oauth_key, None)
+
+    async def _run(self):
+        METRICS.attach_command(None)
+        spacing = 1.0 / self.max_rps
+        while self._sessions:
+            now = time.monotonic()
+            for key, sess in list(self._sessions.items()):
+                if now >= sess["deadline"]:
+                    logger.warning("二维码轮询超时")
+                    self._finish(key, None)
+
+            # 每轮只发一个请求，挑等得最久的会话，保证公平且不超过全局速率
+            due = min(
+                ((sess["next_poll"], key) for key, sess in self._sessions.items() if sess["next_poll"] <= now),
+                default=None,
+            )
+            if due is None:
+                next_at = min(
+                    [sess["next_poll"] for sess in self._sessions.values()]
+                    + [sess["deadline"] for sess in self._sessions.values()],
+                    default=now,
+                )
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_at - now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key = due[1]
+            # 请求在途期间不会被再次调度
+            self._sessions[key]["next_poll"] = float("inf")
+            task = asyncio.create_task(self._poll(key))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            await asyncio.sleep(spacing)
+
+    async def _poll(self, key: str):
+        sess = self._sessions.get(key)
+        if sess is None:
+            return
+        METRICS.attach_command(sess["command"])
+        try:
+            status_code, cookies = await self.bili.poll_qrcode_once(key, sess["session"])
+        except Exception as e:
+            sess["errors"] += 1
+            if sess["errors"] >= self.MAX_ERRORS:
+                logger.error(f"check_qrcode_status 异常：{e}", exc_info=True)
+                self._finish(key, None)
+            else:
+                logger.debug(f"二维码轮询请求异常，稍后重试：{e}")
+                sess["next_poll"] = time.monotonic() + self.IDLE_INTERVAL
+            return
+
+        sess["errors"] = 0
+        if status_code == 0:
+            self._finish(key, cookies)
+            return
+        if status_code == 86038:
+            logger.warning("B站二维码已过期")
+            self._finish(key, None)
+            return
+        # 86090: 已扫描等待确认，加快轮询；其余（86101 等待扫码等）保持慢速
+        interval = self.SCANNED_INTERVAL if status_code == 86090 else self.IDLE_INTERVAL
+        sess["next_poll"] = time.monotonic() + interval
+        self._wakeup.set()
+
+    def _finish(self, key: str, result: Optional[Dict]):
+        sess = self._sessions.pop(key, None)
+        if sess and not sess["future"].done():
+            sess["future"].set_result(result)
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        for task in list(self._inflight):
+            task.cancel()
+        for key in list(self._sessions):
+            self._finish(key, None)
+
+# =========================
+# QrKeyPool: 预生成的二维码，login/logout 直接取用
+# =========================
+class QrKeyPool:
+    """
+    预先生成好的 (qrcode_key, 二维码图片)，扫码命令取用后用户几乎立即看到二维码。
+    - 容量有上限，每次被取走后在后台补满
+    - 条目在 MAX_AGE 秒后丢弃，保证用户拿到的二维码仍有完整的扫码时间
+    - 丢弃的条目只在近期有人扫码时才补充，长期空闲的部署不会持续请求B站
+    """
+    # 条目最长保留时间（秒）：B站二维码 180 秒过期，留给用户的 2 分钟扫码时间之外再留些余量
+    MAX_AGE = 45.0
+    # 最近一次取用后多长时间内仍视为有扫码需求（秒），之后过期的条目不再补充
+    DEMAND_WINDOW = 600.0
+    # 补充失败后的重试间隔（秒）
+    RETRY_DELAY = 30.0
+
+    def __init__(self, bili: "BiliClient", size: int = 0):
+        self.bili = bili
+        self.size = max(0, int(size))
+        # (生成时间, qrcode_key, PNG 字节)，按生成时间从旧到新
+        self._entries: deque = deque()
+        # 已发出的 key → 生成时间，用于 put_back 判断是否还能放回
+        self._issued: Dict[str, float] = {}
+        self._last_demand = float("-inf")
+        self._priming = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> int:
+        return len(self._entries)
+
+    def prime(self):
+        """启动时填满一次；之后没有人扫码，这些条目过期后不再补充"""
+        if self.size:
+            self._priming = True
+            self._ensure_refill()
+
+    async def take(self) -> Tuple[Optional[str], Optional[BytesIO]]:
+        """取一个二维码，池中没有时现场生成；失败返回 (None, None)"""
+        now = time.monotonic()
+        self._last_demand = now
+        self._evict(now)
+        if self._entries:
+            created, key, data = self._entries.popleft()
+            METRICS.inc("bilitool_qr_pool_total", (("result", "hit"),))
+        else:
+            if self.size:
+                METRICS.inc("bilitool_qr_pool_total", (("result", "miss"),))
+            key, stream = await self.bili.generate_qrcode()
+            if not key or not stream:
+                return None, None
+            created, data = time.monotonic(), stream.getvalue()
+        self._issued[key] = created
+        self._ensure_refill()
+        return key, BytesIO(data)
+
+    def put_back(self, key: str, stream: BytesIO):
+        """取走后没有展示给用户的二维码（如账号已满）放回池中，避免白白浪费"""
+        created = self._issued.pop(key, None)
+        if created is None or len(self._entries) >= self.size or time.monotonic() - created >= self.MAX_AGE:
+            return
+        self._entries = deque(sorted([*self._entries, (created, key, stream.getvalue())]))
+
+    def _evict(self, now: float):
+        while self._entries and now - self._entries[0][0] >= self.MAX_AGE:
+            self._entries.popleft()
+        for key, created in list(self._issued.items()):
+            if now - created >= self.MAX_AGE:
+                del self._issued[key]
+
+    def _ensure_refill(self):
+        if self.size and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        # 补充请求属于后台任务，不计入触发它的命令
+        METRICS.attach_command(None)
+        while True:
+            now = time.monotonic()
+            self._evict(now)
+            wanted = self._priming or now - self._last_demand < self.DEMAND_WINDOW
+            if wanted and len(self._entries) < self.size:
+                key, stream = await self.bili.generate_qrcode()
+                if key and stream:
+                    # 生成期间可能有条目被放回，仍不超过容量
+                    if len(self._entries) < self.size:
+                        self._entries.append((time.monotonic(), key, stream.getvalue()))
+                else:
+                    # 风控冷却或接口异常，稍后再试，不连续请求
+                    await asyncio.sleep(max(self.RETRY_DELAY, self.bili.hold_left()))
+                continue
+            self._priming = False
+            if not self._entries:
+                return
+            # 等到最旧的条目过期再决定是否补充
+            await asyncio.sleep(max(0.0, self._entries[0][0] + self.MAX_AGE - now))
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._entries.clear()
+
+# =========================
+# QrImageSpool: 二维码图片文件的存放与延迟清理
+# =========================
+class QrImageSpool:
+    """
+    发送给适配器的二维码图片文件统一放在一个目录（可放到 /dev/shm 等内存盘）：
+    - 文件名取内容哈希，同一张图片只写一次，重复发送直接复用
+    - 写入和删除都在线程中进行，不阻塞事件循环
+    - 文件最后一次使用 GRACE 秒后才删除，适配器延迟上传时文件仍在
+    同名文件的写入和删除串行执行，不会删掉刚写好的文件。
+    """
+    # 文件最后一次使用后保留的时间（秒）
+    GRACE = 300.0
+    # 清理间隔（秒）
+    REAP_INTERVAL = 60.0
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        # 文件名 → 最后一次使用时间（time.time()）
+        self._used: Dict[str, float] = {}
+        # 文件名 → 进行中的写入或删除
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    @property
+    def files(self) -> int:
+        return len(self._used)
+
+    async def put(self, data: bytes) -> str:
+        """保存图片并返回文件路径，相同内容返回同一个文件"""
+        name = hashlib.sha256(data).hexdigest()[:32] + ".png"
+        # 等待同名文件进行中的写入/删除；任务在结束前已从 _pending 移除，不会空转
+        while (pending := self._pending.get(name)) is not None:
+            await asyncio.shield(pending)
+        if name not in self._used:
+            task = self._pending[name] = asyncio.create_task(self._write_file(name, data))
+            await asyncio.shield(task)
+        self._used[name] = time.time()
+        self.start()
+        return os.path.join(self.root, name)
+
+    def start(self):
+        """启动后台清理；启动时调用一次可顺便清掉上次运行遗留的文件"""
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def _write_file(self, name: str, data: bytes):
+        try:
+            await asyncio.to_thread(self._write, os.path.join(self.root, name), data)
+            self._used[name] = time.time()
+        finally:
+            self._pending.pop(name, None)
+
+    async def _remove_file(self, name: str):
+        try:
+            await asyncio.to_thread(self._remove, os.path.join(self.root, name))
+        finally:
+            self._pending.pop(name, None)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # 先写临时文件再改名，适配器不会读到写了一半的图片；二维码可直接登录账号，只允许当前用户读取
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _scan_stale(self, known: frozenset, cutoff: float) -> List[str]:
+        """目录中不在记录里且早已过期的文件（上次运行遗留、或写入中途失败的临时文件）"""
+        stale = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                try:
+                    if entry.name not in known and entry.is_file() and entry.stat().st_mtime < cutoff:
+                        stale.append(entry.name)
+                except OSError:
+                    continue
+        return stale
+
+    async def reap(self) -> int:
+        """删除超过保留时间的文件，返回本次删除的数量"""
+        cutoff = time.time() - self.GRACE
+        expired = [name for name, used in self._used.items() if used < cutoff and name not in self._pending]
+        for name in expired:
+            del self._used[name]
+        try:
+            stale = await asyncio.to_thread(self._scan_stale, frozenset(self._used), cutoff)
+        except OSError as e:
+            logger.warning(f"扫描二维码图片目录失败：{e}")
+            stale = []
+        removed = 0
+        for name in dict.fromkeys(expired + stale):
+            # 扫描期间又被使用的文件跳过
+            if name in self._used or name in self._pending:
+                continue
+            self._pending[name] = asyncio.create_task(self._remove_file(name))
+            removed += 1
+        return removed
+
+    async def _reap_loop(self):
+        METRICS.attach_command(None)
+        while True:
+            await asyncio.sleep(self.REAP_INTERVAL)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"清理二维码图片异常：{e}", exc_info=True)
+            if not self._used:
+                # 没有需要清理的文件了，下次 put 时再启动
+                return
+
+    async def close(self):
+        # 剩余文件可能还在被适配器上传，留给下次启动时按修改时间清理
+        if self._reaper and not self._reaper.done():
+            self._reaper.cancel()
+
+# =========================
+# QinglongClient: 与青龙面板交互（异步 httpx）
+# =========================
+class QinglongError(Exception):
+    """青龙面板返回了非预期结果"""
+
+
+class QinglongAuthError(QinglongError):
+    """获取青龙面板令牌失败"""
+
+
+class QinglongClient:
+    # 令牌剩余有效期低于该值（秒）时，在后台提前刷新
+    TOKEN_REFRESH_MARGIN = 3600
+    # 面板未返回 expiration 时使用的兜底有效期（秒）
+    TOKEN_DEFAULT_TTL = 24 * 3600
+
+    # 连接池：面板只有一个主机，少量长连接足够覆盖并发命令
+    POOL_LIMITS = httpx.Limits(
+        max_connections=8,
+        max_keepalive_connections=4,
+        # 青龙（Node.js）默认 5 秒关闭空闲连接，本地必须更早淘汰，
+        # 否则会复用已被对端关闭的连接并报 "Server disconnected"，
+        # 这就是之前"复用客户端会导致神秘崩溃"的原因
+        keepalive_expiry=4.0,
+    )
+    TIMEOUT = httpx.Timeout(15.0, connect=3.0)
+    # 每个请求失败后最多重试的次数
+    RETRIES = 1
+    # 支持分页的面板每页读取的变量数；不支持的面板忽略分页参数，一次返回全部匹配项
+    ENV_PAGE_SIZE = 100
+    # 分页读取的页数上限，防止面板返回的 total 异常时无限翻页
+    ENV_MAX_PAGES = 50
+
+    def __init__(self, panel_url: str, client_id: str, client_secret: str, env_cache_ttl: float = 5.0, http2: bool = False,
+                 shared: bool = False, lease_wait: float = 15.0):
+        self.ql_panel_url = panel_url.rstrip("/") if panel_url else ""
+        self._host = urlsplit(self.ql_panel_url).netloc or self.ql_panel_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+        # HTTP/2 需要额外安装 h2，未安装时回退到 HTTP/1.1
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("未安装 h2，青龙面板连接回退到 HTTP/1.1（pip install httpx[http2]）")
+            http2 = False
+        # 所有面板请求共用这一个客户端，保持连接复用
+        self.client = httpx.AsyncClient(
+            timeout=self.TIMEOUT, limits=self.POOL_LIMITS, http2=http2, verify=True if http2 else shared_ssl_context()
+        )
+
+        # 令牌缓存：所有调用方共享同一个令牌，同一时刻最多只有一个获取请求在途
+        self._token: Optional[str] = None
+        self._token_expire_at: float = 0.0
+        self._token_task: Optional[asyncio.Task] = None
+
+        # 环境变量快照：短时间内的读取共享同一份数据，同一时刻最多一个拉取请求在途
+        self.env_cache_ttl = max(0.0, float(env_cache_ttl))
+        self._env_snapshot: Optional[List[Dict]] = None
+        self._env_snapshot_at: float = 0.0
+        self._env_task: Optional[asyncio.Task] = None
+        # 写入开始和结束时各加一；拉取期间发生过写入（或仍在写入）时，拉到的可能是写了一半的状态，不写入快照
+        self._env_generation = 0
+        self._env_writing = False
+        # 按变量名读取的映射变量值：变量名 → (读取时间, 值)，值为 None 表示面板上没有
+        self._values: Dict[str, Tuple[float, Optional[str]]] = {}
+        self._value_tasks: Dict[str, asyncio.Task] = {}
+
+        # Cookie 变量的所有写操作都交给唯一的写入者排队执行，开启多实例共用时每批写入持有跨实例租约
+        self.lease = MutationLease(self, shared=shared, max_wait=lease_wait)
+        self.writer = CookieEnvWriter(self)
+        # 快照更新（读取或写入后）时的回调 (面板地址, 快照或 None)，用于同步本地账号登记
+        self.on_snapshot: Optional[Callable[[str, Optional[List[Dict]]], None]] = None
+        # 新账号登录后触发 BiliTool 任务，由插件按配置创建
+        self.task_trigger: Optional["TaskTrigger"] = None
+        # BiliTool 运行日志的缓存，status 命令使用
+        self.task_logs: Optional["TaskLogIndex"] = None
+
+    async def get_token(self, force_refresh: bool = False) -> Optional[str]:
+        """
+        返回缓存的访问令牌，缓存为空或已过期时才请求面板。
+        令牌临近过期时立即返回旧令牌，同时在后台刷新；并发调用共享同一个在途请求。
+        """
+        if not all([self.ql_panel_url, self.client_id, self.client_secret]):
+            logger.error("青龙面板配置不完整：地址/Client ID/Client Secret 缺失")
+            return None
+
+        now = time.time()
+        if not force_refresh and self._token and now < self._token_expire_at:
+            if now >= self._token_expire_at - self.TOKEN_REFRESH_MARGIN:
+                self._start_token_fetch()
+            return self._token
+        # shield：某个调用方被取消时不影响其他共享该请求的调用方
+        return await asyncio.shield(self._start_token_fetch())
+
+    def invalidate_token(self, stale_token: Optional[str] = None):
+        """
+        作废缓存的令牌。传入 stale_token 时仅当缓存仍是该令牌才作废，
+        这样多个请求同时收到 401 时只会触发一次重新认证。
+        """
+        if stale_token is None or self._token == stale_token:
+            self._token = None
+            self._token_expire_at = 0.0
+
+    def _start_token_fetch(self) -> asyncio.Task:
+        if self._token_task is None or self._token_task.done():
+            self._token_task = asyncio.create_task(self._fetch_token())
+        return self._token_task
+
+    async def _fetch_token(self) -> Optional[str]:
+        # 这里没有体面的方法了，只能拼接URL参数
+        url = f"{self.ql_panel_url}/open/auth/token?client_id={self.client_id}&client_secret={self.client_secret}"
+        try:
+            resp = await self._send("GET", url)
+            resp.raise_for_status()
+            data = resp.json()
+            token_data = data.get("data") or {}
+            if data.get("code") == 200 and token_data.get("token"):
+                self._token = token_data["token"]
+                self._token_expire_at = self._parse_expiration(token_data.get("expiration"))
+                logger.info("青龙面板访问令牌获取成功")
+                return self._token
+            logger.error(f"获取青龙令牌失败：{data}")
+            return None
+        except CircuitOpenError as e:
+            logger.debug(f"获取青龙令牌跳过：{e}")
+            return None
+        except Exception as e:
+            # 提前刷新失败时保留旧令牌，等它真正过期再说
+            logger.error(f"获取青龙令牌异常：{e}", exc_info=True)
+            return None
+
+    def _parse_expiration(self, expiration) -> float:
+        """青龙返回的 expiration 为秒级时间戳，个别版本为毫秒，缺失时使用兜底有效期"""
+        now = time.time()
+        try:
+            exp = float(expiration)
+            if exp > 1e12:
+                exp /= 1000
+            if exp > now:
+                return exp
+        except (TypeError, ValueError):
+            pass
+        return now + self.TOKEN_DEFAULT_TTL
+
+    async def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        面板请求的唯一出口。临时错误按类型重试（连接池里的连接恰好被面板关闭等），
+        面板连续失败后熔断，之后的请求立即失败，不再逐个等待超时。
+        """
+        # 路径中的数字 id（如 /open/crons/12/log）合并为同一个端点统计
+        endpoint = re.sub(r"/\d+(?=/|$)", "/{id}", url[len(self.ql_panel_url):].split("?", 1)[0])
+        start = time.perf_counter()
+        status = None
+        try:
+            resp = await resilient_request(self.client, method, url, self._host, retries=self.RETRIES, **kwargs)
+            status = resp.status_code
+            return resp
+        finally:
+            METRICS.record_http("qinglong", method, endpoint, status, time.perf_counter() - start)
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """
+        带鉴权的面板请求，自动使用缓存令牌。
+        返回 401 时只重新认证一次并重试，仍失败则把响应交给调用方处理。
+        """
+        token = await self.get_token()
+        if not token:
+            raise QinglongAuthError("获取青龙面板令牌失败")
+        headers = dict(kwargs.pop("headers", None) or {})
+        url = f"{self.ql_panel_url}{path}"
+        for attempt in range(2):
+            headers["Authorization"] = f"Bearer {token}"
+            resp = await self._send(method, url, headers=headers, **kwargs)
+            if resp.status_code != 401 or attempt:
+                return resp
+            logger.warning("青龙令牌已失效，重新获取后重试")
+            self.invalidate_token(token)
+            token = await self.get_token()
+            if not token:
+                raise QinglongAuthError("重新获取青龙面板令牌失败")
+        return resp
+
+    async def get_all_envs(self, token: Optional[str] = None) -> List[Dict]:
+        """
+        返回本插件的 Cookie 变量（来自快照缓存）。
+        token 参数仅为兼容旧调用保留，实际使用缓存的令牌。
+        """
+        return list(await self.get_env_snapshot())
+
+    async def get_env_snapshot(self, force_refresh: bool = False, strict: bool = False) -> List[Dict]:
+        """
+        读取 Cookie 变量快照（只含 Ray_BiliBiliCookies__ 开头的变量，面板上其它变量不拉取），
+        在 env_cache_ttl 秒内直接返回缓存；
+        并发读取合并为一次面板请求。拉取失败时不写入缓存，
+        strict=True 抛出异常，否则返回空列表。
+        """
+        if (
+            not force_refresh
+            and self._env_snapshot is not None
+            and time.monotonic() - self._env_snapshot_at < self.env_cache_ttl
+        ):
+            return self._env_snapshot
+        if force_refresh or self._env_task is None or self._env_task.done():
+            self._env_task = asyncio.create_task(self._refresh_snapshot())
+        try:
+            return await asyncio.shield(self._env_task)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if strict:
+                raise
+            return []
+
+    def invalidate_envs(self):
+        """作废快照；在途的拉取可能早于本次变更，同样不再复用"""
+        self._env_snapshot = None
+        self._env_task = None
+        self._publish()
+
+    def _publish(self):
+        if self.on_snapshot is None:
+            return
+        try:
+            self.on_snapshot(self.ql_panel_url, self._env_snapshot)
+        except Exception as e:
+            logger.error(f"同步本地账号登记异常：{e}", exc_info=True)
+
+    def _patch_env(self, env: Dict):
+        """按 id 更新快照中的单条变量，找不到时直接作废快照"""
+        if self._env_snapshot is None:
+            return
+        for i, cur in enumerate(self._env_snapshot):
+            if cur.get("id") == env.get("id"):
+                # 快照可能正被其他协程遍历，替换为新列表而不是原地修改
+                snapshot = list(self._env_snapshot)
+                snapshot[i] = {**cur, **env}
+                self._env_snapshot = snapshot
+                return
+        self.invalidate_envs()
+
+    def _append_envs(self, envs) -> None:
+        """把 POST 返回的新变量追加进快照，返回内容不可用时作废快照"""
+        if self._env_snapshot is None:
+            return
+        if isinstance(envs, list) and envs and all(isinstance(e, dict) and "id" in e for e in envs):
+            self._env_snapshot = self._env_snapshot + envs
+        else:
+            self.invalidate_envs()
+
+    def _drop_envs(self, ids: List):
+        if self._env_snapshot is None:
+            return
+        drop = set(ids)
+        self._env_snapshot = [e for e in self._env_snapshot if e.get("id") not in drop]
+
+    async def get_env_values(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """
+        按变量名读取值（菜单展示映射变量用），每个名字一次 searchValue 查询，并发进行。
+        结果缓存 env_cache_ttl 秒，并发读取同一名字合并为一次请求；
+        面板上没有的变量值为 None，读取失败的名字不出现在结果中。
+        """
+        results = await asyncio.gather(*[self._env_value(name) for name in names], return_exceptions=True)
+        values = {}
+        for name, result in zip(names, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                if not isinstance(result, CircuitOpenError):
+                    logger.warning(f"读取青龙环境变量 {name} 失败：{result}")
+                continue
+            values[name] = result
+        return values
+
+    async def _env_value(self, name: str) -> Optional[str]:
+        cached = self._values.get(name)
+        if cached and time.monotonic() - cached[0] < self.env_cache_ttl:
+            return cached[1]
+        task = self._value_tasks.get(name)
+        if task is None or task.done():
+            task = self._value_tasks[name] = asyncio.create_task(self._fetch_value(name))
+        return await asyncio.shield(task)
+
+    async def _fetch_value(self, name: str) -> Optional[str]:
+        env = next(iter(await self._fetch_envs(name, exact=True)), None)
+        value = None if env is None else env.get("value")
+        self._values[name] = (time.monotonic(), value)
+        return value
+
+    def begin_write(self):
+        self._env_generation += 1
+        self._env_writing = True
+
+    def end_write(self):
+        self._env_generation += 1
+        self._env_writing = False
+
+    async def _refresh_snapshot(self) -> List[Dict]:
+        task = asyncio.current_task()
+        generation = self._env_generation
+        try:
+            envs = await self._fetch_envs(CHECK_PREFIX)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error(f"获取青龙环境变量异常：{e}", exc_info=True)
+            raise
+        # 拉取期间快照被作废或有写入时，结果只返回给已在等待的调用方
+        if self._env_task is task and self._env_generation == generation and not self._env_writing:
+            self._env_snapshot = envs
+            self._env_snapshot_at = time.monotonic()
+            self._publish()
+        return envs
+
+    async def _fetch_envs(self, search: str, exact: bool = False) -> List[Dict]:
+        """
+        用 searchValue 让面板只返回相关变量，支持分页的面板逐页读取。
+        searchValue 是模糊匹配（名称/值/备注包含即可），老版本面板还会忽略它，
+        所以结果再按名称过滤：exact=True 要求名称相等，否则要求以 search 开头。
+        同名变量全部保留（整理 Cookie 变量时需要看到重名），按面板返回的顺序排列。
+        """
+        envs: List[Dict] = []
+        seen = 0
+        for page in range(1, self.ENV_MAX_PAGES + 1):
+            resp = await self._request(
+                "GET", "/open/envs", params={"searchValue": search, "page": page, "size": self.ENV_PAGE_SIZE}
+            )
+            resp.raise_for_status()
+            items, total = self._parse_envs(resp.content)
+            seen += len(items)
+            for env in items:
+                name = env_name(env)
+                if name == search if exact else name.startswith(search):
+                    envs.append(env)
+            # 未分页的响应（列表）或已读完全部页时结束
+            if total is None or not items or seen >= total:
+                return envs
+        logger.warning(f"青龙环境变量分页超过 {self.ENV_MAX_PAGES} 页，后续未读取")
+        return envs
+
+    @staticmethod
+    def _parse_envs(content: bytes) -> Tuple[List[Dict], Optional[int]]:
+        """
+        直接从响应字节解析，返回 (变量列表, 总数)；总数为 None 表示面板没有分页。
+        兼容 [..]、{"data": [..]}、{"data": {"items"/"data": [..], "total": n}} 几种格式。
+        """
+        data = json.loads(content)
+        if isinstance(data, list):
+            return data, None
+        if not isinstance(data, dict) or data.get("code") != 200:
+            raise QinglongError(f"查询青龙环境变量失败：{data}")
+        d = data.get("data", {})
+        if isinstance(d, list):
+            return d, None
+        if isinstance(d, dict):
+            items = d.get("items", d.get("data")) or []
+            total = d.get("total")
+            return items, total if isinstance(total, int) else None
+        return [], None
+
+    async def save_cookie_to_qinglong(self, cookies: Dict, uid: int) -> Tuple[bool, str]:
+        """新增或更新账号 Cookie，实际写入由 CookieEnvWriter 合并执行"""
+        cookie_str = "; ".join([f"{k}={v}" for k, v in cookies.items()])
+        user_id = str(cookies.get("DedeUserID", uid))
+        return await self.writer.submit({"op": "upsert", "uid": user_id, "value": cookie_str})
+
+    async def delete_bili_cookie(self, token: Optional[str], uid: int) -> Tuple[bool, str]:
+        """
+        删除指定UID的B站Cookie，保持变量名连续（空位由末尾变量填补）。
+        token 参数仅为兼容旧调用保留，实际使用缓存的令牌。
+        """
+        return await self.writer.submit({"op": "remove", "uid": str(uid)})
+
+    async def reconcile(self, dry_run: bool = False) -> Tuple[bool, str]:
+        """
+        整理 Cookie 变量：补齐缺号、去掉重名和同一 UID 的重复变量，返回 (成功, 操作列表)。
+        dry_run=True 只读取面板并返回将要执行的操作，不写入。
+        """
+        if not dry_run:
+            return await self.writer.submit({"op": "reconcile"})
+        envs = await self.get_env_snapshot(force_refresh=True, strict=True)
+        bili_envs = sorted(envs, key=env_slot)
+        plan, _ = plan_cookie_mutations(bili_envs, [])
+        return True, "\n".join(describe_plan(plan, bili_envs)) or "无需整理"
+
+    async def list_crons(self, keyword: str) -> List[Dict]:
+        """
+        查找名称或命令包含 keyword 的定时任务。
+        新版面板返回 {data: [...], total}，老版本直接返回列表，两种都兼容。
+        """
+        resp = await self._request("GET", "/open/crons", params={"searchValue": keyword})
+        resp.raise_for_status()
+        result = resp.json()
+        if result.get("code") != 200:
+            raise QinglongError(f"读取定时任务失败：{result.get('message')}")
+        data = result.get("data")
+        crons = (data.get("data") or []) if isinstance(data, dict) else (data or [])
+        return [
+            c for c in crons
+            if isinstance(c, dict) and (keyword in str(c.get("command", "")) or keyword in str(c.get("name", "")))
+        ]
+
+    async def run_crons(self, ids: List) -> None:
+        await self._write_checked("PUT", ids, "运行定时任务", path="/open/crons/run")
+
+    async def get_cron_log(self, cron_id) -> str:
+        """定时任务最近一次运行的完整日志（运行中时为目前已输出的部分）"""
+        resp = await self._request("GET", f"/open/crons/{cron_id}/log")
+        resp.raise_for_status()
+        result = resp.json()
+        if result.get("code") != 200:
+            raise QinglongError(f"读取任务日志失败：{result.get('message')}")
+        data = result.get("data")
+        return data if isinstance(data, str) else ""
+
+    async def _write_checked(self, method: str, json_body, action: str, path: str = "/open/envs"):
+        resp = await self._request(method, path, json=json_body)
+        resp.raise_for_status()
+        result = resp.json()
+        if result.get("code") != 200:
+            raise QinglongError(f"{action}失败：{result.get('message')}")
+        return result
+
+    async def close(self):
+        await self.writer.close()
+        for helper in (self.task_trigger, self.task_logs):
+            if helper is not None:
+                helper.close()
+        for task in (self._token_task, self._env_task, *self._value_tasks.values()):
+            if task and not task.done():
+                task.cancel()
+        await self.client.aclose()
+
+# =========================
+# Cookie 变量写入：单写入者 + 批量合并
+# =========================
+def slot_name(index: int) -> str:
+    return f"{CHECK_PREFIX}{index}"
+
+def canonical_slot(env: Dict) -> Optional[int]:
+    """变量名是规范的 Ray_BiliBiliCookies__N（N 为不带前导零的非负整数）时返回 N，否则返回 None"""
+    suffix = env_name(env)[len(CHECK_PREFIX):]
+    if suffix.isdigit() and str(int(suffix)) == suffix:
+        return int(suffix)
+    return None
+
+def plan_cookie_mutations(bili_envs: List[Dict], ops: List[Dict]) -> Tuple[Dict, List[Tuple[bool, str]]]:
+    """
+    根据当前 Cookie 变量（按序号排好）和一批写操作，计算最少的面板写请求，
+    执行后变量名恰好是 __0..__{n-1}，每个 UID 只有一个变量。
+    返回 (plan, results)：
+      plan = {"put": [env...], "post": [env...], "delete": [id...]}
+      results 与 ops 一一对应，是每个操作的 (成功, 消息)
+    ops 为空时就是单纯的整理：修复缺号、重名、同一 UID 的重复变量。
+    - 已在 [0, n) 内且名字不冲突的变量原地保留，值有变化才 PUT
+    - 需要换位置的变量优先直接改名进缺号（一次 PUT）；
+      目标名字被待删除的变量占着时，覆盖那个变量再删除自己，不会出现两个同名变量
+    - 新增账号优先覆盖待删除的变量，其次 POST 到缺号，名字不会与现有变量冲突
+    每删除一个账号最多产生两个请求，与面板上的账号总数无关。
+    没有 bili- 备注的变量不属于任何 UID，名字规范时照常占位，不规范时不做处理。
+    """
+    by_uid: Dict[str, List[Dict]] = {}
+    anonymous: List[Dict] = []
+    for env in bili_envs:
+        uid = env_uid(env)
+        if uid:
+            by_uid.setdefault(uid, []).append(env)
+        elif canonical_slot(env) is not None:
+            anonymous.append(env)
+
+    # 按到达顺序模拟每个操作，得到每个 UID 的最终值（None 表示删除）
+    state: Dict[str, Optional[str]] = {uid: envs[0].get("value") for uid, envs in by_uid.items()}
+    new_uids: List[str] = []
+    results: List[Tuple[bool, str]] = []
+    for op in ops:
+        uid = op.get("uid")
+        if op["op"] == "upsert":
+            existed = state.get(uid) is not None
+            state[uid] = op["value"]
+            if uid not in by_uid and uid not in new_uids:
+                new_uids.append(uid)
+            results.append((True, f"更新Cookie成功！UID：{uid}" if existed else f"新增Cookie成功！UID：{uid}"))
+        elif op["op"] == "remove":
+            if state.get(uid) is None:
+                results.append((False, f"未找到UID {uid} 的Cookie"))
+            else:
+                state[uid] = None
+                results.append((True, f"删除成功（UID：{uid}）"))
+        else:
+            # reconcile：不改变任何账号，只借这一批整理变量名
+            results.append((True, "整理完成"))
+
+    alive = [uid for uid in by_uid if state.get(uid) is not None]
+    adds = [uid for uid in new_uids if state.get(uid) is not None]
+    final_count = len(anonymous) + len(alive) + len(adds)
+
+    # 按序号顺序选出原地保留的变量：每个 UID 一个、名字在范围内且没被前面的变量占用
+    claimed: Dict[str, Dict] = {}
+    keeper: Dict[int, Optional[str]] = {}
+    kept_uids = set()
+    for env in bili_envs:
+        uid = env_uid(env)
+        slot = canonical_slot(env)
+        if slot is None or slot >= final_count or env_name(env) in claimed:
+            continue
+        if uid and state.get(uid) is not None and uid not in kept_uids:
+            keeper[id(env)] = uid
+            kept_uids.add(uid)
+        elif not uid:
+            keeper[id(env)] = None
+        else:
+            continue
+        claimed[env_name(env)] = env
+
+    # 没能原地保留的账号需要换位置：(变量, 新值, 新备注)
+    movers: List[Tuple[Dict, str, str]] = []
+    for uid in alive:
+        if uid not in kept_uids:
+            movers.append((by_uid[uid][0], state[uid], f"bili-{uid}"))
+    for env in anonymous:
+        if id(env) not in keeper:
+            movers.append((env, env.get("value"), env.get("remarks") or ""))
+    moving = {id(env) for env, _, _ in movers}
+    # 其余变量（已删除账号、同一 UID 的多余变量）都可以回收
+    free = [env for env in bili_envs if id(env) not in keeper and id(env) not in moving
+            and (env_uid(env) or canonical_slot(env) is not None)]
+
+    open_names = [slot_name(i) for i in range(final_count) if slot_name(i) not in claimed]
+    holders: Dict[str, Dict] = {}
+    for env in free:
+        if env_name(env) in open_names and env_name(env) not in holders:
+            holders[env_name(env)] = env
+    held = [name for name in open_names if name in holders]
+    gaps = [name for name in open_names if name not in holders]
+    spare = [env for env in free if env_name(env) not in holders or holders[env_name(env)] is not env]
+
+    put: List[Dict] = []
+    post: List[Dict] = []
+    delete: List = []
+    for env in bili_envs:
+        uid = keeper.get(id(env))
+        if uid and (state[uid] != env.get("value") or env.get("remarks") != f"bili-{uid}"):
+            put.append({"id": env["id"], "name": env_name(env), "value": state[uid], "remarks": f"bili-{uid}"})
+
+    # 一次 PUT 就能完成的先配对：换位置的改名进缺号，新增的覆盖待删除变量
+    while movers and gaps:
+        env, value, remarks = movers.pop(0)
+        put.append({"id": env["id"], "name": gaps.pop(0), "value": value, "remarks": remarks})
+    while adds and held:
+        uid = adds.pop(0)
+        env = holders[held.pop(0)]
+        put.append({"id": env["id"], "name": env_name(env), "value": state[uid], "remarks": f"bili-{uid}"})
+    # 剩下的新增账号放进缺号：回收多余变量改名，没有可回收的再 POST
+    for uid in adds:
+        name = gaps.pop(0)
+        if spare:
+            put.append({"id": spare.pop(0)["id"], "name": name, "value": state[uid], "remarks": f"bili-{uid}"})
+        else:
+            post.append({"name": name, "value": state[uid], "remarks": f"bili-{uid}"})
+    # 剩下换位置的账号只能覆盖占着目标名字的变量，再删除自己
+    for env, value, remarks in movers:
+        holder = holders[held.pop(0)]
+        put.append({"id": holder["id"], "name": env_name(holder), "value": value, "remarks": remarks})
+        delete.append(env["id"])
+    delete += [env["id"] for env in spare]
+    return {"put": put, "post": post, "delete": delete}, results
+
+def describe_plan(plan: Dict, bili_envs: List[Dict], limit: int = 10) -> List[str]:
+    """把整理计划转成可读的操作列表，用于预览"""
+    by_id = {env.get("id"): env for env in bili_envs}
+    lines = []
+    for env in plan["put"]:
+        old = by_id.get(env["id"], {})
+        old_remarks = old.get("remarks") or "无备注"
+        if env_name(old) != env["name"]:
+            lines.append(f"改名 {env_name(old)} → {env['name']}（{env['remarks'] or '无备注'}）")
+        elif old_remarks != (env["remarks"] or "无备注"):
+            lines.append(f"覆盖 {env['name']}（{old_remarks} → {env['remarks'] or '无备注'}）")
+        else:
+            lines.append(f"更新 {env['name']}（{old_remarks}）")
+    lines += [f"新增 {env['name']}（{env['remarks']}）" for env in plan["post"]]
+    for env_id in plan["delete"]:
+        old = by_id.get(env_id, {})
+        lines.append(f"删除 {env_name(old)}（{old.get('remarks') or '无备注'}）")
+    if len(lines) > limit:
+        lines = lines[:limit] + [f"……其余 {len(lines) - limit} 项"]
+    return lines
+
+
+class CookieEnvWriter:
+    """
+    Ray_BiliBiliCookies__N 变量的唯一写入者。
+    所有新增/更新/删除请求进入队列，batch_window 秒内到达的请求合并为
+    一次快照读取和最少的 PUT/POST/DELETE，每个调用方拿到自己操作的结果。
+    同一进程内不会再出现两个请求各自读改写、抢同一个槽位名的情况；
+    多个进程或主机共用面板时，每批写入还要先拿到 MutationLease。
+    """
+
+    def __init__(self, ql: "QinglongClient", batch_window: float = 0.2):
+        self.ql = ql
+        self.batch_window = batch_window
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, op: Dict) -> Tuple[bool, str]:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, fut))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await fut
+
+    async def _run(self):
+        # 合并写入服务于多个命令，不归属任何一个
+        METRICS.attach_command(None)
+        batch: List[Tuple[Dict, asyncio.Future]] = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                # 等一个短窗口，把同一波登录/登出合并到一起
+                await asyncio.sleep(self.batch_window)
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                try:
+                    async with self.ql.lease.hold():
+                        results = await self._apply([op for op, _ in batch])
+                except QinglongError as e:
+                    results = [(False, str(e))] * len(batch)
+                except httpx.ConnectError:
+                    results = [(False, "无法连接到青龙面板")] * len(batch)
+                except httpx.TimeoutException:
+                    results = [(False, "青龙面板请求超时")] * len(batch)
+                except Exception as e:
+                    logger.error(f"写入青龙Cookie异常：{e}", exc_info=True)
+                    results = [(False, f"写入Cookie异常：{e}")] * len(batch)
+                for (_, fut), result in zip(batch, results):
+                    if not fut.done():
+                        fut.set_result(result)
+                batch = []
+        except asyncio.CancelledError:
+            # 已从队列取出、正在等待窗口或写入中的请求不在队列里，close() 清不到，这里给它们答复
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result((False, "插件正在关闭"))
+            raise
+
+    async def _apply(self, ops: List[Dict]) -> List[Tuple[bool, str]]:
+        # 强制刷新：写入必须基于面板的最新状态，读到的快照顺便给菜单查询复用
+        envs = await self.ql.get_env_snapshot(force_refresh=True, strict=True)
+        bili_envs = sorted([e for e in envs if env_name(e).startswith(CHECK_PREFIX)], key=env_slot)
+        plan, results = plan_cookie_mutations(bili_envs, ops)
+        if any(op["op"] == "reconcile" for op in ops):
+            summary = "\n".join(describe_plan(plan, bili_envs)) or "无需整理"
+            results = [(ok, summary if op["op"] == "reconcile" else msg) for op, (ok, msg) in zip(ops, results)]
+
+        posted = None
+        if plan["put"] or plan["post"] or plan["delete"]:
+            await self.ql.lease.verify()
+        # 写入期间其它协程拉到的快照可能是写了一半的状态，不能覆盖下面按计划修补的快照
+        self.ql.begin_write()
+        try:
+            # 先覆盖（含搬运），再新增，最后删除末尾，任何时刻都不会丢失仍需保留的账号。
+            # PUT 按计划顺序逐个发送：并发发送时一个失败其余可能已生效，面板会停在计划之外的中间状态
+            for env in plan["put"]:
+                await self.ql._write_checked("PUT", env, "更新Cookie")
+            if plan["post"]:
+                posted = await self.ql._write_checked("POST", plan["post"], "新增Cookie")
+            if plan["delete"]:
+                await self.ql._write_checked("DELETE", plan["delete"], "删除Cookie")
+        except (Exception, asyncio.CancelledError):
+            # 中途失败或被取消时面板状态未知，只能整体作废快照
+            self.ql.end_write()
+            self.ql.invalidate_envs()
+            raise
+
+        for env in plan["put"]:
+            self.ql._patch_env(env)
+        if posted is not None:
+            self.ql._append_envs(posted.get("data"))
+        if plan["delete"]:
+            self.ql._drop_envs(plan["delete"])
+        self.ql.end_write()
+        # 写穿：本地账号登记随写入后的快照一起更新
+        self.ql._publish()
+        logger.info(
+            f"青龙Cookie批量写入完成：{len(ops)} 个操作，"
+            f"PUT {len(plan['put'])} / POST {len(plan['post'])} / DELETE {len(plan['delete'])}"
+        )
+        return results
+
+    async def close(self):
+        if self._worker and not self._worker.done():
+            self._worker.cancel()
+            # 等工作协程答复手上的批次后再返回
+            await asyncio.gather(self._worker, return_exceptions=True)
+        while not self._queue.empty():
+            _, fut = self._queue.get_nowait()
+            if not fut.done():
+                fut.set_result((False, "插件正在关闭"))
+
+
+# =========================
+# 多实例写入租约
+# =========================
+class MutationLease:
+    """
+    多个 AstrBot 实例共用一个青龙面板时，Cookie 变量写入前的互斥租约，只在 shared=True 时生效：
+    - 同一主机：系统临时目录下按面板地址命名的文件锁（fcntl，Windows 上没有，跳过），
+      本机实例先在锁上排队，不必都去面板上争抢
+    - 跨主机：面板上的 BILITOOL_LEASE 变量，值为 {owner, expires, fence}，
+      过期的租约可以直接接管，每次获取 fence 加一
+    shared=False（单实例）时 hold() 直接放行，不加锁也不计入租约指标。
+    青龙没有条件写入，获取时写入后等待 SETTLE 秒再读回确认；
+    真正写入 Cookie 前再核对一次 fence，租约已被别的实例接管时放弃本批写入。
+    等待超过 max_wait 秒放弃，不无限排队。
+    """
+    NAME = "BILITOOL_LEASE"
+    REMARKS = "BiliTool 多实例写入租约，请勿手动修改"
+    # 租约有效期（秒），持有者异常退出后其它实例最多等这么久
+    TTL = 30.0
+    SETTLE = 0.3
+    POLL_INTERVAL = (0.2, 1.0)
+
+    def __init__(self, ql: "QinglongClient", shared: bool = False, max_wait: float = 15.0):
+        self.ql = ql
+        self.shared = shared
+        self.max_wait = max_wait
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.fence: Optional[int] = None
+        digest = hashlib.sha1(ql.ql_panel_url.encode("utf-8")).hexdigest()[:12]
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"bilitool-{digest}.lock")
+        self._lock_file = None
+
+    @asynccontextmanager
+    async def hold(self):
+        if not self.shared:
+            yield
+            return
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        contended = await self._acquire_local(deadline)
+        try:
+            contended = await self._acquire_panel(deadline) or contended
+            METRICS.inc("bilitool_lease_total", (("result", "contended" if contended else "acquired"),))
+            METRICS.observe("bilitool_lease_wait_seconds", (), time.monotonic() - start)
+            try:
+                yield
+            finally:
+                await self._release_panel()
+        finally:
+            self._release_local()
+
+    def _timeout(self, who: str):
+        METRICS.inc("bilitool_lease_total", (("result", "timeout"),))
+        raise QinglongError(f"{who}正在写入青龙Cookie，等待 {self.max_wait:g} 秒后仍未结束，请稍后再试")
+
+    async def _acquire_local(self, deadline: float) -> bool:
+        if fcntl is None:
+            return False
+        f = open(self._lock_path, "a+")
+        contended = False
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                contended = True
+                if time.monotonic() >= deadline:
+                    f.close()
+                    self._timeout("本机其它实例")
+                await asyncio.sleep(random.uniform(*self.POLL_INTERVAL))
+        self._lock_file = f
+        return contended
+
+    def _release_local(self):
+        if self._lock_file is not None:
+            # 关闭文件即释放 flock
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _read(self) -> Tuple[Optional[Dict], List]:
+        """返回 (租约, 多余的同名变量 id)；并发创建可能产生多个同名变量，以 id 最小的为准"""
+        envs = sorted(await self.ql._fetch_envs(self.NAME, exact=True), key=lambda e: e.get("id") or 0)
+        if not envs:
+            return None, []
+        try:
+            data = json.loads(envs[0].get("value") or "{}")
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        lease = {
+            "id": envs[0].get("id"),
+            "owner": str(data.get("owner", "")),
+            "expires": float(data.get("expires") or 0),
+            "fence": int(data.get("fence") or 0),
+        }
+        return lease, [e.get("id") for e in envs[1:]]
+
+    async def _write(self, lease: Optional[Dict], expires: float, fence: int):
+        value = json.dumps({"owner": self.owner, "expires": expires, "fence": fence})
+        if lease is None:
+            await self.ql._write_checked("POST", [{"name": self.NAME, "value": value, "remarks": self.REMARKS}], "获取写入租约")
+        else:
+            await self.ql._write_checked(
+                "PUT", {"id": lease["id"], "name": self.NAME, "value": value, "remarks": self.REMARKS}, "更新写入租约"
+            )
+
+    async def _acquire_panel(self, deadline: float) -> bool:
+        contended = False
+        while True:
+            lease, _ = await self._read()
+            if lease and lease["owner"] != self.owner and lease["expires"] > time.time():
+                contended = True
+                if time.monotonic() >= deadline:
+                    self._timeout(f"其它实例（{lease['owner']}）")
+                await asyncio.sleep(random.uniform(*self.POLL_INTERVAL))
+                continue
+            fence = (lease["fence"] if lease else 0) + 1
+            await self._write(lease, time.time() + self.TTL, fence)
+            # 等同一时刻写入的其它实例也落盘，再读回看谁留下了
+            await asyncio.sleep(self.SETTLE)
+            lease, extras = await self._read()
+            if lease and lease["owner"] == self.owner and lease["fence"] == fence:
+                self.fence = fence
+                if extras:
+                    await self.ql._write_checked("DELETE", extras, "清理重复的写入租约")
+                return contended
+            contended = True
+            if time.monotonic() >= deadline:
+                self._timeout("其它实例")
+
+    async def verify(self):
+        """写入 Cookie 前确认租约仍归本实例；被接管（本实例卡顿超过 TTL 等）时抛出异常"""
+        if not self.shared:
+            return
+        lease, _ = await self._read()
+        if not lease or lease["owner"] != self.owner or lease["fence"] != self.fence:
+            METRICS.inc("bilitool_lease_total", (("result", "lost"),))
+            raise QinglongError("写入租约已被其它实例接管，本批写入已放弃，请重试")
+
+    async def _release_panel(self):
+        fence, self.fence = self.fence, None
+        if fence is None:
+            return
+        try:
+            lease, _ = await self._read()
+            if lease and lease["owner"] == self.owner and lease["fence"] == fence:
+                await self._write(lease, 0, fence)
+        except Exception as e:
+            # 释放失败不影响结果，租约到期后自然失效
+            logger.warning(f"释放青龙写入租约失败：{e}")
 
-    async def check_qrcode_status(self, oauth_key: str, timeout_seconds: int = 120) -> Optional[Dict]:
-        """
-        轮询二维码登录状态，使用 asyncio.sleep 避免阻塞。
-        成功时返回合并后的 cookie 字典（包含补全后的 cookie）。
-        """
-        try:
-            elapsed = 0
-            interval = 2
-            while elapsed < timeout_seconds:
-                params = {"qrcode_key": oauth_key}
-                resp = await self.client.get(QRCODE_CHECK_URL, params=params)
-                resp.raise_for_status()
-                data = resp.json()
-                # B 站返回结构复杂：优先检查 data.code 字段
-                if data.get("code") != 0:
-                    # 当 top-level code 非 0 时，通常是接口错误或提示
-                    # 特殊处理：某些 code 代表过期
-                    try:
-                        inner_code = data.get("data", {}).get("code")
-                        if inner_code == 86038:
-                            logger.warning("B站二维码已过期")
-                            return None
-                        # 其他情况继续轮询
-                    except Exception:
-                        logger.debug(f"二维码检查返回非预期数据：{data}")
-                else:
-                    status_code = data.get("data", {}).get("code")
-                    if status_code == 0:
-                        # 登录成功，尝试补全 cookie（请求首页）
-                        cookies = {}
-                        try:
-                            # 合并当前客户端已接收到的 cookies
-                            cookies.update({c.name: c.value for c in self.client.cookies.jar})
-                        except Exception:
-                            # 备用
-                            try:
-                                cookies.update(dict(self.client.cookies))
-                            except Exception:
-                                pass
-                        cookies = await self.complement_cookies(cookies)
-                        logger.info("B站二维码登录成功，已提取并补全 Cookies")
-                        return cookies
-                    elif status_code == 86038:
-                        logger.warning("B站二维码已过期（内部code）")
-                        return None
-                    # 86101: 等待扫码; 86090: 已扫描等待确认
-                await asyncio.sleep(interval)
-                elapsed += interval
-            logger.warning("二维码轮询超时")
-            return None
+
+# =========================
+# 新账号登录后触发 BiliTool 任务
+# =========================
+class TaskTrigger:
+    """
+    新账号登录后立即在面板上运行一次 BiliBiliToolPro 的每日任务，不用等下一次定时运行：
+    - 防抖合并：每次登录把运行推迟到 delay 秒后，一波登录只运行一次；
+      一直有人登录时最多推迟到第一次登录后 MAX_DELAY_FACTOR * delay 秒
+    - 任务正在运行或排队时跳过，不在面板上叠加重复的重任务
+    """
+    MAX_DELAY_FACTOR = 5
+    # 青龙定时任务状态：0 运行中，0.5 排队中，1 空闲，2 已禁用
+    BUSY_STATUS = (0, 0.5)
+
+    def __init__(self, ql: "QinglongClient", keyword: str, delay: float):
+        self.ql = ql
+        self.keyword = keyword
+        self.delay = delay
+        self._first_at: Optional[float] = None
+        self._deadline = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def schedule(self):
+        now = time.monotonic()
+        if self._first_at is None:
+            self._first_at = now
+        self._deadline = min(now + self.delay, self._first_at + self.delay * self.MAX_DELAY_FACTOR)
+        if not self.pending:
+            self._task = asyncio.create_task(self._wait_and_fire())
+
+    async def _wait_and_fire(self):
+        # 一次运行覆盖多个登录，不归属任何一个命令
+        METRICS.attach_command(None)
+        while True:
+            left = self._deadline - time.monotonic()
+            if left <= 0:
+                break
+            await asyncio.sleep(left)
+        self._first_at = None
+        try:
+            await self.fire()
+        except CircuitOpenError:
+            METRICS.inc("bilitool_task_trigger_total", (("result", "error"),))
         except Exception as e:
-            logger.error(f"check_qrcode_status 异常：{e}", exc_info=True)
+            METRICS.inc("bilitool_task_trigger_total", (("result", "error"),))
+            logger.error(f"触发青龙面板 {self.ql.ql_panel_url} 的BiliTool任务失败：{e}")
+
+    async def fire(self) -> Tuple[bool, str]:
+        """立即检查并运行任务，返回 (是否运行, 说明)"""
+        crons = [c for c in await self.ql.list_crons(self.keyword) if not c.get("isDisabled")]
+        if not crons:
+            METRICS.inc("bilitool_task_trigger_total", (("result", "missing"),))
+            logger.warning(f"青龙面板 {self.ql.ql_panel_url} 上没有找到包含 {self.keyword} 的已启用定时任务，跳过触发")
+            return False, "没有找到BiliTool定时任务"
+        busy = [c for c in crons if c.get("status") in self.BUSY_STATUS]
+        if busy:
+            METRICS.inc("bilitool_task_trigger_total", (("result", "busy"),))
+            logger.info(f"BiliTool任务正在运行（{busy[0].get('name')}），跳过本次触发")
+            return False, "任务正在运行"
+        await self.ql.run_crons([c["id"] for c in crons])
+        METRICS.inc("bilitool_task_trigger_total", (("result", "run"),))
+        names = "、".join(str(c.get("name") or c.get("command")) for c in crons)
+        logger.info(f"已触发青龙面板 {self.ql.ql_panel_url} 的BiliTool任务：{names}")
+        return True, names
+
+    def close(self):
+        if self.pending:
+            self._task.cancel()
+
+
+class TaskRunLog:
+    """
+    一次 BiliTool 运行的日志和账号段落索引。
+    多账号运行时每个账号前有一行 "账号 N" 分隔（N 从 1 开始，按 Ray_BiliBiliCookies__ 序号排列），
+    段落内出现 UID 时记下 UID → 段落，查询时优先按 UID 匹配，找不到再按账号顺序匹配。
+    """
+    SECTION_RE = re.compile(r"^.*?账号\s*(\d+)[\s#=\-】\]]*$")
+    UID_RE = re.compile(r"UID\D{0,4}(\d{2,})", re.I)
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.text = ""
+        # 最后一次读取时任务已结束，之后不再读取
+        self.done = False
+        # 已解析到的位置，总是某一行的开头
+        self._parsed = 0
+        # [账号序号, 起点, 终点]，终点为 None 表示段落延续到当前末尾
+        self.sections: List[List] = []
+        self.uids: Dict[str, int] = {}
+
+    def feed(self, text: str):
+        """面板每次返回完整日志；与已缓存内容前缀相同时只解析新增的完整行"""
+        if not text.startswith(self.text):
+            self.text, self._parsed, self.sections, self.uids = "", 0, [], {}
+        self.text = text
+        end = text.rfind("\n") + 1
+        pos = self._parsed
+        for line in text[pos:end].splitlines(keepends=True):
+            m = self.SECTION_RE.match(line)
+            if m:
+                if self.sections:
+                    self.sections[-1][2] = pos
+                self.sections.append([int(m.group(1)), pos, None])
+            elif self.sections:
+                m = self.UID_RE.search(line)
+                if m:
+                    self.uids.setdefault(m.group(1), len(self.sections) - 1)
+            pos += len(line)
+        self._parsed = end
+
+    def section(self, uid: str, ordinal: Optional[int]) -> Optional[str]:
+        idx = self.uids.get(str(uid))
+        if idx is None:
+            if not self.sections:
+                # 只有一个账号时没有分隔行，整份日志就是它的
+                return self.text if ordinal == 1 else None
+            idx = next((i for i, s in enumerate(self.sections) if s[0] == ordinal), None)
+            if idx is None:
+                return None
+        _, start, end = self.sections[idx]
+        return self.text[start:end]
+
+
+class TaskLogIndex:
+    """
+    按账号查询 BiliTool 最近一次运行的日志：
+    - 日志按运行 ID（任务 id + 日志路径或开始时间）缓存，已结束的运行只读取一次
+    - 运行中的日志最多每 REFRESH_INTERVAL 秒重新读取，只解析新增部分
+    - 定时任务列表同样缓存 REFRESH_INTERVAL 秒，并发查询合并为一次请求
+    很多用户反复查询时，面板请求数只随运行次数增长，与查询次数无关。
+    """
+    REFRESH_INTERVAL = 30.0
+    MAX_RUNS = 4
+
+    def __init__(self, ql: "QinglongClient", keyword: str):
+        self.ql = ql
+        self.keyword = keyword
+        self._runs: "OrderedDict[str, TaskRunLog]" = OrderedDict()
+        self._latest: Optional[Tuple[Dict, TaskRunLog]] = None
+        self._checked_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def latest(self) -> Optional[Tuple[Dict, TaskRunLog]]:
+        """返回 (定时任务, 最近一次运行的日志)，面板上还没有运行记录时返回 None"""
+        if self._checked_at and time.monotonic() - self._checked_at < self.REFRESH_INTERVAL:
+            return self._latest
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._task)
+
+    async def _refresh(self) -> Optional[Tuple[Dict, TaskRunLog]]:
+        METRICS.attach_command(None)
+        crons = [c for c in await self.ql.list_crons(self.keyword) if c.get("last_execution_time")]
+        if not crons:
+            self._latest, self._checked_at = None, time.monotonic()
             return None
+        cron = max(crons, key=lambda c: c.get("last_execution_time") or 0)
+        run_id = f"{cron.get('id')}:{cron.get('log_path') or cron.get('last_execution_time')}"
+        run = self._runs.get(run_id)
+        if run is None:
+            run = self._runs[run_id] = TaskRunLog(run_id)
+            while len(self._runs) > self.MAX_RUNS:
+                self._runs.popitem(last=False)
+        if not run.done:
+            running = cron.get("status") in TaskTrigger.BUSY_STATUS
+            run.feed(await self.ql.get_cron_log(cron["id"]))
+            run.done = not running
+            METRICS.inc("bilitool_task_log_fetches_total")
+        self._latest, self._checked_at = (cron, run), time.monotonic()
+        return self._latest
+
+    def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+
+# 账号段落里值得展示的行：经验、硬币、会员权益，以及失败和报错
+TASK_LOG_HIGHLIGHT_RE = re.compile(r"经验|硬币|等级|大会员|充电|失败|异常|错误|\b(?:ERR|FTL|WRN)\]")
+
+
+def summarize_task_log(section: str, limit: int = 15) -> List[str]:
+    """从账号的日志段落中挑出重点行，去掉重复，最多保留最后 limit 行"""
+    picked: List[str] = []
+    for line in section.splitlines():
+        line = line.strip()
+        if line and TASK_LOG_HIGHLIGHT_RE.search(line) and line not in picked:
+            picked.append(line[:120])
+    return picked[-limit:]
 
-    async def complement_cookies(self, cookies: Dict) -> Dict:
+
+# =========================
+# QinglongPool: 多面板分片
+# =========================
+class QinglongPool:
+    """
+    多个青龙面板组成的账号池，对插件提供与单个 QinglongClient 相同的接口：
+    - 读取时并发访问所有面板再合并，某个面板不可用只影响它自己的账号
+    - 新登录的账号放到当前账号最少且未满的面板
+    - 已有账号的更新、登出按 UID 路由到所在面板
+    只配置一个面板时，行为与直接使用 QinglongClient 一致。
+    配置了本地账号登记且各面板都同步过不久时，计数和按 UID 查找面板直接查登记，不读取面板。
+    """
+    def __init__(self, panels: List[QinglongClient], max_per_panel: int, registry: Optional["AccountRegistry"] = None):
+        self.panels = panels
+        self.max_per_panel = max_per_panel
+        self.registry = registry
+        if registry is not None:
+            registry.retain([p.ql_panel_url for p in panels])
+            for panel in panels:
+                panel.on_snapshot = registry.sync
+        # UID → 最近一次看到它的面板；所在面板暂时不可用时，据此避免在别的面板重复登录
+        self._home: Dict[str, QinglongClient] = {}
+        # 正在写入、快照中还看不到的新账号数，避免并发登录挤进同一个面板
+        self._reserved: Dict[int, int] = {}
+
+    @property
+    def queued(self) -> int:
+        return sum(p.writer.queued for p in self.panels)
+
+    async def get_token(self, force_refresh: bool = False) -> Optional[str]:
+        """任一面板可用即返回它的令牌，全部不可用时返回 None"""
+        tokens = await asyncio.gather(*[p.get_token(force_refresh) for p in self.panels], return_exceptions=True)
+        return next((t for t in tokens if isinstance(t, str) and t), None)
+
+    async def _snapshots(self, force_refresh: bool = False) -> List[Optional[List[Dict]]]:
         """
-        访问 B 站首页以补全服务器在 Set-Cookie 中设置的 cookie。
-        返回合并后的 cookie dict。
+        并发读取所有面板的快照，与 panels 一一对应，不可用的面板为 None。
+        面板宕机时由熔断器直接拒绝，不会拖慢其它面板。
+        """
+        async def read(panel: QinglongClient) -> Optional[List[Dict]]:
+            try:
+                envs = await panel.get_env_snapshot(force_refresh=force_refresh, strict=True)
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpenError:
+                return None
+            except Exception as e:
+                logger.warning(f"青龙面板 {panel.ql_panel_url} 暂时无法读取：{e}")
+                return None
+            self._learn(panel, envs)
+            return envs
+
+        return list(await asyncio.gather(*[read(p) for p in self.panels]))
+
+    def _learn(self, panel: QinglongClient, envs: List[Dict]):
+        present = {env_uid(e) for e in envs if env_name(e).startswith(CHECK_PREFIX)}
+        present.discard("")
+        for uid, home in list(self._home.items()):
+            if home is panel and uid not in present:
+                del self._home[uid]
+        for uid in present:
+            self._home[uid] = panel
+
+    @staticmethod
+    def _bili_count(envs: List[Dict]) -> int:
+        return sum(1 for e in envs if env_name(e).startswith(CHECK_PREFIX))
+
+    def local(self) -> bool:
+        """本地账号登记是否可以代替读取面板"""
+        return self.registry is not None and self.registry.fresh([p.ql_panel_url for p in self.panels])
+
+    @staticmethod
+    def _reachable(panel: QinglongClient) -> bool:
+        return BREAKERS.get(panel._host).state != "open"
+
+    async def _find(self, uid: str, verify_missing: bool = False) -> Tuple[Optional[QinglongClient], List[Optional[int]]]:
         """
+        按 UID 查找所在面板，返回 (面板, 各面板账号数)，不可用的面板账号数为 None。
+        登记有效时只查本地；否则读取快照（快照在本插件写入后会同步更新）。
+        verify_missing=True 时登记里找不到的 UID 再读一次快照确认，避免"未找到"误报。
+        """
+        if self.local():
+            row = self.registry.find(uid)
+            home = next((p for p in self.panels if row and p.ql_panel_url == row["panel"]), None)
+            if home is not None or not verify_missing:
+                counts = [self.registry.count(p.ql_panel_url) if self._reachable(p) else None for p in self.panels]
+                return home, counts
+        snaps = await self._snapshots()
+        counts = [None if snap is None else self._bili_count(snap) for snap in snaps]
+        for panel, snap in zip(self.panels, snaps):
+            if snap and any(env_uid(e) == uid and env_name(e).startswith(CHECK_PREFIX) for e in snap):
+                return panel, counts
+        return None, counts
+
+    async def get_env_snapshot(self, force_refresh: bool = False, strict: bool = False) -> List[Dict]:
+        """合并所有可用面板的快照；strict=True 时仅在全部面板都不可用时抛出异常"""
+        snaps = await self._snapshots(force_refresh)
+        if strict and all(snap is None for snap in snaps):
+            raise QinglongError("所有青龙面板均无法读取")
+        return [env for snap in snaps if snap for env in snap]
+
+    async def get_all_envs(self, token: Optional[str] = None) -> List[Dict]:
+        return list(await self.get_env_snapshot())
+
+    async def get_env_values(self, names: List[str]) -> Dict[str, Optional[str]]:
+        """并发读取所有面板，同一变量以配置顺序靠前、且配置了该变量的面板为准"""
+        per_panel = await asyncio.gather(*[p.get_env_values(names) for p in self.panels])
+        values: Dict[str, Optional[str]] = {}
+        for panel_values in per_panel:
+            for name, value in panel_values.items():
+                if values.get(name) is None:
+                    values[name] = value
+        return values
+
+    async def shard_status(self) -> List[Tuple[str, Optional[int]]]:
+        """每个面板的 (地址, 账号数)，不可用的面板账号数为 None"""
+        if self.local():
+            return [
+                (p.ql_panel_url, self.registry.count(p.ql_panel_url) if self._reachable(p) else None)
+                for p in self.panels
+            ]
+        snaps = await self._snapshots()
+        return [
+            (panel.ql_panel_url, None if snap is None else self._bili_count(snap))
+            for panel, snap in zip(self.panels, snaps)
+        ]
+
+    async def save_cookie_to_qinglong(self, cookies: Dict, uid: int) -> Tuple[bool, str]:
+        user_id = str(cookies.get("DedeUserID", uid))
+        panel, counts = await self._find(user_id)
+        if panel is not None and counts[self.panels.index(panel)] is not None:
+            return await panel.save_cookie_to_qinglong(cookies, uid)
+        if panel is not None or (user_id in self._home and not self.local()):
+            # 账号存在于某个暂时连不上的面板，放到别的面板会产生重复账号（本地登记同样记着这些账号）
+            return False, "该账号所在的青龙面板暂时无法连接，请稍后再试"
+
+        loads = [
+            (count + self._reserved.get(i, 0), i)
+            for i, count in enumerate(counts) if count is not None
+        ]
+        if not loads:
+            return False, "青龙面板均无法连接，请稍后再试"
+        candidates = [item for item in loads if item[0] < self.max_per_panel]
+        if not candidates:
+            return False, "所有可用的青龙面板账号数量均已达上限"
+        _, idx = min(candidates)
+        panel = self.panels[idx]
+        self._reserved[idx] = self._reserved.get(idx, 0) + 1
         try:
-            resp = await self.client.get(HOME_PAGE_URL, cookies=cookies)
-            resp.raise_for_status()
-            new_cookies = merge_cookies_from_response(resp.cookies)
-            cookies.update(new_cookies)
-            logger.debug(f"补全Cookie成功，新增字段：{','.join(new_cookies.keys())}")
-            return cookies
-        except Exception as e:
-            logger.error(f"complement_cookies 异常：{e}", exc_info=True)
-            return cookies
+            success, msg = await panel.save_cookie_to_qinglong(cookies, uid)
+        finally:
+            self._reserved[idx] -= 1
+        if success:
+            self._home[user_id] = panel
+        return success, msg
 
-    async def validate_cookie(self, cookies: Dict) -> Tuple[bool, str]:
+    def _home_panel(self, uid) -> Optional[QinglongClient]:
+        row = self.registry.find(uid) if self.registry is not None else None
+        panel = next((p for p in self.panels if row and p.ql_panel_url == row["panel"]), None)
+        return panel or self._home.get(str(uid))
+
+    async def task_log(self, uid) -> Optional[Tuple[Dict, Optional[str]]]:
         """
-        验证 Cookie 有效性，保持与原函数签名一致。
+        账号所在面板最近一次 BiliTool 运行：返回 (定时任务, 该账号的日志段落)，
+        面板上还没有运行记录时返回 None；段落找不到时为 None
         """
-        required_fields = ["DedeUserID", "SESSDATA", "bili_jct"]
-        missing = [f for f in required_fields if f not in cookies]
-        if missing:
-            return False, f"缺少必要Cookie字段：{', '.join(missing)}"
-        if not str(cookies["DedeUserID"]).isdigit():
-            return False, "DedeUserID格式无效（非数字）"
-        if len(cookies["SESSDATA"]) < 20:
-            return False, "SESSDATA格式无效（长度不足20）"
-        if len(cookies["bili_jct"]) != 32:
-            return False, "bili_jct格式无效（长度不为32）"
-        return True, "Cookie验证通过"
+        panel = self._home_panel(uid)
+        if panel is None or panel.task_logs is None:
+            return None
+        latest = await panel.task_logs.latest()
+        if latest is None:
+            return None
+        cron, run = latest
+        ordinal = None
+        if self.registry is not None:
+            uids = [a["uid"] for a in self.registry.accounts(panel.ql_panel_url)]
+            ordinal = uids.index(str(uid)) + 1 if str(uid) in uids else None
+        return cron, run.section(str(uid), ordinal)
+
+    def schedule_task_run(self, uid) -> bool:
+        """新账号写入后，安排它所在的面板运行一次 BiliTool 任务；该面板未开启触发时返回 False"""
+        panel = self._home_panel(uid)
+        if panel is None or panel.task_trigger is None:
+            return False
+        panel.task_trigger.schedule()
+        return True
+
+    async def delete_bili_cookie(self, token: Optional[str], uid: int) -> Tuple[bool, str]:
+        panel, counts = await self._find(str(uid), verify_missing=True)
+        if panel is not None and counts[self.panels.index(panel)] is None:
+            return False, "该账号所在的青龙面板暂时无法连接，请稍后再试"
+        if panel is not None:
+            success, msg = await panel.delete_bili_cookie(token, uid)
+            if success:
+                # 查本地登记时不读快照，_home 不会自动更新
+                self._home.pop(str(uid), None)
+            return success, msg
+        if any(count is None for count in counts):
+            return False, f"未找到UID {uid} 的Cookie（有青龙面板暂时无法连接，请稍后再试）"
+        return False, f"未找到UID {uid} 的Cookie"
+
+    async def reconcile(self, dry_run: bool = False) -> List[Tuple[str, bool, str]]:
+        """逐个面板整理 Cookie 变量，返回每个面板的 (地址, 成功, 操作列表或错误)"""
+        async def run(panel: QinglongClient) -> Tuple[str, bool, str]:
+            try:
+                ok, msg = await panel.reconcile(dry_run)
+            except asyncio.CancelledError:
+                raise
+            except CircuitOpenError:
+                return panel.ql_panel_url, False, "暂时无法连接"
+            except Exception as e:
+                return panel.ql_panel_url, False, str(e)
+            return panel.ql_panel_url, ok, msg
+
+        return list(await asyncio.gather(*[run(p) for p in self.panels]))
 
     async def close(self):
-        await self.client.close()
+        await asyncio.gather(*[p.close() for p in self.panels], return_exceptions=True)
+
 
 # =========================
-# QinglongClient: 与青龙面板交互（异步 httpx）
+# 账号登记与 Cookie 健康检测
 # =========================
-class QinglongClient:
-    def __init__(self, panel_url: str, client_id: str, client_secret: str):
-        self.ql_panel_url = panel_url.rstrip("/") if panel_url else ""
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.client = httpx.AsyncClient(timeout=15.0)
-
-    async def get_token(self) -> Optional[str]:
-        if not all([self.ql_panel_url, self.client_id, self.client_secret]):
-            logger.error("青龙面板配置不完整：地址/Client ID/Client Secret 缺失")
-            return None
-        
-        # 这里没有体面的方法了，只能拼接URL参数
-        url = f"{self.ql_panel_url}/open/auth/token?client_id={self.client_id}&client_secret={self.client_secret}"
+class AccountRegistry:
+    """
+    本地账号登记（数据目录下的 SQLite 文件 accounts.db），以 UID 为主键，按 (面板, 序号) 建索引：
+    - 镜像面板上每个账号所在的面板、变量名和序号，以及登录时间、登录人
+    - 账号的本地状态（最近一次在线检测时间和结果、登录时下发的 refresh_token 等）
+    面板仍是唯一事实来源：每次读到或写入面板的 Cookie 变量后调用 sync，
+    先比较变量列表的指纹，没有变化直接跳过，有变化也只改动差异的行。
+    查询全部在内存中完成，SQLite 只负责落盘，每次只写有改动的行。
+    """
+    # 面板超过该时间（秒）没有同步时，计数和 UID 查询改为读取面板
+    MAX_AGE = 600.0
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS accounts (
+        uid TEXT PRIMARY KEY,
+        panel TEXT,
+        name TEXT,
+        slot INTEGER,
+        env_id TEXT,
+        added_at REAL,
+        added_by TEXT,
+        state TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS accounts_slot ON accounts (panel, slot);
+    CREATE TABLE IF NOT EXISTS panels (
+        panel TEXT PRIMARY KEY,
+        fingerprint TEXT,
+        synced_at REAL
+    );
+    """
+    FIELDS = ("panel", "name", "slot", "env_id", "added_at", "added_by")
+
+    def __init__(self, path: str, legacy_json: Optional[str] = None):
+        self.path = path
+        self._rows: Dict[str, Dict] = {}
+        self._panels: Dict[str, Dict] = {}
+        # 内存中已改动、尚未落盘的 UID 和面板
+        self._dirty: set = set()
+        self._dirty_panels: set = set()
+        # 多个命令可能同时落盘，串行写入
+        self._save_lock = asyncio.Lock()
+        self._save_task: Optional[asyncio.Task] = None
+        self._db = self._open(path)
+        self._load()
+        if legacy_json and not self._rows:
+            self._migrate(legacy_json)
+
+    @classmethod
+    def _open(cls, path: str) -> sqlite3.Connection:
         try:
-            resp = await self.client.get(url)
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("code") == 200 and data.get("data", {}).get("token"):
-                logger.info("青龙面板访问令牌获取成功")
-                return data["data"]["token"]
-            logger.error(f"获取青龙令牌失败：{data}")
-            return None
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.executescript(cls.SCHEMA)
+            return db
+        except sqlite3.Error as e:
+            logger.error(f"打开账号登记数据库失败，本次运行只保存在内存中：{e}")
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+            db.executescript(cls.SCHEMA)
+            return db
+
+    def _load(self):
+        try:
+            for uid, *fields, state in self._db.execute(f"SELECT uid, {', '.join(self.FIELDS)}, state FROM accounts"):
+                row = dict(zip(self.FIELDS, fields))
+                row["state"] = json.loads(state or "{}")
+                self._rows[uid] = row
+            for panel, fingerprint, synced_at in self._db.execute("SELECT panel, fingerprint, synced_at FROM panels"):
+                # 序号数只在内存中，重启后要先同步一次才算新鲜
+                self._panels[panel] = {"fingerprint": fingerprint, "synced_at": 0.0, "slots": 0}
         except Exception as e:
-            logger.error(f"获取青龙令牌异常：{e}", exc_info=True)
-            return None
+            logger.error(f"读取账号登记数据库失败，将重新记录：{e}")
 
-    async def get_all_envs(self, token: str) -> List[Dict]:
-        url = f"{self.ql_panel_url}/open/envs"
-        headers = {"Authorization": f"Bearer {token}"}
+    def _migrate(self, legacy_json: str):
+        """旧版本的 account_state.json 导入一次后改名为 .migrated"""
         try:
-            resp = await self.client.get(url, headers=headers)
-            resp.raise_for_status()
-            text = resp.text
-            data = json.loads(text)
-            if isinstance(data, list):
-                return data
-            if isinstance(data, dict) and data.get("code") == 200:
-                d = data.get("data", {})
-                if isinstance(d, dict):
-                    return d.get("items", [])
-                if isinstance(d, list):
-                    return d
-            return []
+            with open(legacy_json, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
         except Exception as e:
-            logger.error(f"获取青龙环境变量异常：{e}", exc_info=True)
-            return []
-
-    async def save_cookie_to_qinglong(self, cookies: Dict, uid: int) -> Tuple[bool, str]:
-        token = await self.get_token()
-        if not token:
-            return False, "获取青龙面板令牌失败"
+            logger.error(f"读取旧账号状态文件失败，跳过导入：{e}")
+            return
+        for uid, state in data.items():
+            if isinstance(state, dict) and state:
+                self._row(uid)["state"] = dict(state)
         try:
-            url = f"{self.ql_panel_url}/open/envs"
-            headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-            resp = await self.client.get(url, params={"searchValue": CHECK_PREFIX}, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get("code") != 200:
-                return False, f"查询青龙环境变量失败：{data.get('message', '')}"
-            env_list = data.get("data", [])
-            if isinstance(env_list, dict):
-                env_list = env_list.get("items", [])
-
-            cookie_str = "; ".join([f"{k}={v}" for k, v in cookies.items()])
-            user_id = cookies.get("DedeUserID", str(uid))
-
-            existing_env = None
-            for env in env_list:
-                name = env.get("name", "")
-                if isinstance(name, bytes):
-                    try:
-                        name = name.decode("utf-8", errors="ignore")
-                    except Exception:
-                        name = str(name)
-                remarks = env.get("remarks", "")
-                if name.startswith(CHECK_PREFIX) and remarks == f"bili-{user_id}":
-                    existing_env = env
-                    break
-            
-            # 在这里再次提及插件设计寿命极短
-            # 变量名本来就必须连续，如果不连续则会导致处理任务的程序无法正常运行，你并不能依赖这个插件去修复这个错误
-            # 我能做的就是尽力去保证每一次正常运行的时候不会出现意外错误
-            if existing_env:
-                env_data = {"id": existing_env["id"], "name": existing_env["name"], "value": cookie_str, "remarks": f"bili-{user_id}"}
-                up = await self.client.put(url, json=env_data, headers=headers)
-                up.raise_for_status()
-                result = up.json()
-                if result.get("code") == 200:
-                    logger.info(f"更新B站Cookie成功：{existing_env['name']}")
-                    return True, f"更新Cookie成功！UID：{user_id}"
-                else:
-                    return False, f"更新Cookie失败：{result.get('message')}"
-            else:
-                new_name = f"{CHECK_PREFIX}{len(env_list)}"
-                env_payload = [{"name": new_name, "value": cookie_str, "remarks": f"bili-{user_id}"}]
-                post = await self.client.post(url, json=env_payload, headers=headers)
-                post.raise_for_status()
-                result = post.json()
-                if result.get("code") == 200:
-                    logger.info(f"新增B站Cookie成功：{new_name}")
-                    return True, f"新增Cookie成功！UID：{user_id}"
-                else:
-                    return False, f"新增Cookie失败：{result.get('message')}"
+            self._write(self._dump(set(self._rows)), [], [])
+            os.replace(legacy_json, f"{legacy_json}.migrated")
+            logger.info(f"已导入旧账号状态文件：{len(self._rows)} 个账号")
         except Exception as e:
-            logger.error(f"保存Cookie到青龙异常：{e}", exc_info=True)
-            return False, f"保存Cookie异常：{e}"
+            logger.error(f"导入旧账号状态文件失败：{e}")
+
+    def _row(self, uid) -> Dict:
+        uid = str(uid)
+        row = self._rows.get(uid)
+        if row is None:
+            row = self._rows[uid] = {**dict.fromkeys(self.FIELDS), "state": {}}
+        return row
+
+    def _touch(self, uid: str):
+        row = self._rows.get(uid)
+        # 不在任何面板上、也没有本地状态的行没有保留价值
+        if row is not None and row["panel"] is None and not row["state"]:
+            del self._rows[uid]
+        self._dirty.add(uid)
+
+    # ---- 账号状态 ----
+    def get(self, uid) -> Dict:
+        row = self._rows.get(str(uid))
+        return row["state"] if row else {}
+
+    def all(self) -> Dict[str, Dict]:
+        return {uid: row["state"] for uid, row in self._rows.items() if row["state"]}
+
+    def update(self, uid, **fields):
+        self._row(uid)["state"].update(fields)
+        self._touch(str(uid))
+
+    def remove(self, uid):
+        """只清空本地状态，账号所在位置以面板为准，由 sync 维护"""
+        row = self._rows.get(str(uid))
+        if row and row["state"]:
+            row["state"] = {}
+            self._touch(str(uid))
+
+    # ---- 面板镜像 ----
+    @staticmethod
+    def fingerprint(envs: List[Dict]) -> str:
+        keys = sorted((str(e.get("id")), env_name(e), str(e.get("remarks") or "")) for e in envs)
+        return hashlib.sha1(json.dumps(keys, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def sync(self, panel: str, envs: Optional[List[Dict]]) -> bool:
+        """
+        用面板最新的 Cookie 变量列表更新登记，返回是否有变化。
+        envs 为 None 表示面板状态未知（写入中途失败等），该面板的登记过期，下次查询读取面板。
+        同一 UID 有多个变量时以序号最小的为准（整理后只会剩这一个）；
+        已登记在别的面板上的 UID 不抢占，避免两个面板的重复账号来回切换。
+        """
+        meta = self._panels.setdefault(panel, {"fingerprint": None, "synced_at": 0.0, "slots": 0})
+        if envs is None:
+            meta["synced_at"] = 0.0
+            return False
+        meta["synced_at"] = time.time()
+        # 账号上限按面板上的 Cookie 变量数计算，手动添加、没有 UID 备注的变量同样占名额
+        meta["slots"] = sum(1 for e in envs if env_name(e).startswith(CHECK_PREFIX))
+        fingerprint = self.fingerprint(envs)
+        if meta["fingerprint"] == fingerprint:
+            return False
+        meta["fingerprint"] = fingerprint
+        self._dirty_panels.add(panel)
+
+        seen: Dict[str, Dict] = {}
+        for env in sorted(envs, key=env_slot):
+            uid = env_uid(env)
+            if uid and env_name(env).startswith(CHECK_PREFIX):
+                seen.setdefault(uid, env)
+        for uid, env in seen.items():
+            row = self._row(uid)
+            if row["panel"] not in (None, panel):
+                continue
+            placed = {"panel": panel, "name": env_name(env), "slot": canonical_slot(env), "env_id": str(env.get("id"))}
+            if any(row[k] != v for k, v in placed.items()):
+                row.update(placed)
+                self._touch(uid)
+        released = False
+        for uid, row in list(self._rows.items()):
+            if row["panel"] == panel and uid not in seen:
+                row.update(dict.fromkeys(self.FIELDS))
+                self._touch(uid)
+                released = True
+        if released:
+            # 释放的 UID 可能还留在别的面板上，让它们下次同步时重新比对
+            for other, other_meta in self._panels.items():
+                if other != panel:
+                    other_meta["fingerprint"] = None
+        self._schedule_save()
+        return True
+
+    def record_login(self, uid, added_by: str):
+        """登录成功后记录登录人；已有记录的账号（重新登录）保留最初的登录时间和登录人"""
+        row = self._row(uid)
+        if not row["added_by"]:
+            row["added_at"] = time.time()
+            row["added_by"] = str(added_by)
+            self._touch(str(uid))
+
+    def retain(self, panels: List[str]):
+        """
+        只保留当前配置的面板：面板地址改过或删掉后，旧地址上的账号行不再占着 UID，
+        否则新面板同步时不会接管这些 UID，登出会找不到账号
+        """
+        keep = set(panels)
+        for uid, row in list(self._rows.items()):
+            if row["panel"] is not None and row["panel"] not in keep:
+                row.update(dict.fromkeys(self.FIELDS))
+                self._touch(uid)
+        stale = [p for p in self._panels if p not in keep]
+        for panel in stale:
+            del self._panels[panel]
+        if stale:
+            try:
+                with self._db:
+                    self._db.executemany("DELETE FROM panels WHERE panel = ?", [(p,) for p in stale])
+            except Exception as e:
+                logger.error(f"清理账号登记中的旧面板失败：{e}")
+
+    def fresh(self, panels: List[str]) -> bool:
+        """所有面板都在 MAX_AGE 内同步过时，本地登记可以直接回答计数和 UID 查询"""
+        now = time.time()
+        return all(now - self._panels.get(p, {}).get("synced_at", 0.0) < self.MAX_AGE for p in panels)
+
+    def find(self, uid) -> Optional[Dict]:
+        row = self._rows.get(str(uid))
+        if row is None or row["panel"] is None:
+            return None
+        return {"uid": str(uid), **row}
+
+    def count(self, panel: Optional[str] = None) -> int:
+        """面板上 Ray_BiliBiliCookies__ 变量的个数（与读取快照时的计数一致），不指定面板时为合计"""
+        return sum(meta.get("slots", 0) for p, meta in self._panels.items() if panel in (None, p))
+
+    def accounts(self, panel: Optional[str] = None) -> List[Dict]:
+        """面板上的账号，按 (面板, 序号) 排列"""
+        rows = [
+            {"uid": uid, **row} for uid, row in self._rows.items()
+            if row["panel"] is not None and panel in (None, row["panel"])
+        ]
+        return sorted(rows, key=lambda r: (r["panel"], r["slot"] is None, r["slot"] or 0, r["name"] or ""))
+
+    # ---- 落盘 ----
+    def _dump(self, uids) -> List[Tuple]:
+        return [
+            (uid, *(self._rows[uid][k] for k in self.FIELDS), json.dumps(self._rows[uid]["state"], ensure_ascii=False))
+            for uid in uids if uid in self._rows
+        ]
+
+    def _schedule_save(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self.save())
+
+    async def save(self):
+        async with self._save_lock:
+            # 写入期间产生的新改动在下一轮一起写
+            while self._dirty or self._dirty_panels:
+                uids, panels = self._dirty, self._dirty_panels
+                self._dirty, self._dirty_panels = set(), set()
+                rows = self._dump(uids)
+                gone = [(uid,) for uid in uids if uid not in self._rows]
+                metas = [(p, self._panels[p]["fingerprint"], self._panels[p]["synced_at"]) for p in panels]
+                try:
+                    await asyncio.to_thread(self._write, rows, gone, metas)
+                except Exception as e:
+                    self._dirty |= uids
+                    self._dirty_panels |= panels
+                    logger.error(f"保存账号登记失败：{e}")
+                    return
 
-    async def delete_bili_cookie(self, token: str, uid: int) -> Tuple[bool, str]:
-        """使用尾部覆盖方式安全删除指定UID的B站Cookie"""
+    def _write(self, rows: List[Tuple], gone: List[Tuple], metas: List[Tuple]):
+        with self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO accounts (uid, {', '.join(self.FIELDS)}, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.executemany("DELETE FROM accounts WHERE uid = ?", gone)
+            self._db.executemany("INSERT OR REPLACE INTO panels (panel, fingerprint, synced_at) VALUES (?, ?, ?)", metas)
 
-        # 这个项目不足10个人使用，其面板最终管理者不超过一个
-        # 这个能出现2个人同时操作给变量搞掉的概率比宇宙射线打到内存条而且不蓝屏的概率还低
-        # 而且就算搞掉了也不会影响其他任务执行，如果真的恰巧运行也只会当作错误的cookie跳过
-        # 然后还是这个插件的设计寿命，我设计只允许10个人登录，而且登录后基本长期不会再次运行，可以说很无用但是不能没有了
-        # 没有用户会频繁来回登录账户，会导致用户本身账户风控
+    async def close(self):
+        await self.save()
+        self._db.close()
 
-        if not token:
-            return False, "青龙令牌获取失败"
 
-        try:
-            # 复用客户端会导致神秘崩溃，请图灵辟邪之前请不要动这坨代码
-            async with httpx.AsyncClient(timeout=10) as client:
+class CookieHealthChecker:
+    """
+    后台检测面板中每个 Ray_BiliBiliCookies__N 是否仍然有效：
+    - 每轮只检测上次检测早于 max_age 的账号，刚登录或刚检测过的跳过
+    - 同时进行的检测不超过 concurrency 个，每次检测前随机等待，避免集中请求
+    - 结果写入 AccountRegistry，info/help 直接读取
+    """
+
+    def __init__(self, bili: "BiliClient", ql: "QinglongPool", store: AccountRegistry,
+                 interval: float = 1800, max_age: float = 12 * 3600, concurrency: int = 2, jitter: float = 5.0):
+        self.bili = bili
+        self.ql = ql
+        self.store = store
+        self.interval = interval
+        self.max_age = max_age
+        self.concurrency = max(1, concurrency)
+        self.jitter = jitter
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        METRICS.attach_command(None)
+        while True:
+            try:
+                await self.check_due()
+            except Exception as e:
+                logger.error(f"Cookie健康检测异常：{e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def check_due(self) -> int:
+        """检测所有到期的账号，返回本轮检测的数量"""
+        envs = await self.ql.get_env_snapshot(strict=True)
+        now = time.time()
+        due = []
+        for env in envs:
+            uid = env_uid(env)
+            if not uid or not env_name(env).startswith(CHECK_PREFIX):
+                continue
+            if now - self.store.get(uid).get("checked_at", 0) >= self.max_age:
+                due.append((uid, env))
+        if not due:
+            return 0
+
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def check(uid: str, env: Dict):
+            async with sem:
+                await asyncio.sleep(random.uniform(0, self.jitter))
+                alive = await self.bili.check_login_state(str(env.get("value", "")))
+            if alive is None:
+                # 无法判断时不更新检测时间，下一轮重试
+                return
+            self.store.update(uid, alive=alive, checked_at=time.time(), slot=env_name(env))
+            if not alive:
+                logger.warning(f"B站Cookie已失效：{env_name(env)}（UID {uid}）")
 
-                # 1. 获取全部 Cookie 环境变量
-                url = f"{self.ql_panel_url}/open/envs"
-                resp = await client.get(url, headers={"Authorization": f"Bearer {token}"}, params={"searchValue": CHECK_PREFIX})
-                resp.raise_for_status()
-                all_envs = resp.json().get("data", [])
+        await asyncio.gather(*[check(uid, env) for uid, env in due])
+        await self.store.save()
+        logger.info(f"Cookie健康检测完成：本轮检测 {len(due)} 个账号")
+        return len(due)
 
-                # 排序，确保 bili_cookie__0 1 2 ... 顺序一致
-                def extract_suffix(env):
-                    try:
-                        return int(str(env["name"]).split("__")[-1])
-                    except:
-                        return 99999
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        await self.store.save()
 
-                bili_envs = sorted(
-                    [env for env in all_envs if str(env.get("name", "")).startswith(CHECK_PREFIX)],
-                    key=extract_suffix
-                )
 
-                # 找到目标 cookie
-                target_env = None
-                for env in bili_envs:
-                    if str(env.get("remarks", "")) == f"bili-{uid}":
-                        target_env = env
-                        break
-
-                if not target_env:
-                    return False, f"未找到UID {uid} 的Cookie"
-
-                # 如果只有 1 条，直接删即可
-                if len(bili_envs) == 1:
-                    delete_resp = await client.request(
-                        "DELETE",
-                        f"{self.ql_panel_url}/open/envs?id=",
-                        json=[target_env["id"]],
-                        headers={"Authorization": f"Bearer {token}"}
-                    )
-                    delete_resp.raise_for_status()
-                    return True, f"删除成功（UID：{uid}）"
-
-                # 2. 获取最后一条
-                last_env = bili_envs[-1]
-
-                # 3. 如果要删除的不是最后一个 → 则用最后一个覆盖它
-                if target_env["id"] != last_env["id"]:
-                    update_data = {
-                        "id": target_env["id"],
-                        "name": target_env["name"],  # 名称保持不变！
-                        "value": last_env["value"],
-                        "remarks": last_env["remarks"]
-                    }
-
-                    put_resp = await client.put(
-                        f"{self.ql_panel_url}/open/envs",
-                        json=update_data,
-                        headers={"Authorization": f"Bearer {token}"}
-                    )
-                    put_resp.raise_for_status()
-
-                # 4. 删除最后一条
-                delete_resp = await client.request(
-                    "DELETE",
-                    f"{self.ql_panel_url}/open/envs?id=",
-                    json=[last_env["id"]],
-                    headers={"Authorization": f"Bearer {token}"}
-                )
-                delete_resp.raise_for_status()
+class CookieRefresher:
+    """
+    用登录时保存的 refresh_token 在 Cookie 过期前自动续期，免去重新扫码：
+    - 每个账号每隔 check_age 向 B站查询一次是否需要刷新
+    - 账号之间至少间隔 spacing 秒，B站侧收到的刷新请求有上限
+    - 每 BATCH_SIZE 个刷新成功的账号一起写回面板（由 CookieEnvWriter 合并为一次批量写入），
+      写回成功后才确认刷新让旧 Cookie 失效；写回失败的新 Cookie 暂存在本地，下一轮优先重试
+    """
+    # 后台检查是否有到期账号的间隔（秒）
+    ROUND_INTERVAL = 1800
+    BATCH_SIZE = 5
+
+    def __init__(self, bili: "BiliClient", ql: "QinglongPool", store: AccountRegistry,
+                 check_age: float = 24 * 3600, spacing: float = 2.0):
+        self.bili = bili
+        self.ql = ql
+        self.store = store
+        self.check_age = check_age
+        self.spacing = spacing
+        self._last_request = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        METRICS.attach_command(None)
+        while True:
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.error(f"Cookie自动刷新异常：{e}", exc_info=True)
+            await asyncio.sleep(self.ROUND_INTERVAL)
+
+    async def refresh_due(self) -> int:
+        """处理所有到期的账号，返回本轮刷新并写回成功的数量"""
+        envs = await self.ql.get_env_snapshot(strict=True)
+        now = time.time()
+        due = []
+        for env in envs:
+            uid = env_uid(env)
+            if not uid or not env_name(env).startswith(CHECK_PREFIX):
+                continue
+            state = self.store.get(uid)
+            if not state.get("refresh_token"):
+                continue
+            if state.get("pending_cookie") or now - state.get("refresh_checked_at", 0) >= self.check_age:
+                due.append((uid, env))
+        if not due:
+            return 0
+
+        done = 0
+        for i in range(0, len(due), self.BATCH_SIZE):
+            refreshed = []
+            for uid, env in due[i:i + self.BATCH_SIZE]:
+                item = await self._refresh_one(uid, env)
+                if item:
+                    refreshed.append(item)
+            done += await self._write_back(refreshed)
+            await self.store.save()
+        logger.info(f"Cookie自动刷新完成：检查 {len(due)} 个账号，刷新 {done} 个")
+        return done
+
+    async def _pace(self):
+        wait = self._last_request + self.spacing - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_request = time.monotonic()
+
+    async def _refresh_one(self, uid: str, env: Dict) -> Optional[Tuple[str, Dict, str, str]]:
+        """刷新单个账号，返回 (uid, 新 cookies, 旧 refresh_token, 新 refresh_token)，无需或无法刷新时返回 None"""
+        state = self.store.get(uid)
+        if state.get("pending_cookie"):
+            # 上一轮已刷新但没写回面板，直接重试写回
+            return uid, parse_cookie_string(state["pending_cookie"]), state.get("pending_old_token", ""), state["refresh_token"]
+
+        await self._pace()
+        cookies = parse_cookie_string(str(env.get("value", "")))
+        need, timestamp = await self.bili.cookie_refresh_info(cookies)
+        if need is None:
+            # 无法判断（未登录/网络错误），不记检查时间，下一轮再试；失效账号交给健康检测标记
+            return None
+        if not need:
+            METRICS.inc("bilitool_cookie_refresh_total", (("result", "skipped"),))
+            self.store.update(uid, refresh_checked_at=time.time())
+            return None
 
-                return True, f"删除成功（UID：{uid}）"
+        await self._pace()
+        old_token = state["refresh_token"]
+        new_cookies, new_token = await self.bili.refresh_cookies(cookies, old_token, timestamp)
+        if not new_cookies or not new_token:
+            METRICS.inc("bilitool_cookie_refresh_total", (("result", "failed"),))
+            self.store.update(uid, refresh_checked_at=time.time())
+            return None
 
-                # 操你妈的AI，压根不考虑别人项目兼容性，不搞数组末尾交换删除又嫌我调用50次挪动问题太大
-                # 别人的项目必须保证变量名连续，cookie丢哪个槽位都能跑，你来一句有抖动或者俩人操作怎么办，那我问你你有这种API吗，那你有办法吗
-                # 这玩意设计寿命就他妈供10个人用，登录一次半辈子都不用管，插件就是扩展面板已有的登录，卸了这玩意都能跑，信我登录一次能遇到这个BUG还是信硬盘内存条涨价
+        # 旧 refresh_token 已被消耗，新的立即落盘；新 Cookie 写回面板前先暂存，避免丢失
+        self.store.update(
+            uid,
+            refresh_token=new_token,
+            pending_cookie="; ".join(f"{k}={v}" for k, v in new_cookies.items()),
+            pending_old_token=old_token,
+        )
+        await self.store.save()
+        return uid, new_cookies, old_token, new_token
+
+    async def _write_back(self, items: List[Tuple[str, Dict, str, str]]) -> int:
+        # 刷新期间账号可能被登出或重新扫码登录，此时不能用旧会话的 Cookie 覆盖
+        items = [it for it in items if self.store.get(it[0]).get("refresh_token") == it[3]]
+        if not items:
+            return 0
+        results = await asyncio.gather(*[self.ql.save_cookie_to_qinglong(cookies, int(uid)) for uid, cookies, _, _ in items])
+
+        done = 0
+        for (uid, cookies, old_token, _), (success, msg) in zip(items, results):
+            if not success:
+                logger.warning(f"刷新后的Cookie写回面板失败（UID {uid}），下一轮重试：{msg}")
+                continue
+            await self._pace()
+            if not await self.bili.confirm_refresh(cookies, old_token):
+                # 不影响新 Cookie 使用，旧 Cookie 到期后自然失效
+                logger.warning(f"确认刷新失败（UID {uid}），旧Cookie将保留到自然过期")
+            now = time.time()
+            self.store.update(
+                uid, pending_cookie="", pending_old_token="",
+                refresh_checked_at=now, refreshed_at=now, alive=True, checked_at=now,
+            )
+            METRICS.inc("bilitool_cookie_refresh_total", (("result", "ok"),))
+            done += 1
+        return done
 
-        except httpx.ConnectError:
-            return False, "无法连接到青龙面板"
-        except httpx.TimeoutException:
-            return False, "青龙面板请求超时"
-        except Exception as e:
-            logger.error(f"删除Cookie异常：{str(e)}", exc_info=True)
-            return False, f"删除Cookie异常：{str(e)}"
-    
     async def close(self):
-        await self.client.close()
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+
+# =========================
+# 扫码会话登记：并发上限、排队、同UID去重、发送者冷却
+# =========================
+class QrTicket:
+    """一次扫码流程的排队凭证"""
+    __slots__ = ("uid", "admitted", "superseded")
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.admitted = asyncio.get_running_loop().create_future()
+        # 同一UID发起了新的扫码请求时置位，旧流程应尽快结束
+        self.superseded = asyncio.Event()
+
+
+class QrSessionRegistry:
+    """
+    管理所有扫码流程（登录和登出验证）。
+    - 同时进行的扫码会话不超过 max_active，其余按先来后到排队
+    - 同一UID再次发起时，取消它之前仍在进行或排队的流程
+    - 记录每个发送者上次发起的时间，冷却表用 LRU 限制大小
+    """
+
+    def __init__(self, max_active: int = 3, cooldown: float = 30.0, cooldown_capacity: int = 1024):
+        self.max_active = max(1, max_active)
+        self.cooldown = max(0.0, cooldown)
+        self.cooldown_capacity = cooldown_capacity
+        self._active: List[QrTicket] = []
+        self._waiting: List[QrTicket] = []
+        self._by_uid: Dict[str, QrTicket] = {}
+        self._last_start: "OrderedDict[str, float]" = OrderedDict()
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def cooldown_left(self, sender: str) -> float:
+        """返回该发送者还需等待的秒数，0 表示可以发起"""
+        last = self._last_start.get(sender)
+        if last is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - last))
+
+    def touch(self, sender: str):
+        self._last_start[sender] = time.monotonic()
+        self._last_start.move_to_end(sender)
+        while len(self._last_start) > self.cooldown_capacity:
+            self._last_start.popitem(last=False)
+
+    def open(self, uid) -> QrTicket:
+        """登记一次扫码流程，同UID的旧流程被标记为已取代"""
+        uid = str(uid)
+        old = self._by_uid.get(uid)
+        if old is not None:
+            old.superseded.set()
+            self.close(old)
+        ticket = QrTicket(uid)
+        self._by_uid[uid] = ticket
+        self._waiting.append(ticket)
+        self._promote()
+        return ticket
+
+    def position(self, ticket: QrTicket) -> int:
+        """排队位置（从 1 开始），已开始或已结束返回 0"""
+        try:
+            return self._waiting.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    async def wait_turn(self, ticket: QrTicket, timeout: float) -> bool:
+        """等待轮到自己，被取代或等待超时返回 False"""
+        if ticket.admitted.done():
+            return True
+        stop = asyncio.create_task(ticket.superseded.wait())
+        try:
+            await asyncio.wait({ticket.admitted, stop}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop.cancel()
+        return ticket.admitted.done() and not ticket.superseded.is_set()
+
+    def close(self, ticket: QrTicket):
+        """流程结束（无论成功与否）时调用，空出的名额交给队首"""
+        if ticket in self._active:
+            self._active.remove(ticket)
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+        if self._by_uid.get(ticket.uid) is ticket:
+            del self._by_uid[ticket.uid]
+        if not ticket.admitted.done():
+            ticket.admitted.cancel()
+        self._promote()
+
+    def _promote(self):
+        while self._waiting and len(self._active) < self.max_active:
+            ticket = self._waiting.pop(0)
+            self._active.append(ticket)
+            ticket.admitted.set_result(True)
+
 
 # =========================
 # 插件主类（保持 MyPlugin 名称与方法签名）
 # =========================
 @register("astrbot_plugin_ql_bilibili_account_manager", "BUGJI", "将账号扫码登录到青龙的Bili任务执行器，需要青龙面板且安装BiliToolPro，不会配置可以看仓库", "v0.1.14514")
 class MyPlugin(Star):
+    # 排队等待扫码名额的最长时间（秒）
+    QR_QUEUE_TIMEOUT = 300
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         # 请不要肘击这里的代码，这些都设置了默认值
@@ -453,6 +3216,8 @@ class MyPlugin(Star):
         self.ql_panel_url = self.config.ql_config.get("ql_panel_url", "").rstrip("/")
         self.ql_client_id = self.config.ql_config.get("ql_client_id", "")
         self.ql_client_secret = self.config.ql_config.get("ql_client_secret", "")
+        # 主面板之外的其它面板，账号上限按面板分别计算
+        self.ql_extra_panels = parse_ql_panels(self.config.ql_config.get("ql_panels", "") or "")
         raw_mapping = self.config.slot_config.get("ql_env_mapping", "")
         try:
             # 你选择了严格模式（非法行会报错），这里保持 strict=True
@@ -464,16 +3229,114 @@ class MyPlugin(Star):
         self.max_account = int(self.config.slot_config.get("max_account", 10))
         self.logout_verify = bool(self.config.slot_config.get("logout_verify", True))
         self.test = bool(self.config.slot_config.get("test", False))
+        self.ql_env_cache_ttl = float(self.config.ql_config.get("ql_env_cache_ttl", 5))
+        self.ql_http2 = bool(self.config.ql_config.get("ql_http2", False))
+        # 多个 AstrBot 实例共用面板时，每批 Cookie 写入先在面板上获取租约
+        self.shared_panel = bool(self.config.advanced_config.get("shared_panel", False))
+        self.lease_max_wait = max(1.0, float(self.config.advanced_config.get("lease_max_wait", 15)))
+        self.qr_compact = bool(self.config.slot_config.get("qr_compact", True))
+        self.max_qr_sessions = int(self.config.slot_config.get("max_qr_sessions", 3))
+        self.qr_cooldown = float(self.config.slot_config.get("qr_cooldown", 30))
 
         # 业务客户端
-        self.bili = BiliClient()
-        self.ql = QinglongClient(self.ql_panel_url, self.ql_client_id, self.ql_client_secret)
+        advanced = self.config.advanced_config
+        self.bili_max_rps = max(AdaptiveRateLimiter.MIN_RPS, float(advanced.get("bili_max_rps", 5)))
+        self.qr_pool_size = max(0, int(self.config.slot_config.get("qr_pool_size", 1)))
+        self.bili = BiliClient(qr_compact=self.qr_compact, max_rps=self.bili_max_rps, qr_pool_size=self.qr_pool_size)
+        self.qr_spool = self._open_qr_spool(str(advanced.get("qr_spool_dir", "") or "").strip())
+        self.metrics_dump_path = str(advanced.get("metrics_dump_path", "") or "").strip()
+        self.metrics_dump_interval = max(5, int(advanced.get("metrics_dump_interval", 60)))
+        self._metrics_task: Optional[asyncio.Task] = None
+        self.warm_up = bool(advanced.get("warm_up", True))
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+        self.health_check = bool(advanced.get("health_check", True))
+        self.health_check_interval = max(60, int(advanced.get("health_check_interval", 30)) * 60)
+        self.health_check_max_age = max(0.0, float(advanced.get("health_check_max_age", 12)) * 3600)
+        self.health_check_concurrency = int(advanced.get("health_check_concurrency", 2))
+        self.cookie_refresh = bool(advanced.get("cookie_refresh", True))
+        self.cookie_refresh_interval = max(1.0, float(advanced.get("cookie_refresh_interval", 24))) * 3600
+        self.cookie_refresh_spacing = max(0.0, float(advanced.get("cookie_refresh_spacing", 2)))
+        # 小时，0 表示不定期整理
+        self.slot_reconcile_interval = max(0.0, float(advanced.get("slot_reconcile_interval", 6))) * 3600
+        # 秒，0 表示登录后不触发任务
+        self.task_trigger_delay = max(0.0, float(advanced.get("task_trigger_delay", 60)))
+        self.task_cron_keyword = str(advanced.get("task_cron_keyword", "") or "").strip() or "bili_task_daily"
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+        self.qr_sessions = QrSessionRegistry(self.max_qr_sessions, self.qr_cooldown)
+        data_dir = plugin_data_dir()
+        self.registry = AccountRegistry(
+            os.path.join(data_dir, "accounts.db"), legacy_json=os.path.join(data_dir, "account_state.json")
+        )
+        self._registry_task: Optional[asyncio.Task] = None
+        self.ql = QinglongPool(
+            [
+                QinglongClient(
+                    url, client_id, secret, env_cache_ttl=self.ql_env_cache_ttl, http2=self.ql_http2,
+                    shared=self.shared_panel, lease_wait=self.lease_max_wait,
+                )
+                for url, client_id, secret in [(self.ql_panel_url, self.ql_client_id, self.ql_client_secret)] + self.ql_extra_panels
+            ],
+            max_per_panel=self.max_account,
+            registry=self.registry,
+        )
+        # 所有面板合计的账号上限
+        self.account_capacity = self.max_account * len(self.ql.panels)
+        for panel in self.ql.panels:
+            panel.task_logs = TaskLogIndex(panel, self.task_cron_keyword)
+            if self.task_trigger_delay:
+                panel.task_trigger = TaskTrigger(panel, self.task_cron_keyword, self.task_trigger_delay)
+        self.health_checker = CookieHealthChecker(
+            self.bili, self.ql, self.registry,
+            interval=self.health_check_interval,
+            max_age=self.health_check_max_age,
+            concurrency=self.health_check_concurrency,
+        )
+        self.cookie_refresher = CookieRefresher(
+            self.bili, self.ql, self.registry,
+            check_age=self.cookie_refresh_interval,
+            spacing=self.cookie_refresh_spacing,
+        )
 
         
 
-        logger.info(f"BiliTool插件初始化完成，配置：青龙地址={self.ql_panel_url}，最大账号数={self.max_account}，测试模式={self.test}")
+        METRICS.gauge("bilitool_qr_sessions_active", lambda: self.qr_sessions.active)
+        METRICS.gauge("bilitool_qr_sessions_waiting", lambda: self.qr_sessions.waiting)
+        METRICS.gauge("bilitool_qr_polls_pending", lambda: self.bili.poller.pending)
+        METRICS.gauge("bilitool_qr_pool_ready", lambda: self.bili.qr_pool.ready)
+        METRICS.gauge("bilitool_qr_spool_files", lambda: self.qr_spool.files)
+        METRICS.gauge("bilitool_env_writes_queued", lambda: self.ql.queued)
+        METRICS.gauge("bilitool_circuits_open", lambda: BREAKERS.open_count)
+        METRICS.gauge("bilitool_bili_hold_seconds", lambda: self.bili.hold_left())
+        METRICS.gauge("bilitool_accounts_registered", lambda: self.registry.count())
+        METRICS.gauge("bilitool_accounts_dead", lambda: sum(1 for st in self.registry.all().values() if st.get("alive") is False))
+
+        logger.info(
+            f"BiliTool插件初始化完成，配置：青龙地址={self.ql_panel_url}（共 {len(self.ql.panels)} 个面板），"
+            f"每个面板最大账号数={self.max_account}，测试模式={self.test}"
+        )
 
     async def initialize(self):
+        self.qr_spool.start()
+        if not self.test:
+            self.bili.qr_pool.prime()
+        if self.warm_up:
+            # 不阻塞插件加载，预热在后台进行
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+        if self.metrics_dump_path:
+            self._metrics_task = asyncio.create_task(self._metrics_dump_loop())
+        if self.health_check and all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            self.health_checker.start()
+        if all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            self._registry_task = asyncio.create_task(self._registry_sync_loop())
+        if self.slot_reconcile_interval and all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            self._reconcile_task = asyncio.create_task(self._reconcile_loop())
+        if self.cookie_refresh and all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            if refresh_supported():
+                self.cookie_refresher.start()
+            else:
+                logger.warning("未安装 cryptography，Cookie自动刷新已关闭（pip install cryptography）")
         logger.info("BiliTool插件异步初始化完成")
 
     @filter.command_group("bilitool", alias={'哔哩哔哩账号管理'})
@@ -481,31 +3344,9 @@ class MyPlugin(Star):
         pass
 
     @bilitool.command("info", alias={'介绍'})
+    @tracked_command("info")
     async def info(self, event: AstrMessageEvent):
-        token = await self.ql.get_token()
-        count, _ = await self.count_bili_envs(token) if token else (0, [])
-
-        config_info = "暂无配置信息（青龙面板连接失败）"
-        if token:
-            all_envs = await self.ql.get_all_envs(token)
-            if all_envs:
-                lines = []
-                for env_name, desc in self.ql_env_mapping.items():
-                    value = "未配置"
-                    for env in all_envs:
-                        current_name = env.get("name", "")
-                        if isinstance(current_name, bytes):
-                            try:
-                                current_name = current_name.decode("utf-8", errors="ignore")
-                            except Exception:
-                                current_name = str(current_name)
-                        if current_name == env_name:
-                            value = env.get("value", "未配置")
-                            break
-                    lines.append(f"• {desc}：{value}")
-                config_info = "\n".join(lines)
-            else:
-                config_info = "暂无配置信息（未查询到青龙面板环境变量）"
+        count, health_info, config_info = await self._load_menu_status()
 
         info_msg = f"""此插件可以每天增加最多65经验，可以快速升级lv6
 
@@ -513,42 +3354,20 @@ class MyPlugin(Star):
 
 此工具使用的项目为rayWangQvQ/BiliBiliToolPro，您可以直接在本地/青龙部署此项目
 
-当前存储的账号数量：{count}/{self.max_account}
+当前存储的账号数量：{count}/{self.account_capacity}{health_info}
 {config_info}
         """
         yield event.plain_result(info_msg)
 
     @bilitool.command("help", alias={'帮助', 'helpme'})
+    @tracked_command("help")
     async def help(self, event: AstrMessageEvent):
-        token = await self.ql.get_token()
-        count, _ = await self.count_bili_envs(token) if token else (0, [])
-
-        config_info = "暂无配置信息（青龙面板连接失败）"
-        if token:
-            all_envs = await self.ql.get_all_envs(token)
-            if all_envs:
-                lines = []
-                for env_name, desc in self.ql_env_mapping.items():
-                    value = "未配置"
-                    for env in all_envs:
-                        current_name = env.get("name", "")
-                        if isinstance(current_name, bytes):
-                            try:
-                                current_name = current_name.decode("utf-8", errors="ignore")
-                            except Exception:
-                                current_name = str(current_name)
-                        if current_name == env_name:
-                            value = env.get("value", "未配置")
-                            break
-                    lines.append(f"• {desc}：{value}")
-                config_info = "\n".join(lines)
-            else:
-                config_info = "暂无配置信息（未查询到青龙面板环境变量）"
+        count, health_info, config_info = await self._load_menu_status()
 
         help_msg = f"""风险声明：此工具不能保证安全性，所有者可直接查看ck，可直接控制账号！
 此工具引用的开源项目为rayWangQvQ/BiliBiliToolPro，您可以直接在本地/青龙部署此项目
 
-当前存储的账号数量：{count}/{self.max_account}
+当前存储的账号数量：{count}/{self.account_capacity}{health_info}
 {config_info}
 
 注意：尖括号内的值<uid>只需要替换为数字即可
@@ -561,60 +3380,80 @@ BiliTool 帮助：
  登录Bili账号 /bilitool login <uid> 
  - 登录会申请一个登录二维码，扫码后请在手机端确认登录，如果提示地点请选择在自己设备登录
  登出Bili账号 /bilitool logout <uid> 
+ 任务状态 /bilitool status <uid>
+ - 查看账号最近一次每日任务的运行结果（经验、硬币、报错）
 
 所有者指令：
  删除账户 /bilitool forcelogout <uid>  
+ 导出账号 /bilitool export
+ 导入账号 /bilitool import <导出的文件名>
+ 整理账号变量 /bilitool reconcile [apply]
 """
         yield event.plain_result(help_msg)
 
     @bilitool.command("login", alias={'登录'})
+    @tracked_command("login")
     async def login(self, event: AstrMessageEvent, uid: int):
         qr_stream: Optional[BytesIO] = None
+        ticket: Optional[QrTicket] = None
+        bili_session = BiliSession()
         try:
             if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
                 yield event.plain_result("❌ 青龙面板配置不完整，请检查地址/Client ID/Client Secret")
                 return
 
-            token = await self.ql.get_token()
-            if not token:
-                yield event.plain_result("❌ 获取青龙面板访问令牌失败，请检查配置或网络")
+            sender = str(event.get_sender_id())
+            wait = self.qr_sessions.cooldown_left(sender)
+            if wait > 0:
+                yield event.plain_result(f"⏳ 操作太频繁，请 {int(wait) + 1} 秒后再试")
                 return
-
-            count, _ = await self.count_bili_envs(token)
-            if count >= self.max_account:
-                yield event.plain_result(f"❌ 当前账号数量已达上限：{count}/{self.max_account}，无法添加新账号")
+            hold = self.bili.hold_left()
+            if hold > 0:
+                yield event.plain_result(f"⏳ B站风控冷却中，请 {int(hold) + 1} 秒后再试")
                 return
 
             # 放在此处主要是可以验证上方的配置和流程是否正确
             if self.test:
-                yield event.plain_result(f"⚠️ 测试模式开启，跳出二维码登录流程，无法登录")
+                error = await self._check_capacity()
+                yield event.plain_result(error or f"⚠️ 测试模式开启，跳出二维码登录流程，无法登录")
                 return
 
+            self.qr_sessions.touch(sender)
+            ticket = self.qr_sessions.open(uid)
+            position = self.qr_sessions.position(ticket)
+            if position:
+                # 排队前先确认还能添加账号，免得排到了才告诉用户已满
+                error = await self._check_capacity()
+                if error:
+                    yield event.plain_result(error)
+                    return
+                yield event.plain_result(f"⏳ 当前扫码人数较多，您排在第 {position} 位，请稍候...")
+                if not await self.qr_sessions.wait_turn(ticket, self.QR_QUEUE_TIMEOUT):
+                    yield event.plain_result("❌ 排队已取消（超时或该UID发起了新的请求）")
+                    return
+
             yield event.plain_result(f"📱 正在为UID {uid} 生成登录二维码，请稍候...")
-            oauth_key, qr_stream = await self.bili.generate_qrcode()
+            # 令牌、账号数和二维码互不依赖，同时进行；二维码通常直接从预生成池取
+            error, (oauth_key, qr_stream) = await asyncio.gather(self._check_capacity(), self.bili.qr_pool.take())
+            if error:
+                if oauth_key and qr_stream:
+                    self.bili.qr_pool.put_back(oauth_key, qr_stream)
+                yield event.plain_result(error)
+                return
             if not oauth_key or not qr_stream:
-                yield event.plain_result("❌ 生成二维码失败，请重试")
+                hold = self.bili.hold_left()
+                yield event.plain_result(f"⏳ B站风控冷却中，请 {int(hold) + 1} 秒后再试" if hold > 0 else "❌ 生成二维码失败，请重试")
                 return
 
-            data = qr_stream.getvalue()
-            tmp_path = None # 代码作用域锁定
-
-            # 写入临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                tmp.write(data)
-                tmp_path = tmp.name
-
-            # 用文件路径发送图片
-            yield event.image_result(tmp_path)
-            if tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
-            
-            # 说缓存的那个我问你，放到下面会发生什么，你知道吗
-            # cannot access local variable 'tmp_path' where it is not associated with a value
-            # 知道为什么吗，是你让我改在这的，你去修理，然后让我这个兼顾测试和这坨代码的多睡会，第二天如果我看见你给这玩意塞到全局变量你就等着我往仓库里拉屎吧
-            
+            # 用文件路径发送图片；文件由 qr_spool 延迟清理，适配器延后上传也读得到
+            image_path = await self.qr_spool.put(qr_stream.getvalue())
+            yield event.image_result(image_path)
             yield event.plain_result(f"✅ 请使用B站APP扫描上方二维码登录（2分钟内有效）")
 
-            cookies = await self.bili.check_qrcode_status(oauth_key)
+            cookies, superseded = await self._wait_for_scan(ticket, oauth_key, bili_session)
+            if superseded:
+                yield event.plain_result("⚠️ 该UID发起了新的登录请求，本次二维码已作废")
+                return
             if not cookies:
                 yield event.plain_result("❌ 二维码登录失败（超时/过期/取消）")
                 return
@@ -631,20 +3470,83 @@ BiliTool 帮助：
             
             success, msg = await self.ql.save_cookie_to_qinglong(cookies, uid)
             if success:
-                new_count, _ = await self.count_bili_envs(token)
+                # 刚扫码得到的 Cookie 必然有效，记为已检测，健康检测无需马上再查；
+                # 旧的 refresh_token 和待写回的刷新结果都随新登录作废
+                now = time.time()
+                self.registry.remove(uid)
+                self.registry.update(
+                    uid, alive=True, checked_at=now,
+                    refresh_token=bili_session.refresh_token, refresh_checked_at=now,
+                )
+                self.registry.record_login(uid, event.get_sender_id())
+                await self.registry.save()
+                if self.ql.schedule_task_run(uid):
+                    msg += f"\n⏳ 约 {self.task_trigger_delay:g} 秒后面板会运行一次每日任务，不用等定时运行（任务正在运行时等下次定时运行）"
                 yield event.plain_result(f"✅ {msg}")
             else:
                 yield event.plain_result(f"❌ 保存Cookie失败：{msg}")
         finally:
+            if ticket:
+                self.qr_sessions.close(ticket)
             if qr_stream:
                 try:
                     qr_stream.close()
                 except Exception:
                     pass
 
+    @bilitool.command("status", alias={'任务状态'})
+    @tracked_command("status")
+    async def status(self, event: AstrMessageEvent, uid: int):
+        if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            yield event.plain_result("❌ 青龙面板配置不完整")
+            return
+        if not self.ql.local():
+            await self.ql.get_env_snapshot()
+        account = self.registry.find(uid)
+        if account is None:
+            yield event.plain_result(f"❌ 未找到UID {uid} 的账号，请先 /bilitool login {uid}")
+            return
+
+        lines = [f"📋 UID {uid}（{account['name']}）"]
+        if account["added_at"]:
+            lines.append(f"登录时间：{time.strftime('%Y-%m-%d %H:%M', time.localtime(account['added_at']))}")
+        state = account["state"]
+        if state.get("alive") is False:
+            lines.append("⚠️ Cookie已失效，请重新登录")
+        elif state.get("checked_at"):
+            lines.append(f"Cookie有效（{time.strftime('%m-%d %H:%M', time.localtime(state['checked_at']))} 检测）")
+
+        result, error = None, None
+        try:
+            result = await self.ql.task_log(uid)
+        except CircuitOpenError:
+            error = "青龙面板暂时无法连接"
+        except Exception as e:
+            logger.warning(f"读取BiliTool运行日志失败：{e}")
+            error = str(e)
+        if error:
+            lines.append(f"❌ 读取任务日志失败：{error}")
+        elif result is None:
+            lines.append("面板上还没有每日任务的运行记录")
+        else:
+            cron, section = result
+            started = time.strftime("%m-%d %H:%M", time.localtime(cron.get("last_execution_time") or 0))
+            running = cron.get("status") in TaskTrigger.BUSY_STATUS
+            lines.append(f"最近一次运行：{started}{'（运行中）' if running else ''}")
+            if section is None:
+                lines.append("这次运行的日志里没有找到该账号（可能是运行之后才登录的）")
+            else:
+                picked = summarize_task_log(section)
+                lines.extend(f"• {line}" for line in picked)
+                if not picked:
+                    lines.append("日志中没有经验/硬币相关的记录")
+        yield event.plain_result("\n".join(lines))
+
     @bilitool.command("logout", alias={'删除'})
+    @tracked_command("logout")
     async def logout(self, event: AstrMessageEvent, uid: int):
         qr_stream: Optional[BytesIO] = None
+        ticket: Optional[QrTicket] = None
         try:
             if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
                 yield event.plain_result("❌ 青龙面板配置不完整")
@@ -655,26 +3557,40 @@ BiliTool 帮助：
                     yield event.plain_result(f"⚠️ 测试模式开启，跳出二维码验证，删除失败")
                     return
 
+                sender = str(event.get_sender_id())
+                wait = self.qr_sessions.cooldown_left(sender)
+                if wait > 0:
+                    yield event.plain_result(f"⏳ 操作太频繁，请 {int(wait) + 1} 秒后再试")
+                    return
+                hold = self.bili.hold_left()
+                if hold > 0:
+                    yield event.plain_result(f"⏳ B站风控冷却中，请 {int(hold) + 1} 秒后再试")
+                    return
+                self.qr_sessions.touch(sender)
+                ticket = self.qr_sessions.open(uid)
+                position = self.qr_sessions.position(ticket)
+                if position:
+                    yield event.plain_result(f"⏳ 当前扫码人数较多，您排在第 {position} 位，请稍候...")
+                    if not await self.qr_sessions.wait_turn(ticket, self.QR_QUEUE_TIMEOUT):
+                        yield event.plain_result("❌ 排队已取消（超时或该UID发起了新的请求）")
+                        return
+
                 yield event.plain_result(f"📱 请扫码验证身份以删除UID {uid} 的账号（仅验证身份，无实际登录）")
-                oauth_key, qr_stream = await self.bili.generate_qrcode()
+                oauth_key, qr_stream = await self.bili.qr_pool.take()
                 if not oauth_key or not qr_stream:
-                    yield event.plain_result("❌ 生成验证二维码失败")
+                    hold = self.bili.hold_left()
+                    yield event.plain_result(f"⏳ B站风控冷却中，请 {int(hold) + 1} 秒后再试" if hold > 0 else "❌ 生成验证二维码失败")
                     return
 
-                data = qr_stream.getvalue()
-                tmp_path = None # 代码作用域锁定
-
-                # 写入临时文件
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                    tmp.write(data)
-                    tmp_path = tmp.name
-
                 # 用文件路径发送图片
-                yield event.image_result(tmp_path)
-                if tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
+                image_path = await self.qr_spool.put(qr_stream.getvalue())
+                yield event.image_result(image_path)
                 yield event.plain_result("✅ 请使用B站APP扫描上方二维码验证身份（2分钟内有效）")
                 
-                cookies = await self.bili.check_qrcode_status(oauth_key)
+                cookies, superseded = await self._wait_for_scan(ticket, oauth_key)
+                if superseded:
+                    yield event.plain_result("⚠️ 该UID发起了新的请求，本次验证二维码已作废")
+                    return
                 if not cookies:
                     yield event.plain_result("❌ 身份验证失败（超时/过期/取消）")
                     return
@@ -689,11 +3605,14 @@ BiliTool 帮助：
             token = await self.ql.get_token()
             success, msg = await self.ql.delete_bili_cookie(token, uid)
             if success:
-                new_count, _ = await self.count_bili_envs(token) if token else (0, [])
+                self.registry.remove(uid)
+                await self.registry.save()
                 yield event.plain_result(f"✅ {msg}")
             else:
                 yield event.plain_result(f"❌ {msg}")
         finally:
+            if ticket:
+                self.qr_sessions.close(ticket)
             if qr_stream:
                 try:
                     qr_stream.close()
@@ -702,6 +3621,7 @@ BiliTool 帮助：
 
     @filter.permission_type(filter.PermissionType.ADMIN)
     @bilitool.command("forcelogout", alias={'由所有者直接删除账户'})
+    @tracked_command("forcelogout")
     async def forcelogout(self, event: AstrMessageEvent, uid: int):
         if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
             yield event.plain_result("❌ 青龙面板配置不完整")
@@ -710,39 +3630,406 @@ BiliTool 帮助：
         token = await self.ql.get_token()
         success, msg = await self.ql.delete_bili_cookie(token, uid)
         if success:
+            self.registry.remove(uid)
+            await self.registry.save()
             new_count, _ = await self.count_bili_envs(token) if token else (0, [])
-            yield event.plain_result(f"✅ {msg}\n当前账号数量：{new_count}/{self.max_account}")
+            yield event.plain_result(f"✅ {msg}\n当前账号数量：{new_count}/{self.account_capacity}")
         else:
             yield event.plain_result(f"❌ {msg}")
 
-    async def count_bili_envs(self, token: str) -> Tuple[int, List[Dict]]:
-        if not token:
-            logger.error("统计B站账号失败：未获取到青龙令牌")
-            return 0, []
-
-        all_envs = await self.ql.get_all_envs(token)
-        bili_envs = []
-        for env in all_envs:
-            name = env.get("name", "")
-            if isinstance(name, bytes):
-                try:
-                    name = name.decode("utf-8", errors="ignore")
-                except Exception:
-                    name = str(name)
-            if name.startswith(CHECK_PREFIX):
-                bili_envs.append(env)
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @bilitool.command("export", alias={'导出账号'})
+    @tracked_command("export")
+    async def export_accounts(self, event: AstrMessageEvent):
+        """把所有面板中的账号 Cookie（连同 refresh_token）导出到插件数据目录"""
+        if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            yield event.plain_result("❌ 青龙面板配置不完整")
+            return
+
+        try:
+            envs = await self.ql.get_env_snapshot(force_refresh=True, strict=True)
+        except Exception as e:
+            yield event.plain_result(f"❌ 读取青龙环境变量失败：{e}")
+            return
+        bili_envs = sorted([e for e in envs if env_name(e).startswith(CHECK_PREFIX)], key=env_slot)
+        accounts = []
+        for env in bili_envs:
+            uid = env_uid(env) or parse_cookie_string(str(env.get("value", ""))).get("DedeUserID", "")
+            if not uid:
+                continue
+            accounts.append({
+                "uid": uid,
+                "cookie": str(env.get("value", "")),
+                "refresh_token": self.registry.get(uid).get("refresh_token", ""),
+            })
+
+        filename = time.strftime("bili_cookies_%Y%m%d_%H%M%S.json")
+        path = os.path.join(self._export_dir(), filename)
+        try:
+            await asyncio.to_thread(self._write_private_file, path, dump_account_export(accounts))
+        except Exception as e:
+            logger.error(f"写入导出文件失败：{e}", exc_info=True)
+            yield event.plain_result(f"❌ 写入导出文件失败：{e}")
+            return
+
+        down = [url for url, count in await self.ql.shard_status() if count is None]
+        msg = f"✅ 已导出 {len(accounts)} 个账号到：{path}\n文件包含可直接登录的Cookie，请妥善保管，导入：bilitool import {filename}"
+        if down:
+            msg += f"\n⚠️ 以下面板暂时无法连接，其中的账号未导出：{'、'.join(down)}"
+        yield event.plain_result(msg)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @bilitool.command("import", alias={'导入账号'})
+    @tracked_command("import")
+    async def import_accounts(self, event: AstrMessageEvent, filename: str):
+        """
+        从导出目录中的文件恢复账号。所有账号同时提交给写入器，
+        每个面板合并为一次快照读取、一次 POST 和必要的 PUT（更新已有账号）。
+        """
+        if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            yield event.plain_result("❌ 青龙面板配置不完整")
+            return
+
+        # 只允许读取导出目录中的文件
+        path = os.path.join(self._export_dir(), os.path.basename(filename.strip()))
+        try:
+            text = await asyncio.to_thread(self._read_text_file, path)
+            accounts = load_account_export(text)
+        except FileNotFoundError:
+            files = sorted(f for f in os.listdir(self._export_dir()) if f.endswith(".json"))[-5:]
+            yield event.plain_result(f"❌ 导出目录中没有文件 {os.path.basename(filename)}，最近的导出：{'、'.join(files) or '无'}")
+            return
+        except ValueError as e:
+            yield event.plain_result(f"❌ 导入文件格式错误：{e}")
+            return
+
+        valid, failed = [], []
+        for item in accounts:
+            cookies = parse_cookie_string(item["cookie"])
+            ok, msg = await self.bili.validate_cookie(cookies)
+            if ok and str(cookies.get("DedeUserID")) != item["uid"]:
+                ok, msg = False, "Cookie中的UID与记录不一致"
+            if ok:
+                valid.append((item, cookies))
+            else:
+                failed.append(f"UID {item['uid']}：{msg}")
+
+        yield event.plain_result(f"📦 读取到 {len(accounts)} 个账号，正在批量写入青龙面板...")
+        results = await asyncio.gather(*[self.ql.save_cookie_to_qinglong(cookies, int(item["uid"])) for item, cookies in valid])
+
+        imported = 0
+        for (item, _), (success, msg) in zip(valid, results):
+            if not success:
+                failed.append(f"UID {item['uid']}：{msg}")
+                continue
+            imported += 1
+            # 导入的 Cookie 状态未知，不记检测时间，让健康检测尽快检查
+            self.registry.remove(item["uid"])
+            if item["refresh_token"]:
+                self.registry.update(item["uid"], refresh_token=item["refresh_token"])
+            self.registry.record_login(item["uid"], event.get_sender_id())
+            self.ql.schedule_task_run(item["uid"])
+        await self.registry.save()
+
+        msg = f"✅ 导入完成：成功 {imported} 个，失败 {len(failed)} 个"
+        if failed:
+            msg += "\n" + "\n".join(f"• {line}" for line in failed[:10])
+            if len(failed) > 10:
+                msg += f"\n……其余 {len(failed) - 10} 个见日志"
+                logger.warning("导入失败的账号：" + "；".join(failed))
+        yield event.plain_result(msg)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @bilitool.command("reconcile", alias={'整理账号'})
+    @tracked_command("reconcile")
+    async def reconcile(self, event: AstrMessageEvent, mode: str = ""):
+        """整理各面板的 Cookie 变量名；默认只预览，bilitool reconcile apply 才真正执行"""
+        if not all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            yield event.plain_result("❌ 青龙面板配置不完整")
+            return
+        dry_run = mode.strip().lower() not in ("apply", "执行")
+        lines = ["🔍 整理预览（未执行，确认后发送 bilitool reconcile apply）：" if dry_run else "🧹 整理结果："]
+        for url, ok, msg in await self.ql.reconcile(dry_run):
+            prefix = f"【{url}】" if len(self.ql.panels) > 1 else ""
+            lines.append(f"{prefix}{msg}" if ok else f"{prefix}❌ {msg}")
+        yield event.plain_result("\n".join(lines))
+
+    async def _registry_sync_loop(self):
+        """
+        定期读取一次面板快照，让本地账号登记在没有命令时也保持新鲜，
+        面板上手动的改动最迟在这个间隔后反映到登记中；快照没变化时不写数据库
+        """
+        METRICS.attach_command(None)
+        while True:
+            try:
+                await self.ql.get_env_snapshot()
+            except Exception as e:
+                logger.error(f"同步本地账号登记异常：{e}", exc_info=True)
+            await asyncio.sleep(AccountRegistry.MAX_AGE / 2)
+
+    async def _reconcile_loop(self):
+        """定期整理 Cookie 变量，修复面板上手动改动或其它实例留下的缺号和重复"""
+        while True:
+            await asyncio.sleep(self.slot_reconcile_interval)
+            try:
+                for url, ok, msg in await self.ql.reconcile():
+                    if not ok:
+                        logger.warning(f"定期整理青龙Cookie变量失败（{url}）：{msg}")
+                    elif msg != "无需整理":
+                        logger.info(f"定期整理青龙Cookie变量（{url}）：\n{msg}")
+            except Exception as e:
+                logger.error(f"定期整理青龙Cookie变量异常：{e}", exc_info=True)
+
+    @staticmethod
+    def _open_qr_spool(path: str) -> QrImageSpool:
+        """二维码图片目录，未配置或无法创建时使用插件数据目录下的 qr_spool"""
+        default = os.path.join(plugin_data_dir(), "qr_spool")
+        if path:
+            try:
+                return QrImageSpool(path)
+            except OSError as e:
+                logger.warning(f"二维码图片目录 {path} 不可用，改用 {default}：{e}")
+        return QrImageSpool(default)
+
+    def _export_dir(self) -> str:
+        path = os.path.join(plugin_data_dir(), "exports")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def _write_private_file(path: str, text: str):
+        # 文件里是可直接登录的 Cookie，只允许当前用户读写
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    @staticmethod
+    def _read_text_file(path: str) -> str:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @bilitool.command("stats", alias={'统计'})
+    @tracked_command("stats")
+    async def stats(self, event: AstrMessageEvent):
+        yield event.plain_result(self._render_stats())
+
+    def _render_stats(self) -> str:
+        m = METRICS
+        uptime = int(time.time() - m.started_at)
+        lines = [f"📊 BiliTool 运行统计（已运行 {uptime // 3600}时{uptime % 3600 // 60}分）"]
+
+        lines.append("\n命令：次数 / 失败 / p50 / p99 / 每次面板请求 / 每次B站请求")
+        for (name, labels), h in sorted(m.histograms.items()):
+            if name != "bilitool_command_seconds":
+                continue
+            count = h["count"]
+            errors = int(m.counters.get(("bilitool_command_errors_total", labels), 0))
+            per = {
+                target: m.counters.get(("bilitool_command_http_requests_total", labels + (("target", target),)), 0) / count
+                for target in ("qinglong", "bilibili")
+            }
+            lines.append(
+                f"• {labels[0][1]}：{count} / {errors} / "
+                f"{m.percentile(name, labels, 50) * 1000:.0f}ms / {m.percentile(name, labels, 99) * 1000:.0f}ms / "
+                f"{per['qinglong']:.2f} / {per['bilibili']:.2f}"
+            )
+
+        lines.append("\n外部请求：次数 / 错误率 / p50 / p99")
+        for (name, labels), h in sorted(m.histograms.items()):
+            if name != "bilitool_http_request_seconds":
+                continue
+            d = dict(labels)
+            errors = m.counters.get(("bilitool_http_errors_total", labels), 0)
+            lines.append(
+                f"• {d['target']} {d['method']} {d['endpoint']}：{h['count']} / {errors / h['count']:.1%} / "
+                f"{m.percentile(name, labels, 50) * 1000:.0f}ms / {m.percentile(name, labels, 99) * 1000:.0f}ms"
+            )
+
+        for (name, labels), h in sorted(m.histograms.items()):
+            if name == "bilitool_qr_render_seconds":
+                lines.append(
+                    f"\n二维码渲染（{labels[0][1]}）：{h['count']} 次，线程池累计 {h['sum'] * 1000:.0f}ms，"
+                    f"平均 {h['sum'] / h['count'] * 1000:.1f}ms"
+                )
+
+        refresh = {
+            dict(labels)["result"]: int(v) for (name, labels), v in m.counters.items()
+            if name == "bilitool_cookie_refresh_total"
+        }
+        if refresh:
+            lines.append(
+                f"\nCookie自动刷新：成功 {refresh.get('ok', 0)} / 失败 {refresh.get('failed', 0)} / "
+                f"无需刷新 {refresh.get('skipped', 0)}"
+            )
+
+        lease = {
+            dict(labels)["result"]: int(v) for (name, labels), v in m.counters.items()
+            if name == "bilitool_lease_total"
+        }
+        if lease.get("contended") or lease.get("timeout") or lease.get("lost"):
+            lines.append(
+                f"\n写入租约：直接获取 {lease.get('acquired', 0)} / 等待后获取 {lease.get('contended', 0)} / "
+                f"等待超时 {lease.get('timeout', 0)} / 被接管 {lease.get('lost', 0)}，"
+                f"等待 p99 {m.percentile('bilitool_lease_wait_seconds', (), 99) * 1000:.0f}ms"
+            )
+
+        if self.bili.limiters:
+            lines.append("\nB站限速：当前速率 / 上限 / 风控次数 / 暂停新会话")
+            for host, limiter in sorted(self.bili.limiters.items()):
+                strikes = int(m.counters.get(("bilitool_bili_risk_control_total", (("host", host),)), 0))
+                hold = limiter.hold_left
+                lines.append(
+                    f"• {host}：{limiter.current_rate:.2f} / {limiter.max_rps:g} 次/秒 / {strikes} / "
+                    + (f"剩余 {int(hold) + 1} 秒" if hold > 0 else "否")
+                )
 
-        def extract_num(name: str) -> int:
+        tripped = [(host, b) for host, b in BREAKERS.items() if b.state != "closed"]
+        if tripped:
+            lines.append("\n熔断中的主机：")
+            for host, b in tripped:
+                left = max(0, int(b.reset_timeout - (time.monotonic() - b.opened_at)))
+                state = "探测中" if b.state == "half_open" else f"{left} 秒后探测"
+                rejected = int(m.counters.get(("bilitool_circuit_rejected_total", (("host", host),)), 0))
+                lines.append(f"• {host}：{state}，已拒绝 {rejected} 次请求")
+
+        lines.append("\n当前状态：")
+        for name, fn in sorted(m.gauges.items()):
             try:
-                return int(name.split("__")[-1])
+                lines.append(f"• {name}：{fn():g}")
             except Exception:
-                return 99999
+                pass
+        return "\n".join(lines)
+
+    async def _warm_up(self):
+        """
+        后台预热，让重启后的第一条命令不再承担这些开销：
+        二维码渲染依赖的导入和首次渲染、面板令牌、Cookie 变量快照和映射变量、与B站扫码接口的建连。
+        """
+        METRICS.attach_command(None)
+        start = time.perf_counter()
+        jobs = [
+            asyncio.to_thread(_render_qr, "https://passport.bilibili.com/warm-up", self.qr_compact),
+            self.bili.warm_up(),
+        ]
+        if all([self.ql_panel_url, self.ql_client_id, self.ql_client_secret]):
+            jobs += [self.ql.get_token(), self.ql.get_env_snapshot(), self.ql.get_env_values(list(self.ql_env_mapping))]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.debug(f"预热步骤失败：{result}")
+        logger.info(f"BiliTool预热完成，用时 {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    async def _metrics_dump_loop(self):
+        """定期把指标以 Prometheus 文本格式写入文件，先写临时文件再替换，避免读到半截内容"""
+        while True:
+            await asyncio.sleep(self.metrics_dump_interval)
+            try:
+                text = METRICS.render_prometheus()
+                await asyncio.to_thread(self._write_metrics_file, text)
+            except Exception as e:
+                logger.error(f"写入指标文件失败：{e}")
+
+    def _write_metrics_file(self, text: str):
+        tmp = f"{self.metrics_dump_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, self.metrics_dump_path)
+
+    async def _wait_for_scan(self, ticket: QrTicket, oauth_key: str, session: Optional[BiliSession] = None) -> Tuple[Optional[Dict], bool]:
+        """等待扫码结果，返回 (cookies, 是否被同UID的新请求取代)"""
+        scan = asyncio.create_task(self.bili.check_qrcode_status(oauth_key, session=session))
+        stop = asyncio.create_task(ticket.superseded.wait())
+        try:
+            await asyncio.wait({scan, stop}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (scan, stop):
+                if not task.done():
+                    task.cancel()
+        if ticket.superseded.is_set():
+            return None, True
+        return scan.result(), False
+
+    async def _load_menu_status(self) -> Tuple[int, str, str]:
+        """
+        info/help 共用：返回 (当前账号数量, 失效账号提示, 环境变量映射展示文本)。
+        账号统计查本地账号登记（登记过期时读取一次 Cookie 变量快照），映射展示只按名字并发读取映射的变量，
+        面板上其它无关变量不拉取；
+        失效账号来自后台健康检测的本地记录，不产生在线请求。
+        """
+        token = await self.ql.get_token()
+        if not token:
+            return 0, "", "暂无配置信息（青龙面板连接失败）"
+
+        (count, accounts), values = await asyncio.gather(
+            self.count_bili_envs(token), self.ql.get_env_values(list(self.ql_env_mapping))
+        )
+        health_info = await self._format_shards() + self._format_dead_accounts(accounts)
+        if self.ql_env_mapping and not values:
+            return count, health_info, "暂无配置信息（未查询到青龙面板环境变量）"
+
+        lines = []
+        for name, desc in self.ql_env_mapping.items():
+            value = values.get(name)
+            lines.append(f"• {desc}：{'未配置' if value is None else value}")
+        return count, health_info, "\n".join(lines)
+
+    async def _format_shards(self) -> str:
+        """多面板时展示每个面板的账号数，读取的是同一份快照，不产生额外请求"""
+        if len(self.ql.panels) < 2:
+            return ""
+        lines = []
+        for url, count in await self.ql.shard_status():
+            state = "暂时无法连接" if count is None else f"{count}/{self.max_account}"
+            lines.append(f"• {url}：{state}")
+        return "\n各面板账号数：\n" + "\n".join(lines)
+
+    def _format_dead_accounts(self, accounts: List[Dict]) -> str:
+        dead = []
+        for account in accounts:
+            state = account["state"]
+            if state.get("alive") is False:
+                checked = time.strftime("%m-%d %H:%M", time.localtime(state.get("checked_at", 0)))
+                dead.append(f"• {account['name']}（UID {account['uid']}，{checked} 检测）")
+        if not dead:
+            return ""
+        return "\n⚠️ 以下账号Cookie已失效，请重新登录：\n" + "\n".join(dead)
+
+    async def _check_capacity(self) -> Optional[str]:
+        """login 前的检查：能拿到面板令牌且账号未满时返回 None，否则返回提示文本"""
+        token, (count, _) = await asyncio.gather(self.ql.get_token(), self.count_bili_envs())
+        if not token:
+            return "❌ 获取青龙面板访问令牌失败，请检查配置或网络"
+        if count >= self.account_capacity:
+            return f"❌ 当前账号数量已达上限：{count}/{self.account_capacity}，无法添加新账号"
+        return None
 
-        bili_envs.sort(key=lambda x: extract_num(str(x.get("name", ""))))
-        logger.info(f"当前B站账号数量：{len(bili_envs)}/{self.max_account}")
-        return len(bili_envs), bili_envs
+    async def count_bili_envs(self, token: Optional[str] = None) -> Tuple[int, List[Dict]]:
+        """
+        返回 (账号数, 本地登记中的账号列表)。登记过期时先读一次面板快照（读取会同步登记），
+        否则直接查本地。账号数是面板上的 Cookie 变量数，包括手动添加、登记里对不上 UID 的变量。
+        token 参数仅为兼容旧调用保留。
+        """
+        if not self.ql.local():
+            await self.ql.get_env_snapshot()
+        count = self.registry.count()
+        logger.info(f"当前B站账号数量：{count}/{self.account_capacity}")
+        return count, self.registry.accounts()
 
     async def terminate(self):
+        for task in (self._warm_up_task, self._metrics_task, self._registry_task, self._reconcile_task):
+            if task and not task.done():
+                task.cancel()
+        await self.qr_spool.close()
+        try:
+            await self.cookie_refresher.close()
+            await self.health_checker.close()
+        except Exception:
+            logger.error("Cookie健康检测模块未正常关闭")
+        try:
+            await self.registry.close()
+        except Exception:
+            logger.error("账号登记未正常关闭")
         # 关闭异步客户端
         try:
             await self.bili.close()
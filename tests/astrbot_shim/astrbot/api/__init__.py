@@ -0,0 +1,15 @@
+"""
+测试用的 astrbot.api 最小替身：只提供插件导入时用到的名字。
+装有 AstrBot 时 conftest 不会加载它，直接使用真实的 astrbot。
+"""
+import logging
+
+logger = logging.getLogger("astrbot")
+
+
+class AstrBotConfig(dict):
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
@@ -0,0 +1,47 @@
+class MessageEventResult:
+    pass
+
+
+class AstrMessageEvent:
+    def __init__(self, sender: str = "user"):
+        self.sender = sender
+
+    def get_sender_id(self) -> str:
+        return self.sender
+
+    def plain_result(self, text: str):
+        return text
+
+    def image_result(self, path: str):
+        return path
+
+
+class _CommandGroup:
+    """指令组：组内指令装饰后仍是原来的方法，测试里直接调用"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def command(self, *args, **kwargs):
+        return lambda func: func
+
+    def group(self, *args, **kwargs):
+        return lambda func: _CommandGroup(func)
+
+
+class filter:
+    class PermissionType:
+        ADMIN = "admin"
+        MEMBER = "member"
+
+    @staticmethod
+    def command_group(*args, **kwargs):
+        return lambda func: _CommandGroup(func)
+
+    @staticmethod
+    def command(*args, **kwargs):
+        return lambda func: func
+
+    @staticmethod
+    def permission_type(*args, **kwargs):
+        return lambda func: func
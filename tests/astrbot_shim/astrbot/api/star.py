@@ -0,0 +1,11 @@
+class Context:
+    pass
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+
+def register(*args, **kwargs):
+    return lambda cls: cls
@@ -0,0 +1,100 @@
+"""
+测试共用的桩环境：本地青龙/B站桩服务 + 指向它们的 MyPlugin。
+
+插件依赖 astrbot.api，没有 AstrBot 环境时使用 tests/astrbot_shim 中的最小替身。
+测试不依赖 pytest-asyncio，每个用例用 asyncio.run 跑自己的协程。
+"""
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+try:
+    import astrbot.api  # noqa: F401
+except ImportError:
+    # 没有 AstrBot 时用 tests/astrbot_shim 里的最小替身，用例照常运行
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "astrbot_shim"))
+
+import main  # noqa: E402
+from load_bench import BenchConfig, BenchEvent, drive, route_bilibili  # noqa: E402
+from stub_servers import BiliStub, QinglongStub, ScanScript  # noqa: E402
+
+
+@pytest.fixture
+def stub_plugin(tmp_path, monkeypatch):
+    """
+    返回一个异步上下文管理器工厂：
+        async with stub_plugin(panels=1, max_account=10) as (plugin, stubs, bili): ...
+    插件数据目录指向 tmp_path，二维码轮询间隔调小，健康检测/自动刷新/任务触发不在后台运行。
+    """
+    data_dir = str(tmp_path / "plugin_data")
+    os.makedirs(data_dir, exist_ok=True)
+    monkeypatch.setattr(main, "plugin_data_dir", lambda: data_dir)
+    monkeypatch.setattr(main.QrPollScheduler, "IDLE_INTERVAL", 0.2)
+    monkeypatch.setattr(main.QrPollScheduler, "SCANNED_INTERVAL", 0.1)
+
+    @asynccontextmanager
+    async def build(panels: int = 1, max_account: int = 50, advanced=None, latency: float = 0.0):
+        bili = BiliStub(latency=latency)
+        stubs = [QinglongStub(latency=latency) for _ in range(panels)]
+        await bili.start()
+        for stub in stubs:
+            await stub.start()
+        config = BenchConfig(
+            ql_config={
+                "ql_panel_url": stubs[0].url,
+                "ql_client_id": stubs[0].client_id,
+                "ql_client_secret": stubs[0].client_secret,
+                "ql_panels": "\n".join(f"{s.url};{s.client_id};{s.client_secret}" for s in stubs[1:]),
+            },
+            slot_config={
+                "max_account": max_account,
+                "logout_verify": True,
+                "test": False,
+                "max_qr_sessions": 100,
+                "qr_cooldown": 0,
+                "qr_pool_size": 0,
+            },
+            advanced_config={
+                "health_check": False, "cookie_refresh": False, "bili_max_rps": 1000,
+                "task_trigger_delay": 0, **(advanced or {}),
+            },
+        )
+        plugin = main.MyPlugin(None, config)
+        await route_bilibili(plugin, bili.url)
+        plugin.bili.poller.max_rps = 1000
+        bili.render = lambda url: main._render_qr(url, plugin.bili.qr_compact).getvalue()
+        await plugin.initialize()
+        try:
+            yield plugin, stubs, bili
+        finally:
+            await plugin.terminate()
+            await bili.stop()
+            for stub in stubs:
+                await stub.stop()
+
+    return build
+
+
+def cookie_envs(stubs):
+    """所有桩面板上插件写入的 Cookie 变量"""
+    return [e for stub in stubs for e in stub.envs if e["name"].startswith(main.CHECK_PREFIX)]
+
+
+async def login(plugin, bili, uid, scan_after: float = 0.05, confirm_after: float = 0.05) -> BenchEvent:
+    """模拟一个用户发起 login 并按脚本扫码确认，返回记录了回复的事件"""
+    event = BenchEvent(f"user{uid}", bili, ScanScript(str(uid), scan_after, confirm_after))
+    await drive(plugin.login(event, int(uid)), event)
+    return event
+
+
+async def logout(plugin, bili, uid, scan_after: float = 0.05, confirm_after: float = 0.05) -> BenchEvent:
+    """模拟一个用户扫码验证后退出登录"""
+    event = BenchEvent(f"user{uid}", bili, ScanScript(str(uid), scan_after, confirm_after))
+    await drive(plugin.logout(event, int(uid)), event)
+    return event
@@ -0,0 +1,66 @@
+"""命令指标：只有命令代码自己发出的请求归属命令，yield 之后调用方发出的请求不算"""
+import asyncio
+
+import main
+from load_bench import BenchEvent, drive
+
+
+def command_requests(name):
+    return {
+        dict(labels)["target"]: int(value)
+        for (metric, labels), value in main.METRICS.counters.items()
+        if metric == "bilitool_command_http_requests_total" and dict(labels)["command"] == name
+    }
+
+
+def commands_total(name):
+    return int(main.METRICS.counters.get(("bilitool_commands_total", (("command", name),)), 0))
+
+
+@main.tracked_command("probe")
+async def probe(steps: int = 2):
+    for i in range(steps):
+        main.METRICS.record_http("panel", "GET", "/open/envs", 200, 0.01)
+        yield i
+
+
+def test_requests_between_yields_are_not_attributed():
+    before = command_requests("probe").get("panel", 0)
+
+    async def scenario():
+        async for _ in probe():
+            # AstrBot 流水线在两次 yield 之间发送消息等，不属于命令
+            assert main.METRICS.current_command() is None
+            main.METRICS.record_http("pipeline", "POST", "/send", 200, 0.01)
+        assert main.METRICS.current_command() is None
+
+    asyncio.run(scenario())
+    stats = command_requests("probe")
+    assert stats.get("panel", 0) - before == 2
+    assert "pipeline" not in stats
+
+
+def test_generator_closed_from_another_task():
+    total = commands_total("probe")
+
+    async def scenario():
+        gen = probe(steps=3)
+        assert await asyncio.create_task(gen.__anext__()) == 0
+        # 在另一个任务（另一个上下文）里关闭，不应报错也不应残留归属
+        await asyncio.create_task(gen.aclose())
+        assert main.METRICS.current_command() is None
+
+    asyncio.run(scenario())
+    assert commands_total("probe") == total + 1
+
+
+def test_stats_command_is_tracked(stub_plugin):
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            before = commands_total("stats")
+            event = BenchEvent("admin", bili)
+            await drive(plugin.stats(event), event)
+            assert "运行统计" in event.replies[-1]
+            assert commands_total("stats") == before + 1
+
+    asyncio.run(scenario())
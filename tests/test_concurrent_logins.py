@@ -0,0 +1,62 @@
+"""并发扫码登录：每个会话拿到自己的 Cookie，面板上的 Cookie 变量不丢、不重、编号连续"""
+import asyncio
+
+import main
+from conftest import cookie_envs, login, logout
+from load_bench import succeeded
+
+
+def assert_envs_consistent(stubs, bili, uids):
+    envs = cookie_envs(stubs)
+    seen = []
+    for env in envs:
+        cookies = main.parse_cookie_string(env["value"])
+        uid = cookies["DedeUserID"]
+        # 备注、Cookie 中的 UID 和签发这组 SESSDATA 的账号三者一致，说明没有串号
+        assert main.env_uid(env) == uid
+        assert bili.logins[cookies["SESSDATA"]]["uid"] == uid
+        seen.append(uid)
+    assert sorted(seen) == sorted(uids)
+    for stub in stubs:
+        slots = sorted(int(e["name"][len(main.CHECK_PREFIX):]) for e in stub.envs if e["name"].startswith(main.CHECK_PREFIX))
+        assert slots == list(range(len(slots)))
+
+
+def test_overlapping_logins_get_own_cookies(stub_plugin):
+    uids = [str(20000 + i) for i in range(24)]
+
+    async def scenario():
+        async with stub_plugin(latency=0.002) as (plugin, stubs, bili):
+            # 扫码时间错开，让轮询、写入和编号分配交错进行
+            events = await asyncio.gather(*[
+                login(plugin, bili, uid, scan_after=0.02 * (i % 5), confirm_after=0.01 * (i % 3))
+                for i, uid in enumerate(uids)
+            ])
+            assert all(succeeded(e) for e in events), [e.replies[-1] for e in events if not succeeded(e)]
+            assert_envs_consistent(stubs, bili, uids)
+
+    asyncio.run(scenario())
+
+
+def test_overlapping_relogin_and_logout_keep_slots(stub_plugin):
+    uids = [str(30000 + i) for i in range(16)]
+
+    async def scenario():
+        async with stub_plugin(panels=2, max_account=16, latency=0.002) as (plugin, stubs, bili):
+            await asyncio.gather(*[login(plugin, bili, uid) for uid in uids])
+            assert_envs_consistent(stubs, bili, uids)
+            before = {main.env_uid(e): e["value"] for e in cookie_envs(stubs)}
+
+            # 一半账号重新登录（覆盖原变量），另一半同时退出（删除后后面的变量前移）
+            relogin, leaving = uids[::2], uids[1::2]
+            events = await asyncio.gather(
+                *[login(plugin, bili, uid) for uid in relogin],
+                *[logout(plugin, bili, uid) for uid in leaving],
+            )
+            assert all(succeeded(e) for e in events), [e.replies[-1] for e in events if not succeeded(e)]
+            assert_envs_consistent(stubs, bili, relogin)
+            after = {main.env_uid(e): e["value"] for e in cookie_envs(stubs)}
+            assert all(after[uid] != before[uid] for uid in relogin)
+
+    asyncio.run(scenario())
+
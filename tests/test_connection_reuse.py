@@ -0,0 +1,57 @@
+"""连续执行多条命令时复用同一条到面板的 HTTP 连接和同一个令牌，不为每条命令重新握手/认证"""
+import asyncio
+
+from conftest import cookie_envs, login
+from load_bench import BenchEvent, drive, succeeded
+
+
+def test_commands_reuse_panel_connection_and_token(stub_plugin):
+    uids = ["40001", "40002", "40003"]
+
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            stub = stubs[0]
+            for uid in uids:
+                assert succeeded(await login(plugin, bili, uid))
+
+            commands = [
+                ("info", ()), ("help", ()), ("info", ()), ("stats", ()),
+                ("reconcile", ()), ("forcelogout", (int(uids[0]),)), ("info", ()),
+            ]
+            for name, args in commands:
+                event = BenchEvent("admin", bili)
+                await drive(getattr(plugin, name)(event, *args), event)
+                assert event.replies and not event.replies[-1].startswith("❌"), (name, event.replies)
+
+            # 同时到达的 info 共用一次环境变量读取，也不额外建连
+            for panel in plugin.ql.panels:
+                panel.invalidate_envs()
+            reads = stub.requests["GET /open/envs"]
+            events = [BenchEvent(f"user{i}", bili) for i in range(10)]
+            await asyncio.gather(*[drive(plugin.info(e), e) for e in events])
+            assert stub.requests["GET /open/envs"] - reads <= 1
+
+            assert stub.connections == 1
+            assert stub.requests["GET /open/auth/token"] == 1
+            assert len(cookie_envs(stubs)) == len(uids) - 1
+
+    asyncio.run(scenario())
+
+
+def test_expired_token_reauthenticates_once_on_same_connection(stub_plugin):
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            stub = stubs[0]
+            assert succeeded(await login(plugin, bili, "40010"))
+            stub.expire_tokens()
+            for panel in plugin.ql.panels:
+                panel.invalidate_envs()
+
+            events = [BenchEvent(f"user{i}", bili) for i in range(5)]
+            await asyncio.gather(*[drive(plugin.info(e), e) for e in events])
+            assert all("❌" not in e.replies[-1] for e in events)
+
+            assert stub.connections == 1
+            assert stub.requests["GET /open/auth/token"] == 2
+
+    asyncio.run(scenario())
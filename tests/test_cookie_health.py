@@ -0,0 +1,54 @@
+"""Cookie 健康检测：B站侧失效的账号被标记并在 info 中提示，无法判断时不误报"""
+import asyncio
+
+from conftest import login
+from load_bench import BenchEvent, drive, succeeded
+
+
+def test_expired_cookie_is_flagged(stub_plugin):
+    uids = ["50001", "50002", "50003"]
+
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            for uid in uids:
+                assert succeeded(await login(plugin, bili, uid))
+            assert bili.expire(uids[1]) == 1
+
+            checker = plugin.health_checker
+            checker.max_age, checker.jitter = 0, 0
+            assert await checker.check_due() == len(uids)
+
+            states = {uid: plugin.registry.get(uid) for uid in uids}
+            assert states[uids[1]]["alive"] is False
+            assert all(states[uid]["alive"] is True for uid in (uids[0], uids[2]))
+
+            event = BenchEvent("user", bili)
+            await drive(plugin.info(event), event)
+            text = event.replies[-1]
+            assert "Cookie已失效" in text and f"UID {uids[1]}" in text
+            assert f"UID {uids[0]}" not in text
+
+            # 重新扫码登录后恢复为有效
+            assert succeeded(await login(plugin, bili, uids[1]))
+            assert await checker.check_due() == len(uids)
+            assert plugin.registry.get(uids[1])["alive"] is True
+
+    asyncio.run(scenario())
+
+
+def test_unreachable_bilibili_does_not_flag(stub_plugin):
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            assert succeeded(await login(plugin, bili, "50010"))
+            checked_at = plugin.registry.get("50010")["checked_at"]
+            await bili.stop()
+
+            checker = plugin.health_checker
+            checker.max_age, checker.jitter = 0, 0
+            await checker.check_due()
+            state = plugin.registry.get("50010")
+            assert state.get("alive") is not False
+            # 检测时间不更新，下一轮重试
+            assert state["checked_at"] == checked_at
+
+    asyncio.run(scenario())
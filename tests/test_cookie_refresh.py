@@ -0,0 +1,120 @@
+"""Cookie 自动刷新：刷新成功后面板变量被换成新 Cookie，刷新/写回失败和缺少 cryptography 时不丢账号"""
+import asyncio
+import sys
+
+import pytest
+
+import main
+from conftest import cookie_envs, login
+from load_bench import succeeded
+
+
+def panel_cookies(stubs):
+    return {main.env_uid(e): e["value"] for e in cookie_envs(stubs)}
+
+
+def prepare(plugin):
+    refresher = plugin.cookie_refresher
+    refresher.check_age, refresher.spacing = 0, 0
+    return refresher
+
+
+@pytest.mark.skipif(not main.refresh_supported(), reason="未安装 cryptography")
+def test_refresh_rewrites_panel_env(stub_plugin):
+    uids = ["60001", "60002"]
+
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            for uid in uids:
+                assert succeeded(await login(plugin, bili, uid))
+            before = panel_cookies(stubs)
+            old_token = plugin.registry.get(uids[0])["refresh_token"]
+            bili.mark_stale(uids[0])
+
+            assert await prepare(plugin).refresh_due() == 1
+            after = panel_cookies(stubs)
+            assert after[uids[0]] != before[uids[0]]
+            assert after[uids[1]] == before[uids[1]]
+            assert main.parse_cookie_string(after[uids[0]])["DedeUserID"] == uids[0]
+            # 新 Cookie 可用，确认刷新后旧 Cookie 失效
+            assert await plugin.bili.check_login_state(after[uids[0]]) is True
+            assert await plugin.bili.check_login_state(before[uids[0]]) is False
+
+            state = plugin.registry.get(uids[0])
+            assert state["refresh_token"] not in ("", old_token)
+            assert not state.get("pending_cookie")
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not main.refresh_supported(), reason="未安装 cryptography")
+def test_refresh_rejected_keeps_old_cookie(stub_plugin):
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            assert succeeded(await login(plugin, bili, "60010"))
+            before = panel_cookies(stubs)
+            bili.mark_stale("60010")
+            # 本地保存的 refresh_token 与 B站不匹配，刷新被拒绝
+            plugin.registry.update("60010", refresh_token="0" * 32)
+
+            assert await prepare(plugin).refresh_due() == 0
+            assert panel_cookies(stubs) == before
+            assert await plugin.bili.check_login_state(before["60010"]) is True
+            state = plugin.registry.get("60010")
+            assert state["refresh_checked_at"] > 0 and not state.get("pending_cookie")
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not main.refresh_supported(), reason="未安装 cryptography")
+def test_write_back_failure_retries_without_second_refresh(stub_plugin, monkeypatch):
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            assert succeeded(await login(plugin, bili, "60020"))
+            before = panel_cookies(stubs)
+            bili.mark_stale("60020")
+            refresher = prepare(plugin)
+
+            save = plugin.ql.save_cookie_to_qinglong
+
+            async def unavailable(cookies, uid):
+                return False, "青龙面板暂时无法连接"
+
+            monkeypatch.setattr(plugin.ql, "save_cookie_to_qinglong", unavailable)
+            assert await refresher.refresh_due() == 0
+            assert panel_cookies(stubs) == before
+            assert plugin.registry.get("60020")["pending_cookie"]
+
+            # 面板恢复后直接写回暂存的新 Cookie，不再向 B站发起刷新
+            monkeypatch.setattr(plugin.ql, "save_cookie_to_qinglong", save)
+            refreshes = bili.requests["POST /x/passport-login/web/cookie/refresh"]
+            assert await refresher.refresh_due() == 1
+            assert bili.requests["POST /x/passport-login/web/cookie/refresh"] == refreshes
+            after = panel_cookies(stubs)
+            assert after["60020"] != before["60020"]
+            assert await plugin.bili.check_login_state(after["60020"]) is True
+            assert not plugin.registry.get("60020").get("pending_cookie")
+
+    asyncio.run(scenario())
+
+
+def test_missing_cryptography_disables_refresh(stub_plugin, monkeypatch):
+    for name in [m for m in sys.modules if m == "cryptography" or m.startswith("cryptography.")] + ["cryptography"]:
+        monkeypatch.setitem(sys.modules, name, None)
+    main._refresh_public_key.cache_clear()
+    assert not main.refresh_supported()
+
+    async def scenario():
+        async with stub_plugin(advanced={"cookie_refresh": True}) as (plugin, stubs, bili):
+            assert plugin.cookie_refresher._task is None
+            assert succeeded(await login(plugin, bili, "60030"))
+            before = panel_cookies(stubs)
+            bili.mark_stale("60030")
+
+            # 即使手动跑一轮，加密 correspondPath 失败也只记为刷新失败，面板中的 Cookie 保持不变
+            assert await prepare(plugin).refresh_due() == 0
+            assert panel_cookies(stubs) == before
+            assert await plugin.bili.check_login_state(before["60030"]) is True
+
+    asyncio.run(scenario())
+    main._refresh_public_key.cache_clear()
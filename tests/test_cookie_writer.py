@@ -0,0 +1,85 @@
+"""Cookie 批量写入：PUT 按计划顺序逐个发送，中途失败时后续请求不再发出，快照和本地登记整体作废"""
+import asyncio
+
+import main
+from conftest import cookie_envs
+from load_bench import BenchEvent, drive
+from stub_servers import QinglongStub, json_response
+
+
+def seed(stub, bili, uids, slots):
+    for uid, slot in zip(uids, slots):
+        sessdata, rec = bili.issue_login(uid)
+        stub.add_env(f"{main.CHECK_PREFIX}{slot}", f"DedeUserID={uid}; SESSDATA={sessdata}; bili_jct={rec['bili_jct']}", f"bili-{uid}")
+
+
+def test_puts_are_sequential_and_stop_at_first_failure(stub_plugin):
+    uids = ["70001", "70002", "70003"]
+
+    async def scenario():
+        async with stub_plugin() as (plugin, stubs, bili):
+            stub = stubs[0]
+            # 编号不连续，整理时三个变量都要改名进 __0..__2
+            seed(stub, bili, uids, [5, 7, 9])
+            sent, in_flight, overlap = [], [0], [False]
+            handle = stub.handle
+
+            async def failing_handle(method, path, query, headers, body):
+                if method == "PUT" and path == "/open/envs":
+                    in_flight[0] += 1
+                    overlap[0] |= in_flight[0] > 1
+                    await asyncio.sleep(0.01)
+                    in_flight[0] -= 1
+                    sent.append(body)
+                    if len(sent) == 2:
+                        return json_response({"code": 500, "message": "stub failure"}, 500)
+                return await handle(method, path, query, headers, body)
+
+            stub.handle = failing_handle
+            event = BenchEvent("admin", bili)
+            await drive(plugin.reconcile(event, "apply"), event)
+            assert "❌" in event.replies[-1]
+
+            assert not overlap[0]
+            # 第二个 PUT 失败后第三个不再发送
+            assert len(sent) == 2
+            assert not plugin.registry.fresh([stub.url])
+            names = sorted(e["name"] for e in cookie_envs(stubs))
+            assert len(names) == len(uids)
+
+            # 面板恢复后再整理一次，从面板的真实状态继续
+            stub.handle = handle
+            event = BenchEvent("admin", bili)
+            await drive(plugin.reconcile(event, "apply"), event)
+            assert "❌" not in event.replies[-1]
+            envs = cookie_envs(stubs)
+            assert sorted(e["name"] for e in envs) == [f"{main.CHECK_PREFIX}{i}" for i in range(len(uids))]
+            assert sorted(main.env_uid(e) for e in envs) == uids
+            assert plugin.registry.fresh([stub.url])
+            assert plugin.registry.count() == len(uids)
+
+    asyncio.run(scenario())
+
+
+def test_close_answers_in_flight_batch():
+    async def scenario():
+        stub = QinglongStub(latency=0.2)
+        await stub.start()
+        client = main.QinglongClient(stub.url, stub.client_id, stub.client_secret)
+        try:
+            # 第一个请求在合并窗口里被关闭，第二个请求在读取快照/写入中被关闭
+            waiting = asyncio.create_task(client.save_cookie_to_qinglong({"DedeUserID": "1"}, 1))
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(client.writer.close(), 1)
+            assert await asyncio.wait_for(waiting, 1) == (False, "插件正在关闭")
+
+            writing = asyncio.create_task(client.save_cookie_to_qinglong({"DedeUserID": "2"}, 2))
+            await asyncio.sleep(client.writer.batch_window + 0.1)
+            await asyncio.wait_for(client.writer.close(), 1)
+            assert await asyncio.wait_for(writing, 1) == (False, "插件正在关闭")
+            assert client._env_snapshot is None
+        finally:
+            await client.close()
+            await stub.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,111 @@
+"""多实例写入租约：开启时两个实例交错写入仍保持编号连续、UID 不重复；关闭时不加锁、不访问面板"""
+import asyncio
+import json
+import os
+import random
+import time
+
+import main
+from conftest import cookie_envs
+from stub_servers import QinglongStub
+
+
+def assert_slots(stub, uids):
+    envs = cookie_envs([stub])
+    slots = sorted(int(e["name"][len(main.CHECK_PREFIX):]) for e in envs)
+    assert slots == list(range(len(envs)))
+    assert sorted(main.env_uid(e) for e in envs) == sorted(map(str, uids))
+
+
+def test_shared_lease_serializes_two_instances(monkeypatch):
+    monkeypatch.setattr(main.MutationLease, "SETTLE", 0.05)
+
+    async def scenario():
+        stub = QinglongStub(latency=0.005)
+        await stub.start()
+        port = stub.url.rsplit(":", 1)[1]
+        # 两个地址指向同一面板，文件锁互不相干，只靠面板上的租约互斥（相当于两台主机）
+        a = main.QinglongClient(f"http://127.0.0.1:{port}", stub.client_id, stub.client_secret, shared=True)
+        b = main.QinglongClient(f"http://localhost:{port}", stub.client_id, stub.client_secret, shared=True)
+        rng = random.Random(7)
+
+        async def login(client, uid):
+            await asyncio.sleep(rng.uniform(0, 0.5))
+            return await client.save_cookie_to_qinglong({"SESSDATA": "x", "DedeUserID": str(uid)}, uid)
+
+        async def logout(client, uid):
+            await asyncio.sleep(rng.uniform(0, 0.5))
+            return await client.delete_bili_cookie(None, uid)
+
+        try:
+            uids = list(range(1, 13))
+            results = await asyncio.gather(*[login(a if uid % 2 else b, uid) for uid in uids])
+            assert all(ok for ok, _ in results), results
+            assert_slots(stub, uids)
+
+            leaving = uids[::3]
+            results = await asyncio.gather(*[logout(b if uid % 2 else a, uid) for uid in leaving])
+            assert all(ok for ok, _ in results), results
+            assert_slots(stub, [uid for uid in uids if uid not in leaving])
+
+            leases = [json.loads(e["value"]) for e in stub.envs if e["name"] == main.MutationLease.NAME]
+            assert len(leases) == 1 and leases[0]["fence"] > 0 and leases[0]["expires"] == 0
+        finally:
+            await a.close()
+            await b.close()
+            await stub.stop()
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_is_taken_over_and_live_lease_times_out(monkeypatch):
+    monkeypatch.setattr(main.MutationLease, "SETTLE", 0.05)
+
+    async def scenario():
+        stub = QinglongStub()
+        await stub.start()
+        stub.add_env(main.MutationLease.NAME, json.dumps({"owner": "dead", "expires": time.time() + 0.5, "fence": 7}))
+        client = main.QinglongClient(stub.url, stub.client_id, stub.client_secret, shared=True, lease_wait=3)
+        try:
+            ok, _ = await client.save_cookie_to_qinglong({"DedeUserID": "1"}, 1)
+            assert ok
+            lease = json.loads(stub.envs[0]["value"])
+            assert lease["fence"] == 8 and lease["owner"] == client.lease.owner
+
+            stub.envs[0]["value"] = json.dumps({"owner": "busy", "expires": time.time() + 100, "fence": 9})
+            client.lease.max_wait = 0.5
+            ok, msg = await client.save_cookie_to_qinglong({"DedeUserID": "2"}, 2)
+            assert not ok and "busy" in msg
+            assert_slots(stub, [1])
+        finally:
+            await client.close()
+            await stub.stop()
+
+    asyncio.run(scenario())
+
+
+def test_unshared_lease_is_a_no_op():
+    async def scenario():
+        stub = QinglongStub()
+        await stub.start()
+        a = main.QinglongClient(stub.url, stub.client_id, stub.client_secret)
+        b = main.QinglongClient(stub.url, stub.client_id, stub.client_secret)
+        try:
+            if os.path.exists(a.lease._lock_path):
+                os.remove(a.lease._lock_path)
+            # 同一面板地址的两个实例可以同时进入，不创建锁文件、不请求面板
+            async with a.lease.hold():
+                async with b.lease.hold():
+                    assert a.lease._lock_file is None and b.lease._lock_file is None
+            assert not os.path.exists(a.lease._lock_path)
+            assert stub.total_requests == 0
+
+            ok, _ = await a.save_cookie_to_qinglong({"DedeUserID": "1"}, 1)
+            assert ok
+            assert not any(e["name"] == main.MutationLease.NAME for e in stub.envs)
+        finally:
+            await a.close()
+            await b.close()
+            await stub.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,13 @@
+"""紧凑二维码：PNG 尺寸与矩阵对应"""
+import struct
+
+import main
+
+URL = "https://account.bilibili.com/h5/account-h5/auth/scan-web?navhide=1&callback=close&qrcode_key={:032x}&from="
+
+
+def test_compact_png_matches_matrix():
+    text = URL.format(1)
+    png = main._render_qr(text, compact=True).getvalue()
+    width, height = struct.unpack(">II", png[16:24])
+    assert width == height == len(main._qr_matrix(text)) * main.QR_COMPACT_SCALE
@@ -0,0 +1,29 @@
+"""B站自适应限速：暂停结束后按 recovery 线性恢复，暂停期间不计入恢复时间"""
+import pytest
+
+import main
+
+
+def held_limiter():
+    limiter = main.AdaptiveRateLimiter("rate-limiter-test", max_rps=4.0, hold=60.0, recovery=300.0)
+    start = limiter._updated
+    limiter.rate = 0.5
+    limiter.hold_until = start + 60.0
+    return limiter, start
+
+
+def test_no_recovery_credit_for_idle_hold():
+    limiter, start = held_limiter()
+    # 暂停期间没有任何请求，暂停结束 1 秒后的第一次调用只恢复 1 秒的量
+    limiter._refill(start + 61.0)
+    assert limiter.rate == pytest.approx(0.5 + 4.0 / 300)
+
+
+def test_linear_ramp_after_hold():
+    limiter, start = held_limiter()
+    limiter._refill(start + 30.0)
+    assert limiter.rate == 0.5
+    limiter._refill(start + 60.0 + 150.0)
+    assert limiter.rate == pytest.approx(0.5 + 2.0)
+    limiter._refill(start + 60.0 + 300.0)
+    assert limiter.rate == 4.0
@@ -0,0 +1,69 @@
+"""resilient_request：只在请求肯定没发出时重试 POST；连接池排队超时不计入熔断器"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def run(handler, method, host, retries=2):
+    calls = []
+
+    def transport(request):
+        calls.append(request.method)
+        return handler(request, len(calls))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(transport)) as client:
+            return await main.resilient_request(client, method, f"http://{host}/open/envs", host, retries=retries)
+
+    return calls, scenario
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(main, "backoff_delay", lambda attempt: 0)
+
+
+def dropped_after_first(request, n):
+    if n == 1:
+        raise httpx.RemoteProtocolError("Server disconnected without sending a response.", request=request)
+    return httpx.Response(200, json={"code": 200})
+
+
+def test_post_not_retried_after_remote_disconnect():
+    calls, scenario = run(dropped_after_first, "POST", "post-disconnect")
+    with pytest.raises(httpx.RemoteProtocolError):
+        asyncio.run(scenario())
+    assert calls == ["POST"]
+
+
+def test_get_retried_after_remote_disconnect():
+    calls, scenario = run(dropped_after_first, "GET", "get-disconnect")
+    assert asyncio.run(scenario()).status_code == 200
+    assert calls == ["GET", "GET"]
+
+
+def test_post_retried_on_connect_error():
+    def refused_once(request, n):
+        if n == 1:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"code": 200})
+
+    calls, scenario = run(refused_once, "POST", "post-connect")
+    assert asyncio.run(scenario()).status_code == 200
+    assert calls == ["POST", "POST"]
+
+
+def test_pool_timeout_does_not_open_breaker():
+    def pool_full(request, n):
+        raise httpx.PoolTimeout("pool full", request=request)
+
+    host = "pool-timeout"
+    for _ in range(3):
+        calls, scenario = run(pool_full, "GET", host)
+        with pytest.raises(httpx.PoolTimeout):
+            asyncio.run(scenario())
+    breaker = main.BREAKERS.get(host)
+    assert breaker.state == "closed" and breaker.failures == 0